@@ -0,0 +1,221 @@
+"""Module to discover the listener rules checking the token header and keep an index of them"""
+
+import os
+import threading
+import time
+
+from aws_clients import get_client
+from deadline import Deadline
+from json_file import load_json, save_json
+from targets import ListenerRuleTarget, run_concurrently
+
+# Regions scanned for listener rules, a comma separated list, empty turns discovery off
+ALB_DISCOVERY_REGIONS = [
+    region.strip()
+    for region in os.environ.get("ALB_DISCOVERY_REGIONS", "").split(",")
+    if region.strip()
+]
+ALB_DISCOVERY_HEADER = os.environ.get("ALB_DISCOVERY_HEADER", "X-ALB-SECRET")
+ALB_DISCOVERY_TTL = float(os.environ.get("ALB_DISCOVERY_TTL", "3600"))
+ALB_DISCOVERY_INDEX = os.environ.get("ALB_DISCOVERY_INDEX", "/tmp/alb-discovery-index.json")
+ALB_DISCOVERY_CONCURRENCY = int(os.environ.get("ALB_DISCOVERY_CONCURRENCY", "10"))
+
+# Bumped when the layout of the persisted index changes, older files are rescanned
+INDEX_VERSION = 1
+
+
+def target_conditions(conditions, header_name):
+    """Conditions of a rule other than the token header, in the form modify_rule takes them."""
+
+    kept = []
+    for condition in conditions:
+        config = condition.get("HttpHeaderConfig", {})
+        if config.get("HttpHeaderName", "").lower() == header_name.lower():
+            continue
+        # describe_rules repeats the legacy Values next to the config, modify_rule takes one
+        if any(key.endswith("Config") for key in condition):
+            condition = {key: value for key, value in condition.items() if key != "Values"}
+        kept.append(condition)
+    return kept
+
+
+def paginate(region_name, operation, deadline, **kwargs):
+    """Yield the pages of an elbv2 describe call, checking the deadline before every page.
+
+    Each page is requested by a client with timeouts fitting the time left.
+    """
+
+    marker = None
+    while True:
+        timeouts = deadline.client_timeouts(f"{operation} in {region_name}")
+        client = get_client("elbv2", region_name, timeouts=timeouts)
+        page = getattr(client, operation)(**kwargs, **({"Marker": marker} if marker else {}))
+        yield page
+        marker = page.get("NextMarker")
+        if not marker:
+            return
+
+
+def list_load_balancer_rules(region_name, load_balancer_arn, deadline):
+    """Return every rule of every listener of a load balancer."""
+
+    rules = []
+    for page in paginate(
+        region_name, "describe_listeners", deadline, LoadBalancerArn=load_balancer_arn
+    ):
+        for listener in page["Listeners"]:
+            for rule_page in paginate(
+                region_name, "describe_rules", deadline, ListenerArn=listener["ListenerArn"]
+            ):
+                rules.extend(
+                    dict(rule, ListenerArn=listener["ListenerArn"])
+                    for rule in rule_page["Rules"]
+                    if not rule.get("IsDefault")
+                )
+    return rules
+
+
+def scan_region(region_name, deadline=None):
+    """Index the listener rules of every application load balancer in a region by header name."""
+
+    deadline = deadline or Deadline()
+    load_balancers = [
+        load_balancer["LoadBalancerArn"]
+        for page in paginate(region_name, "describe_load_balancers", deadline)
+        for load_balancer in page["LoadBalancers"]
+        # Only application load balancers have rules matching on headers
+        if load_balancer.get("Type", "application") == "application"
+    ]
+    results = run_concurrently(
+        lambda load_balancer_arn: list_load_balancer_rules(
+            region_name, load_balancer_arn, deadline
+        ),
+        load_balancers,
+        ALB_DISCOVERY_CONCURRENCY,
+    )
+
+    headers = {}
+    for result in results:
+        if not result.success:
+            raise result.error
+        for rule in result.response:
+            for condition in rule["Conditions"]:
+                if condition["Field"] != "http-header":
+                    continue
+                header_name = condition["HttpHeaderConfig"]["HttpHeaderName"]
+                # ALB matches header names without regard to case
+                headers.setdefault(header_name.lower(), []).append(
+                    {
+                        "rule_arn": rule["RuleArn"],
+                        "listener_arn": rule["ListenerArn"],
+                        "header_name": header_name,
+                        "conditions": rule["Conditions"],
+                    }
+                )
+    return headers
+
+
+class DiscoveryIndex:
+    """Index of listener rules by the header they check, persisted to a file and rescanned per
+    region once its entry is older than the TTL"""
+
+    def __init__(self, regions=None, path=None, ttl=None, clock=time.time):
+        self.regions = ALB_DISCOVERY_REGIONS if regions is None else regions
+        self.path = ALB_DISCOVERY_INDEX if path is None else path
+        self.ttl = ALB_DISCOVERY_TTL if ttl is None else ttl
+        self.clock = clock
+        # Region name to {"scanned_at", "headers"}, read from the file on first use
+        self.entries = None
+        self._lock = threading.Lock()
+        # Serialises the regions scanned in parallel storing their entries
+        self._save_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """True when regions to scan are configured."""
+
+        return bool(self.regions)
+
+    def load(self):
+        """Read the persisted entries, a missing, unreadable or outdated file reads as empty."""
+
+        return load_json(self.path, INDEX_VERSION).get("regions", {})
+
+    def save(self):
+        """Persist the entries, replacing the file in one step."""
+
+        save_json(self.path, {"regions": self.entries}, INDEX_VERSION)
+
+    def stale_regions(self):
+        """Configured regions never scanned, or scanned longer than the TTL ago."""
+
+        now = self.clock()
+        return [
+            region
+            for region in self.regions
+            if region not in self.entries or now - self.entries[region]["scanned_at"] >= self.ttl
+        ]
+
+    def refresh(self, force=False, deadline=None):
+        """Rescan the stale regions in parallel, or every region when forced, and persist the index.
+
+        Every region is persisted as soon as its scan finishes, so a retry after the deadline
+        only scans the regions left. A region that fails to scan keeps its previous entry, a
+        region never scanned raises. Returns the TargetResult of every region scanned.
+        """
+
+        deadline = deadline or Deadline()
+        with self._lock:
+            if self.entries is None:
+                self.entries = self.load()
+            regions = list(self.regions) if force else self.stale_regions()
+            scanned_at = self.clock()
+
+            def scan(region_name):
+                headers = scan_region(region_name, deadline)
+                with self._save_lock:
+                    self.entries[region_name] = {"scanned_at": scanned_at, "headers": headers}
+                    self.save()
+                return headers
+
+            results = run_concurrently(scan, regions, ALB_DISCOVERY_CONCURRENCY)
+            for result in results:
+                if result.success:
+                    continue
+                if result.target in self.entries:
+                    print(f"Could not rescan {result.target}, keeping its index: {result.error}")
+                else:
+                    # Without an entry the rotation would silently skip the region's rules
+                    raise result.error
+            dropped = set(self.entries) - set(self.regions)
+            for region in dropped:
+                del self.entries[region]
+            if dropped:
+                self.save()
+            return results
+
+    def invalidate(self, region_name):
+        """Mark a region stale so the next lookup rescans it, e.g. after one of its rules was deleted."""
+
+        with self._lock:
+            if self.entries and region_name in self.entries:
+                self.entries[region_name]["scanned_at"] = float("-inf")
+
+    def targets(self, header_name=None, deadline=None):
+        """Return a ListenerRuleTarget for every indexed rule checking the header."""
+
+        header_name = header_name or ALB_DISCOVERY_HEADER
+        self.refresh(deadline=deadline)
+        return [
+            ListenerRuleTarget(
+                rule["rule_arn"],
+                target_conditions(rule["conditions"], header_name),
+                header_name=rule["header_name"],
+            )
+            for region in self.regions
+            for rule in self.entries[region]["headers"].get(header_name.lower(), [])
+        ]
+
+
+# Shared by warm invocations, which read the index from memory rather than the file
+INDEX = DiscoveryIndex()
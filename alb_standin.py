@@ -0,0 +1,104 @@
+"""Local stand-in for a load balancer listener rule that checks the token header, and the moto
+load balancer setup the tests and benchmarks share"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+import boto3
+
+from cloudflare_standin import LocalServer
+from targets import ListenerRuleTarget
+
+
+def create_listener_rules(region_name, hosts, token="old_token", client=None, ec2_client=None):
+    """Create a moto load balancer with a listener rule per host checking the token header.
+
+    Returns a ListenerRuleTarget for every rule. moto must already be mocking ec2 and elbv2,
+    the clients default to ones for region_name.
+    """
+
+    client = client or boto3.client("elbv2", region_name=region_name)
+    ec2_client = ec2_client or boto3.client("ec2", region_name=region_name)
+    vpc_id = ec2_client.create_vpc(CidrBlock="10.0.0.0/16")["Vpc"]["VpcId"]
+    subnets = [
+        ec2_client.create_subnet(
+            VpcId=vpc_id, CidrBlock=cidr, AvailabilityZone=f"{region_name}{zone}"
+        )["Subnet"]["SubnetId"]
+        for cidr, zone in (("10.0.1.0/24", "a"), ("10.0.2.0/24", "b"))
+    ]
+    load_balancer_arn = client.create_load_balancer(Name="standin-alb", Subnets=subnets)[
+        "LoadBalancers"
+    ][0]["LoadBalancerArn"]
+    target_group_arn = client.create_target_group(
+        Name="standin-targets", Protocol="HTTP", Port=80, VpcId=vpc_id
+    )["TargetGroups"][0]["TargetGroupArn"]
+    forward = [{"Type": "forward", "TargetGroupArn": target_group_arn}]
+    listener_arn = client.create_listener(
+        LoadBalancerArn=load_balancer_arn, Protocol="HTTP", Port=80, DefaultActions=forward
+    )["Listeners"][0]["ListenerArn"]
+
+    targets = []
+    for priority, host in enumerate(hosts, start=1):
+        conditions = [{"Field": "host-header", "HostHeaderConfig": {"Values": [host]}}]
+        rule_arn = client.create_rule(
+            ListenerArn=listener_arn,
+            Priority=priority,
+            Conditions=[
+                {
+                    "Field": "http-header",
+                    "HttpHeaderConfig": {"HttpHeaderName": "X-ALB-SECRET", "Values": [token]},
+                },
+                *conditions,
+            ],
+            Actions=forward,
+        )["Rules"][0]["RuleArn"]
+        targets.append(ListenerRuleTarget(rule_arn, conditions))
+    return targets
+
+
+class ListenerStandin(LocalServer):
+    """HTTP server answering 200 when the token header holds an accepted value and 403 otherwise"""
+
+    def __init__(self, accepted=(), header_name="X-ALB-SECRET", latency=0.0):
+        # Accepted values, or a callable returning them for every request
+        self.accepted = accepted
+        self.header_name = header_name
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+        super().__init__(self._handler_class())
+
+    def accepted_values(self):
+        """Header values currently accepted."""
+
+        return self.accepted() if callable(self.accepted) else self.accepted
+
+    def _handler_class(self):
+        listener = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Header checking handler bound to the listener stand-in"""
+
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                value = self.headers.get(listener.header_name)
+                with listener.lock:
+                    listener.requests.append((self.command, self.path, value))
+                if listener.latency:
+                    time.sleep(listener.latency)
+
+                accepted = value is not None and value in listener.accepted_values()
+                data = b"OK" if accepted else b"Forbidden"
+                self.send_response(200 if accepted else 403)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
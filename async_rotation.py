@@ -0,0 +1,363 @@
+"""Module to run the Cloudflare and AWS calls of a rotation on a shared asyncio event loop"""
+
+import asyncio
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import weakref
+
+import aiohttp
+
+from cloudflare_helper import (
+    CF_MAX_RETRIES,
+    CF_TIMEOUT,
+    CloudflareAPIError,
+    CloudflareHelper,
+    attempt_delay,
+    checked_response,
+    header_values,
+    rule_path,
+    rules_by_target,
+    ruleset_rules,
+    target_update,
+)
+from loadbalancer_helper import ALB_MAX_CONCURRENCY, LoadbalancerHelper
+from metrics import METRICS
+from rotation_state import SetSecretStateMachine
+from targets import TargetResult
+
+# Cloudflare requests in flight at once, and the connection pool size of the aiohttp session
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", "100"))
+
+_aiohttp_sessions = weakref.WeakKeyDictionary()
+
+
+class EventLoopThread:
+    """Event loop running on a daemon thread, shared by every synchronous caller in the process"""
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def run(self, coroutine):
+        """Run a coroutine on the shared loop and return its result."""
+
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError("Await the _async method instead of blocking the event loop")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        """Close the loop's HTTP session and stop the loop."""
+
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(close_aiohttp_session(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join()
+        loop.close()
+
+
+EVENT_LOOP = EventLoopThread()
+
+
+def run(coroutine):
+    """Run a coroutine from synchronous code on the shared event loop."""
+
+    return EVENT_LOOP.run(coroutine)
+
+
+def get_aiohttp_session():
+    """Return the keep-alive session of the running event loop, shared by its Cloudflare calls."""
+
+    loop = asyncio.get_running_loop()
+    session = _aiohttp_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=ASYNC_MAX_CONCURRENCY)
+        )
+        _aiohttp_sessions[loop] = session
+    return session
+
+
+async def close_aiohttp_session():
+    """Close the session of the running event loop, the next call opens a new one."""
+
+    session = _aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def run_in_executor(func, *args):
+    """Run a blocking call, e.g. on a shared boto3 client, on the loop's thread pool."""
+
+    # Like asyncio.to_thread, keep the context so metrics know the secret and step
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+
+async def gather_results(func, targets, max_concurrency):
+    """Await func for every target with at most max_concurrency in flight, returning results in target order."""
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_target(target):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await func(target)
+            except Exception as error:
+                return TargetResult(target, error=error, elapsed=time.perf_counter() - start)
+            return TargetResult(target, response=response, elapsed=time.perf_counter() - start)
+
+    return list(await asyncio.gather(*(run_target(target) for target in targets)))
+
+
+class AsyncResponse:
+    """Status, headers and body of an aiohttp response, read before the connection is released"""
+
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class AsyncCloudflareHelper:
+    """Cloudflare WAF token refresher sending its requests concurrently with aiohttp"""
+
+    def __init__(self, base_url=None, session=None, targets=None, deadline=None, rate_limiter=None):
+        # The synchronous helper supplies the configuration and the cached API key
+        self.helper = CloudflareHelper(
+            base_url=base_url, targets=targets, deadline=deadline, rate_limiter=rate_limiter
+        )
+        self.session = session
+
+    @property
+    def targets(self):
+        return self.helper.targets
+
+    @property
+    def deadline(self):
+        return self.helper.deadline
+
+    def roll_token(self, token, targets=None, rules=None):
+        """Roll token method, returns a TargetResult per rule."""
+
+        return run(self.roll_token_async(token, targets, rules))
+
+    def get_token_values(self, targets=None):
+        """Return the token header value set by each rule, None when the rule does not set it."""
+
+        return run(self.get_token_values_async(targets))
+
+    def get_rules(self, targets=None):
+        """Return every rule of the targets' rulesets by target."""
+
+        return run(self.get_rules_async(targets))
+
+    async def roll_token_async(self, token, targets=None, rules=None):
+        """Update the token header of every rule concurrently, see CloudflareHelper.roll_token."""
+
+        cf_api_key = await self.get_api_key()
+        targets = self.targets if targets is None else targets
+        # The rules are written back with only the token changed
+        if rules is None:
+            rules = rules_by_target(await self.get_rulesets(targets, cf_api_key))
+        results = await gather_results(
+            lambda target: self.update_rule(token, target, cf_api_key, rules),
+            targets,
+            ASYNC_MAX_CONCURRENCY,
+        )
+        for result in results:
+            self.helper.check_discovered(result.error)
+        return results
+
+    async def get_token_values_async(self, targets=None):
+        """Read the token header value of every rule, one request per ruleset."""
+
+        targets = self.targets if targets is None else targets
+        return header_values(targets, await self.get_rules_async(targets))
+
+    async def get_rules_async(self, targets=None):
+        """Read every rule of the targets' rulesets, one request per ruleset."""
+
+        targets = self.targets if targets is None else targets
+        cf_api_key = await self.get_api_key()
+        return rules_by_target(await self.get_rulesets(targets, cf_api_key))
+
+    async def get_rulesets(self, targets, cf_api_key):
+        """Return a TargetResult per (zone, ruleset) of the targets, read concurrently."""
+
+        rulesets = sorted({(target.zone_id, target.ruleset_id) for target in targets})
+        return await gather_results(
+            lambda ruleset: self.get_ruleset(*ruleset, cf_api_key),
+            rulesets,
+            ASYNC_MAX_CONCURRENCY,
+        )
+
+    async def get_ruleset(self, zone_id, ruleset_id, cf_api_key):
+        """Return a zone ruleset including its rules."""
+
+        response = await self.request("GET", f"/zones/{zone_id}/rulesets/{ruleset_id}", cf_api_key)
+        return response.json()["result"]
+
+    async def update_rule(self, token, target, cf_api_key, rules=None):
+        """Update the token header value in one transform rule, see CloudflareHelper.update_rule."""
+
+        if rules is None:
+            ruleset = await self.get_ruleset(target.zone_id, target.ruleset_id, cf_api_key)
+            rules = ruleset_rules(target.zone_id, target.ruleset_id, ruleset)
+        response = await self.request(
+            "PATCH", rule_path(target), cf_api_key, json=target_update(token, target, rules)
+        )
+        if not response.json().get("success"):
+            raise CloudflareAPIError(response)
+        return response
+
+    async def request(self, method, path, cf_api_key, **kwargs):
+        """Send a request to the Cloudflare API and return the successful response.
+
+        Retries, rate limiting and deadlines behave as in CloudflareHelper.request.
+        """
+
+        headers = {
+            "Authorization": f"Bearer {cf_api_key}",
+            "Content-Type": "application/json",
+        }
+        url = f"{self.helper.base_url}{path}"
+        session = self.session or get_aiohttp_session()
+
+        with METRICS.timed_call("cloudflare", method, path) as call:
+            call.queue_wait = 0.0
+            for attempt in range(CF_MAX_RETRIES + 1):
+                call.retries = attempt
+                call.queue_wait += await self.throttle(method, path)
+                connect, read = self.deadline.timeout(f"{method} {path}", CF_TIMEOUT)
+                timeout = aiohttp.ClientTimeout(
+                    total=connect + read, sock_connect=connect, sock_read=read
+                )
+                try:
+                    async with session.request(
+                        method, url, headers=headers, timeout=timeout, **kwargs
+                    ) as raw:
+                        response = AsyncResponse(raw.status, raw.headers, await raw.read())
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    delay = attempt_delay(call, self.helper.rate_limiter, attempt, error=error)
+                else:
+                    delay = attempt_delay(call, self.helper.rate_limiter, attempt, response)
+                    if delay is None:
+                        return checked_response(response)
+                await self.backoff(method, path, delay)
+
+    async def throttle(self, method, path):
+        """Take a rate limiter token without blocking the event loop, return the seconds waited."""
+
+        delay = self.helper.rate_limiter.reserve()
+        if delay > 0:
+            self.deadline.check(f"{method} {path}", needed=delay)
+            await asyncio.sleep(delay)
+        return delay
+
+    async def backoff(self, method, path, delay):
+        """Sleep delay seconds, raising DeadlineExceeded if no time is left to retry after it."""
+
+        self.deadline.check(f"retrying {method} {path}", needed=delay)
+        await asyncio.sleep(delay)
+
+    async def get_api_key(self):
+        """Return the cached API key, reading Secrets Manager off the event loop on a miss."""
+
+        return await run_in_executor(self.helper.get_api_key)
+
+
+class AsyncLoadbalancerHelper:
+    """Listener rule updater awaiting the shared boto3 clients on the event loop's thread pool"""
+
+    def __init__(self, targets=None, deadline=None):
+        self.helper = LoadbalancerHelper(targets=targets, deadline=deadline)
+
+    @property
+    def targets(self):
+        return self.helper.targets
+
+    @property
+    def deadline(self):
+        return self.helper.deadline
+
+    def modify_rule(self, token, targets=None):
+        """Method to modify listener rules, returns a TargetResult per rule."""
+
+        return run(self.modify_rule_async(token, targets))
+
+    def get_token_values(self, targets=None):
+        """Method to read the token values checked by each listener rule, keyed by rule arn."""
+
+        return run(self.get_token_values_async(targets))
+
+    async def modify_rule_async(self, token, targets=None):
+        """Modify every listener rule concurrently."""
+
+        results = await gather_results(
+            lambda target: run_in_executor(self.helper.modify_target, token, target),
+            self.targets if targets is None else targets,
+            ALB_MAX_CONCURRENCY,
+        )
+        for result in results:
+            self.helper.check_discovered(result.target.region_name, result.error)
+        return results
+
+    async def get_token_values_async(self, targets=None):
+        """Read the token values of every listener rule."""
+
+        return await run_in_executor(self.helper.get_token_values, targets)
+
+
+async def read_secret_values(rotation):
+    """Read the AWSCURRENT and AWSPENDING tokens of a rotation concurrently."""
+
+    return tuple(
+        await asyncio.gather(
+            run_in_executor(lambda: rotation.current_value),
+            run_in_executor(lambda: rotation.pending_value),
+        )
+    )
+
+
+class AsyncSetSecretStateMachine(SetSecretStateMachine):
+    """setSecret state machine making the reads of its plan together on the event loop"""
+
+    def read_state(self, remaining):
+        """Read the tokens and the remote state on the event loop, see SetSecretStateMachine."""
+
+        return run(self.read_state_async(remaining))
+
+    async def read_state_async(self, remaining):
+        """Await the Secrets Manager, listener rule and, unless checkpointed, Cloudflare reads."""
+
+        reads = [read_secret_values(self.rotation), self.modify_listener.get_token_values_async()]
+        if "cloudflare" in remaining:
+            reads.append(self.token_refresh.get_rules_async())
+        (old_token, new_token), alb_values, *cf_rules = await asyncio.gather(*reads)
+        state = {"old_token": old_token, "new_token": new_token, "alb_values": alb_values}
+        if cf_rules:
+            state["cf_rules"] = cf_rules[0]
+        return state
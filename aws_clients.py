@@ -0,0 +1,132 @@
+"""Module to share boto3 clients across warm Lambda invocations"""
+
+import threading
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+
+from aws_tracer import TRACER
+from metrics import register_botocore_events
+
+DEFAULT_REGION = "ap-southeast-2"
+ROLE_SESSION_NAME = "cf-alb-token-rotation"
+
+# Clients are keyed by (service name, region name, role arn, timeouts) and live for as long
+# as the Lambda execution environment, so warm invocations skip client construction.
+CLIENTS = {}
+ROLE_SESSIONS = {}
+INJECTED = set()
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    """Return the boto3 session shared by every client in the registry."""
+
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_role_session(role_arn):
+    """Return a session using credentials of an assumed role, refreshed before they expire."""
+
+    session = ROLE_SESSIONS.get(role_arn)
+    if session is not None:
+        return session
+
+    sts_client = get_client("sts")
+
+    def assume_role():
+        credentials = sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME
+        )["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    botocore_session = botocore.session.get_session()
+    # botocore has no public setter for the credentials of an existing session
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume_role(), refresh_using=assume_role, method="sts-assume-role"
+    )
+    with _lock:
+        return ROLE_SESSIONS.setdefault(
+            role_arn, boto3.session.Session(botocore_session=botocore_session)
+        )
+
+
+def get_client(service_name, region_name=DEFAULT_REGION, role_arn=None, timeouts=None):
+    """Return the shared client for the service, region and role, creating it once.
+
+    timeouts is an optional (connect, read, max attempts) triple, as Deadline.client_timeouts
+    returns, replacing the botocore default timeouts and retries.
+    """
+
+    key = (service_name, region_name, role_arn, timeouts)
+    client = CLIENTS.get(key)
+    if client is not None:
+        return client
+    # Clients injected with set_client are used whatever timeouts are asked for
+    if key[:3] in INJECTED:
+        return CLIENTS[(*key[:3], None)]
+
+    session = get_role_session(role_arn) if role_arn else get_session()
+    with _lock:
+        # Another thread may have created the client while we waited on the lock
+        client = CLIENTS.get(key)
+        if client is None:
+            config = None
+            if timeouts is not None:
+                connect, read, max_attempts = timeouts
+                config = Config(
+                    connect_timeout=connect,
+                    read_timeout=read,
+                    retries={"mode": "standard", "total_max_attempts": max_attempts},
+                )
+            client = session.client(
+                service_name=service_name, region_name=region_name, config=config
+            )
+            register_events(client)
+            CLIENTS[key] = client
+        return client
+
+
+def register_events(client):
+    """Attach the metrics, and the tracer when tracing is on, to a client."""
+
+    register_botocore_events(client.meta.events)
+    if TRACER.enabled:
+        TRACER.register(client.meta.events)
+
+
+def set_client(service_name, client, region_name=DEFAULT_REGION, role_arn=None):
+    """Register a client for the service and region, e.g. a moto backed client in tests.
+
+    The client is used whatever timeouts are asked for.
+    """
+
+    register_events(client)
+    with _lock:
+        CLIENTS[(service_name, region_name, role_arn, None)] = client
+        INJECTED.add((service_name, region_name, role_arn))
+
+
+def reset_clients():
+    """Drop every registered client and the shared session."""
+
+    global _session
+
+    with _lock:
+        CLIENTS.clear()
+        ROLE_SESSIONS.clear()
+        INJECTED.clear()
+        _session = None
@@ -0,0 +1,214 @@
+"""Module to trace every AWS API call made through the shared boto3 clients"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from urllib.parse import urlencode
+
+from metrics import current_invocation
+
+# Tracing is opt-in, clients created while it is off carry no handlers
+AWS_TRACE = os.environ.get("AWS_TRACE", "false").lower() == "true"
+# JSON lines file every span of an invocation is appended to, unset keeps them in memory
+AWS_TRACE_FILE = os.environ.get("AWS_TRACE_FILE", "")
+
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "LimitExceededException",
+    "SlowDown",
+}
+
+
+@dataclass
+class Span:
+    """One AWS API call, with every attempt botocore made for it"""
+
+    service: str
+    operation: str
+    region: str
+    start_time: float
+    invocation_id: str = None
+    secret_id: str = None
+    step: str = None
+    duration_ms: float = 0.0
+    attempts: int = 0
+    throttles: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    status_code: int = None
+    error: str = None
+    start: float = field(default=0.0, repr=False)
+
+    def to_dict(self):
+        """Span as exported, without the monotonic start time."""
+
+        span = asdict(self)
+        del span["start"]
+        return span
+
+
+def body_size(body):
+    """Size in bytes of a botocore request body, a dict for query protocol services."""
+
+    if not body:
+        return 0
+    if isinstance(body, dict):
+        return len(urlencode(body, doseq=True))
+    if isinstance(body, str):
+        return len(body.encode())
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    # Streaming bodies are not read to be measured
+    return 0
+
+
+class AwsTracer:
+    """Records a span per AWS API call from botocore events"""
+
+    def __init__(self, enabled=None, trace_file=None):
+        self.enabled = AWS_TRACE if enabled is None else enabled
+        self.trace_file = AWS_TRACE_FILE if trace_file is None else trace_file
+        self.invocation_id = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def register(self, events):
+        """Attach the tracer to the events of a client, once."""
+
+        events.register("before-call", self._before_call, unique_id="aws-tracer-before-call")
+        events.register(
+            "response-received", self._response_received, unique_id="aws-tracer-response"
+        )
+        events.register("after-call", self._after_call, unique_id="aws-tracer-after-call")
+        events.register(
+            "after-call-error", self._after_call_error, unique_id="aws-tracer-after-call-error"
+        )
+
+    @contextmanager
+    def invocation(self):
+        """Collect the spans of one invocation, then print their summary and export them."""
+
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            self.invocation_id = str(uuid.uuid4())
+            self.spans = []
+        try:
+            yield
+        finally:
+            for line in self.report():
+                print(line)
+            if self.trace_file:
+                self.export(self.trace_file)
+
+    def summary(self):
+        """Calls, attempts, throttles, latency and bytes per operation."""
+
+        summary = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            operation = summary.setdefault(
+                f"{span.service}.{span.operation}",
+                {
+                    "calls": 0,
+                    "attempts": 0,
+                    "throttles": 0,
+                    "errors": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "request_bytes": 0,
+                    "response_bytes": 0,
+                },
+            )
+            operation["calls"] += 1
+            operation["attempts"] += span.attempts
+            operation["throttles"] += span.throttles
+            operation["errors"] += int(span.error is not None)
+            operation["total_ms"] += span.duration_ms
+            operation["max_ms"] = max(operation["max_ms"], span.duration_ms)
+            operation["request_bytes"] += span.request_bytes
+            operation["response_bytes"] += span.response_bytes
+        return summary
+
+    def report(self):
+        """Lines describing the summary, slowest operation first."""
+
+        summary = sorted(self.summary().items(), key=lambda item: -item[1]["total_ms"])
+        lines = [f"AWS calls of invocation {self.invocation_id}:"]
+        for name, operation in summary:
+            lines.append(
+                f"{name}: {operation['calls']} calls, {operation['attempts']} attempts, "
+                f"{operation['throttles']} throttled, {operation['errors']} failed, "
+                f"{operation['total_ms']:.1f} ms total, {operation['max_ms']:.1f} ms max, "
+                f"{operation['request_bytes']} B sent, {operation['response_bytes']} B received"
+            )
+        return lines
+
+    def export(self, path):
+        """Append the spans to a JSON lines file."""
+
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+        with open(path, "a", encoding="utf-8") as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps(span) + "\n")
+
+    def _before_call(self, model, params, context, **kwargs):
+        invocation = current_invocation()
+        context["aws_tracer_span"] = Span(
+            service=model.service_model.service_name,
+            operation=model.name,
+            region=context.get("client_region"),
+            start_time=time.time(),
+            invocation_id=self.invocation_id,
+            secret_id=invocation.get("SecretId"),
+            step=invocation.get("Step"),
+            request_bytes=body_size(params.get("body")),
+            start=time.perf_counter(),
+        )
+
+    def _response_received(self, context, response_dict, parsed_response, **kwargs):
+        # Sent once per attempt, retries included
+        span = context.get("aws_tracer_span")
+        if span is None:
+            return
+        span.attempts += 1
+        if response_dict is not None:
+            span.response_bytes += len(response_dict.get("body") or b"")
+        error_code = (parsed_response or {}).get("Error", {}).get("Code")
+        if error_code in THROTTLING_ERROR_CODES:
+            span.throttles += 1
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        error = None
+        if http_response.status_code >= 400:
+            error = parsed.get("Error", {}).get("Code") or f"HTTP {http_response.status_code}"
+        self._finish(context, status_code=http_response.status_code, error=error)
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self._finish(context, error=type(exception).__name__)
+
+    def _finish(self, context, status_code=None, error=None):
+        span = context.pop("aws_tracer_span", None)
+        if span is None:
+            return
+        span.duration_ms = (time.perf_counter() - span.start) * 1000
+        span.status_code = status_code
+        span.error = error
+        with self.lock:
+            self.spans.append(span)
+
+
+TRACER = AwsTracer()
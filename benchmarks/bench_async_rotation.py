@@ -0,0 +1,105 @@
+""" Benchmark rolling many Cloudflare rules on the thread pool against the asyncio engine. """
+
+import argparse
+import sys
+import time
+
+sys.path.append('.')
+
+import async_rotation
+import cloudflare_helper
+from async_rotation import AsyncCloudflareHelper, close_aiohttp_session
+from cloudflare_helper import CloudflareHelper, reset_http_session
+from cloudflare_standin import CloudflareStandin
+from metrics import METRICS, MemorySink
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+
+def timed(call, rounds):
+    """Run call repeatedly and return the best wall time in milliseconds."""
+
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = call()
+        elapsed = (time.perf_counter() - start) * 1000
+        if not all(result.success for result in results):
+            raise RuntimeError(next(result.error for result in results if not result.success))
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def set_concurrency(thread_concurrency, asyncio_concurrency):
+    """Set the requests in flight of both engines, with connection pools to match."""
+
+    cloudflare_helper.CF_POOL_SIZE = thread_concurrency
+    cloudflare_helper.CF_MAX_CONCURRENCY = thread_concurrency
+    reset_http_session()
+    async_rotation.ASYNC_MAX_CONCURRENCY = asyncio_concurrency
+    async_rotation.run(close_aiohttp_session())
+
+
+def main():
+    """Run the benchmark against the local stand-in."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rules', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='stand-in latency in seconds')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=100,
+        help='requests in flight of both engines for the like for like comparison',
+    )
+    args = parser.parse_args()
+    # Keep the metric records out of the report
+    METRICS.sink = MemorySink()
+
+    targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(args.rules)]
+    # The defaults differ, CF_MAX_CONCURRENCY is 10 and ASYNC_MAX_CONCURRENCY is 100, so the
+    # engines are also compared at the same concurrency to tell the engine from the setting
+    settings = [
+        ('defaults', cloudflare_helper.CF_MAX_CONCURRENCY, async_rotation.ASYNC_MAX_CONCURRENCY),
+        ('same', args.concurrency, args.concurrency),
+    ]
+
+    with CloudflareStandin(latency=args.latency) as standin:
+        for target in targets:
+            standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+        # Measure the engines, not the client side rate limit
+        options = dict(
+            base_url=standin.base_url,
+            targets=targets,
+            rate_limiter=TokenBucket(rate=1e6, burst=1e6),
+        )
+        threads = CloudflareHelper(**options)
+        threads.get_api_key = lambda: 'key'
+        asyncio_engine = AsyncCloudflareHelper(**options)
+        asyncio_engine.helper.get_api_key = lambda: 'key'
+
+        rows = []
+        for label, thread_concurrency, asyncio_concurrency in settings:
+            set_concurrency(thread_concurrency, asyncio_concurrency)
+            thread_ms = timed(lambda: threads.roll_token('token'), args.rounds)
+            asyncio_ms = timed(lambda: asyncio_engine.roll_token('token'), args.rounds)
+            rows.append((label, thread_concurrency, thread_ms, asyncio_concurrency, asyncio_ms))
+
+    print(f'{args.rules} rules, {args.latency * 1000:.0f} ms per request, no rate limit')
+    print(f'{"concurrency":<12} {"thread pool":>18} {"asyncio":>18}')
+    for label, thread_concurrency, thread_ms, asyncio_concurrency, asyncio_ms in rows:
+        print(
+            f'{label:<12} {thread_ms:9.1f} ms ({thread_concurrency:>3})'
+            f' {asyncio_ms:9.1f} ms ({asyncio_concurrency:>3})  {thread_ms / asyncio_ms:.1f}x'
+        )
+    # Both engines take from the same token bucket, at the default rate it sets the pace
+    paced = max(args.rules - cloudflare_helper.CF_RATE_LIMIT_BURST, 0)
+    print(
+        f'at CF_RATE_LIMIT={cloudflare_helper.CF_RATE_LIMIT:g} requests per second both engines '
+        f'take at least {paced / cloudflare_helper.CF_RATE_LIMIT:.1f} s'
+    )
+
+
+if __name__ == '__main__':
+    main()
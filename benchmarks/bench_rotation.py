@@ -0,0 +1,208 @@
+""" Benchmark the rotation steps end to end against moto and the Cloudflare stand-in. """
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from moto import mock_ec2, mock_elbv2, mock_secretsmanager
+
+sys.path.append('.')
+
+import aws_clients
+import cloudflare_helper
+import lambda_function
+import loadbalancer_helper
+from cloudflare_standin import CloudflareStandin
+from fixtures import SECRET_ID, STEPS, create_listener_rules, create_secrets
+from metrics import METRICS, MemorySink
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+# Slowdown of a step reported as a regression by --compare, besides any extra API call
+REGRESSION_THRESHOLD = 0.2
+REGRESSION_MIN_MS = 1.0
+
+
+class CallCounter:
+    """Counts the AWS API calls made by every client of the shared session"""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    def __call__(self, model, **kwargs):
+        self.calls[f'{model.service_model.service_name}.{model.name}'] += 1
+
+    def take(self):
+        """Return the calls counted since the last take."""
+
+        calls, self.calls = dict(self.calls), Counter()
+        return calls
+
+
+def git_commit():
+    """Commit the benchmark runs on, None outside a git checkout."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def rotate(standin, counter, measure_memory=False):
+    """Run the four steps once, returning the measurements of each."""
+
+    token = str(uuid.uuid4())
+    results = {}
+    for step in STEPS:
+        standin.requests.clear()
+        counter.take()
+        if measure_memory:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        lambda_function.lambda_handler(
+            {'SecretId': SECRET_ID, 'ClientRequestToken': token, 'Step': step}, None
+        )
+        elapsed = time.perf_counter() - start
+        results[step] = {
+            'seconds': elapsed,
+            'aws_calls': counter.take(),
+            'cloudflare_calls': dict(Counter(method for method, _ in standin.requests)),
+        }
+        if measure_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            results[step]['peak_memory_kib'] = round((peak - before) / 1024, 1)
+    return results
+
+
+def summarise(rounds, memory):
+    """Aggregate the rounds of every step."""
+
+    summary = {}
+    for step in STEPS:
+        seconds = [result[step]['seconds'] * 1000 for result in rounds]
+        summary[step] = {
+            'mean_ms': round(statistics.mean(seconds), 3),
+            'min_ms': round(min(seconds), 3),
+            'max_ms': round(max(seconds), 3),
+            'aws_calls': rounds[-1][step]['aws_calls'],
+            'cloudflare_calls': rounds[-1][step]['cloudflare_calls'],
+            'peak_memory_kib': memory[step]['peak_memory_kib'],
+        }
+    return summary
+
+
+def compare(summary, baseline, threshold=REGRESSION_THRESHOLD):
+    """Return the regressions of summary against a baseline summary."""
+
+    regressions = []
+    for step, result in summary.items():
+        before = baseline.get(step)
+        if before is None:
+            continue
+        slowdown = result['min_ms'] - before['min_ms']
+        if slowdown > max(before['min_ms'] * threshold, REGRESSION_MIN_MS):
+            regressions.append(
+                f'{step} took {result["min_ms"]:.1f} ms, was {before["min_ms"]:.1f} ms'
+            )
+        calls = sum(result['aws_calls'].values()) + sum(result['cloudflare_calls'].values())
+        calls_before = sum(before['aws_calls'].values()) + sum(before['cloudflare_calls'].values())
+        if calls > calls_before:
+            regressions.append(f'{step} made {calls} API calls, was {calls_before}')
+    return regressions
+
+
+def main():
+    """Run the benchmark and save the results as JSON."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--cf-latency', type=float, default=0.0, help='stand-in latency in seconds')
+    parser.add_argument('--cf-rules', type=int, default=1)
+    parser.add_argument('--alb-rules', type=int, default=1)
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--output', default='bench_rotation.json', help='where to save the results')
+    parser.add_argument('--compare', help='results of an earlier run to report regressions against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+    # Keep the metric records out of the report
+    METRICS.sink = MemorySink()
+
+    mocks = [mock_secretsmanager(), mock_elbv2(), mock_ec2()]
+    for mock in mocks:
+        mock.start()
+    # Clients copy the session's handlers when they are created, so register before any exist
+    counter = CallCounter()
+    aws_clients.reset_clients()
+    aws_clients.get_session().events.register('before-call', counter)
+
+    create_secrets()
+    alb_targets = create_listener_rules(args.alb_rules)
+    cf_targets = [
+        CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(args.cf_rules)
+    ]
+
+    with CloudflareStandin() as standin:
+        cloudflare_helper.CF_API_BASE_URL = standin.base_url
+        cloudflare_helper.CF_TARGETS = cf_targets
+        # Measure the rotation, not the client side rate limit
+        cloudflare_helper.RATE_LIMITER = TokenBucket(rate=1e6, burst=1e6)
+        loadbalancer_helper.ALB_TARGETS = alb_targets
+        lambda_function.ROTATION_ENGINE = args.engine
+        for target in cf_targets:
+            standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id, token='old_token')
+        standin.latency = args.cf_latency
+
+        # The first round pays for client construction and connections, like a cold start
+        cold = rotate(standin, counter)
+        rounds = [rotate(standin, counter) for _ in range(args.rounds)]
+        tracemalloc.start()
+        memory = rotate(standin, counter, measure_memory=True)
+        tracemalloc.stop()
+
+    for mock in reversed(mocks):
+        mock.stop()
+
+    summary = summarise(rounds, memory)
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'options': vars(args),
+        'cold_ms': {step: round(cold[step]['seconds'] * 1000, 3) for step in STEPS},
+        'steps': summary,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+
+    print(
+        f'{"step":<14}{"mean ms":>10}{"min ms":>10}{"cold ms":>10}'
+        f'{"AWS calls":>11}{"CF calls":>10}{"peak KiB":>10}'
+    )
+    for step, result in summary.items():
+        print(
+            f'{step:<14}{result["mean_ms"]:>10.2f}{result["min_ms"]:>10.2f}'
+            f'{results["cold_ms"][step]:>10.2f}{sum(result["aws_calls"].values()):>11}'
+            f'{sum(result["cloudflare_calls"].values()):>10}{result["peak_memory_kib"]:>10.1f}'
+        )
+    print(f'Saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(summary, json.load(baseline)['steps'], args.threshold)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+""" Load test traffic through the edge and listener stand-ins while lambda_handler rotates the token. """
+
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+import requests
+from moto import mock_ec2, mock_elbv2, mock_secretsmanager
+
+sys.path.append('.')
+
+import cloudflare_helper
+import lambda_function
+import loadbalancer_helper
+import propagation
+import secret_probe
+from alb_standin import ListenerStandin
+from cloudflare_standin import CloudflareStandin, EdgeStandin
+from fixtures import SECRET_ID, STEPS, create_listener_rules, create_secrets
+from metrics import METRICS, MemorySink
+from propagation import PropagationVerifier
+from rate_limiter import TokenBucket
+from rotation_state import SetSecretStateMachine
+from targets import CloudflareTarget
+
+
+class Timeline:
+    """Start times of the rotation phases"""
+
+    def __init__(self):
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.monotonic()))
+
+    def windows(self, end):
+        """(name, start, end) of every phase."""
+
+        ends = [start for _, start in self.marks[1:]] + [end]
+        return [(name, start, stop) for (name, start), stop in zip(self.marks, ends)]
+
+
+def poll_rule_values(target, values, stop, interval):
+    """Keep values holding the token values the moto listener rule accepts."""
+
+    helper = loadbalancer_helper.LoadbalancerHelper(targets=[target])
+    while not stop.is_set():
+        values[:] = helper.get_token_values()[target.rule_arn] or []
+        stop.wait(interval)
+
+
+def send_load(url, samples, stop):
+    """Send requests back to back, recording (time, accepted, latency in ms)."""
+
+    with requests.Session() as session:
+        while not stop.is_set():
+            start = time.monotonic()
+            try:
+                accepted = session.get(url, timeout=10).status_code == 200
+            except requests.RequestException:
+                accepted = False
+            samples.append((start, accepted, (time.monotonic() - start) * 1000))
+
+
+def summarise(timeline, samples, end):
+    """Requests, rejections, throughput and latency percentiles per phase."""
+
+    rows = []
+    for name, start, stop in timeline.windows(end):
+        window = [sample for sample in samples if start <= sample[0] < stop]
+        latencies = sorted(latency for _, _, latency in window)
+        duration = max(stop - start, 1e-9)
+        rows.append(
+            {
+                'phase': name,
+                'seconds': round(duration, 3),
+                'requests': len(window),
+                'rejected': sum(not accepted for _, accepted, _ in window),
+                'requests_per_second': round(len(window) / duration, 1),
+                'p50_ms': round(statistics.median(latencies), 2) if latencies else None,
+                'p99_ms': round(latencies[int(len(latencies) * 0.99)], 2) if latencies else None,
+            }
+        )
+    return rows
+
+
+def instrument(timeline, verify):
+    """Mark the setSecret phases on the timeline."""
+
+    for phase in ('alb_dual', 'cloudflare', 'alb_single'):
+        original = getattr(SetSecretStateMachine, phase)
+
+        def wrapper(self, targets, phase=phase, original=original):
+            name = 'propagation wait' if phase == 'alb_single' and verify else phase
+            timeline.mark(f'setSecret {name}')
+            return original(self, targets)
+
+        setattr(SetSecretStateMachine, phase, wrapper)
+
+    if not verify:
+        return
+    wait_for = PropagationVerifier.wait_for
+
+    def wait_for_wrapper(self, value):
+        elapsed = wait_for(self, value)
+        timeline.mark('setSecret alb_single')
+        return elapsed
+
+    PropagationVerifier.wait_for = wait_for_wrapper
+
+
+def main():
+    """Run the load test."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=8, help='concurrent load generators')
+    parser.add_argument('--propagation-delay', type=float, default=0.5, help='edge lag in seconds')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds of load before and after')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument(
+        '--no-verify',
+        action='store_true',
+        help='drop the old token without waiting for the edge, to show the rejections it causes',
+    )
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    # Keep the metric records out of the report
+    METRICS.sink = MemorySink()
+
+    mocks = [mock_secretsmanager(), mock_elbv2(), mock_ec2()]
+    for mock in mocks:
+        mock.start()
+
+    create_secrets()
+    alb_target = create_listener_rules()[0]
+    cf_target = CloudflareTarget('zone', 'ruleset', 'rule')
+
+    stop = threading.Event()
+    values = []
+    with CloudflareStandin() as standin, ListenerStandin(accepted=lambda: values) as listener:
+        edge = EdgeStandin(
+            standin, cf_target, propagation_delay=args.propagation_delay, upstream=listener.address
+        ).start()
+
+        cloudflare_helper.CF_API_BASE_URL = standin.base_url
+        cloudflare_helper.CF_TARGETS = [cf_target]
+        cloudflare_helper.RATE_LIMITER = TokenBucket(rate=100, burst=100)
+        loadbalancer_helper.ALB_TARGETS = [alb_target]
+        lambda_function.ROTATION_ENGINE = args.engine
+        secret_probe.PROBE_URLS = [listener.address]
+        propagation.CF_PROPAGATION_PROBE_URLS = (
+            [] if args.no_verify else [edge.address + EdgeStandin.ECHO_PATH]
+        )
+        standin.add_rule(cf_target.zone_id, cf_target.ruleset_id, cf_target.rule_id, 'old_token')
+
+        timeline = Timeline()
+        instrument(timeline, not args.no_verify)
+        # The load balancer picks up rule changes within tens of milliseconds
+        poller = threading.Thread(target=poll_rule_values, args=(alb_target, values, stop, 0.02))
+        poller.start()
+        # Start once the old token is live at the edge and the listener
+        while not values or edge.edge_value() != 'old_token':
+            time.sleep(0.01)
+
+        samples = []
+        workers = [
+            threading.Thread(target=send_load, args=(edge.address + '/app', samples, stop))
+            for _ in range(args.workers)
+        ]
+        timeline.mark('before rotation')
+        for worker in workers:
+            worker.start()
+        time.sleep(args.settle)
+
+        token = str(uuid.uuid4())
+        for step in STEPS:
+            # setSecret is split into its phases, its first row only covers the planning reads
+            timeline.mark('setSecret planning' if step == 'setSecret' else step)
+            lambda_function.lambda_handler(
+                {'SecretId': SECRET_ID, 'ClientRequestToken': token, 'Step': step}, None
+            )
+        timeline.mark('after rotation')
+        time.sleep(args.settle)
+
+        stop.set()
+        end = time.monotonic()
+        for worker in workers + [poller]:
+            worker.join()
+        edge.stop()
+
+    for mock in reversed(mocks):
+        mock.stop()
+
+    rows = summarise(timeline, samples, end)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(f'{"phase":<30}{"seconds":>9}{"requests":>10}{"rejected":>10}{"req/s":>9}{"p50 ms":>9}{"p99 ms":>9}')
+        for row in rows:
+            print(
+                f'{row["phase"]:<30}{row["seconds"]:>9.3f}{row["requests"]:>10}{row["rejected"]:>10}'
+                f'{row["requests_per_second"]:>9.1f}{row["p50_ms"] or 0:>9.2f}{row["p99_ms"] or 0:>9.2f}'
+            )
+    rejected = sum(row['rejected'] for row in rows)
+    print(f'{rejected} of {len(samples)} requests rejected', file=sys.stderr)
+    return 1 if rejected else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
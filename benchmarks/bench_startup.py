@@ -0,0 +1,175 @@
+""" Benchmark the cold start: importing lambda_function and the first invocation of every step. """
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.append('.')
+
+# Modules only the steps that need them should import
+LAZY_MODULES = (
+    'requests',
+    'aiohttp',
+    'alb_discovery',
+    'async_rotation',
+    'cloudflare_discovery',
+    'cloudflare_helper',
+    'loadbalancer_helper',
+    'propagation',
+    'rotation_state',
+    'secret_probe',
+)
+TOKEN = 'c9a7e4f0-3e46-4b7c-9d5b-000000000001'
+
+
+def child_import():
+    """Import lambda_function in this fresh interpreter and report what it cost."""
+
+    start = time.perf_counter()
+    import lambda_function  # noqa: F401
+
+    elapsed = time.perf_counter() - start
+    return {
+        'import_ms': elapsed * 1000,
+        'modules': len(sys.modules),
+        'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+    }
+
+
+def child_step(step, engine):
+    """Run the first invocation of a step in a fresh interpreter against moto and the stand-in."""
+
+    from moto import mock_ec2, mock_elbv2, mock_secretsmanager
+
+    for mock in (mock_secretsmanager(), mock_elbv2(), mock_ec2()):
+        mock.start()
+
+    from cloudflare_standin import CloudflareStandin
+    from fixtures import REGION, SECRET_ID, create_listener_rules, create_secrets
+
+    create_secrets()
+    alb_targets = create_listener_rules()
+    standin = CloudflareStandin().start()
+    standin.add_rule('zone', 'ruleset', 'rule', token='old_token')
+    # Configure through the environment, importing the helpers here would warm them up
+    os.environ.update(
+        {
+            'CF_API_BASE_URL': standin.base_url,
+            'CF_TARGETS': json.dumps(
+                [{'zone_id': 'zone', 'ruleset_id': 'ruleset', 'rule_id': 'rule'}]
+            ),
+            'ALB_TARGETS': json.dumps(
+                [
+                    {'rule_arn': target.rule_arn, 'conditions': target.conditions}
+                    for target in alb_targets
+                ]
+            ),
+            'ROTATION_ENGINE': engine,
+            'METRICS_ENABLED': 'false',
+        }
+    )
+    if step != 'createSecret':
+        import boto3
+
+        boto3.client('secretsmanager', region_name=REGION).put_secret_value(
+            SecretId=SECRET_ID,
+            ClientRequestToken=TOKEN,
+            SecretString='new_token',
+            VersionStages=['AWSPENDING'],
+        )
+
+    start = time.perf_counter()
+    import lambda_function
+
+    import_elapsed = time.perf_counter() - start
+    before = set(sys.modules)
+    start = time.perf_counter()
+    lambda_function.lambda_handler(
+        {'SecretId': SECRET_ID, 'ClientRequestToken': TOKEN, 'Step': step}, None
+    )
+    elapsed = time.perf_counter() - start
+    standin.stop()
+    imported = set(sys.modules) - before
+    return {
+        'import_ms': import_elapsed * 1000,
+        'invocation_ms': elapsed * 1000,
+        'modules_imported': len(imported),
+        'lazy_modules_imported': [name for name in LAZY_MODULES if name in imported],
+    }
+
+
+def run_child(*args):
+    """Run this script in a fresh interpreter, returning the JSON it reports."""
+
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """Run the benchmark."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads')
+    parser.add_argument('--max-import-ms', type=float, help='fail when importing takes longer')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        kind, *rest = args.child
+        result = child_import() if kind == 'import' else child_step(kind, *rest)
+        print(json.dumps(result))
+        return 0
+
+    imports = [run_child('import') for _ in range(args.runs)]
+    import_ms = statistics.median(result['import_ms'] for result in imports)
+    minimum_ms = min(result['import_ms'] for result in imports)
+    loaded = imports[-1]['lazy_modules_loaded']
+    print(f'import lambda_function  median {import_ms:8.1f} ms  min {minimum_ms:8.1f} ms')
+    print(f'  {imports[-1]["modules"]} modules loaded, lazy modules loaded: {loaded or "none"}')
+
+    # moto already imports boto3 and requests, so these show the step's own imports and calls
+    steps = {}
+    print(f'{"first invocation":<18}{"median ms":>10}{"min ms":>10}  lazily imported')
+    for step in ('createSecret', 'setSecret', 'testSecret', 'finishSecret'):
+        runs = [run_child(step, args.engine) for _ in range(args.runs)]
+        steps[step] = {
+            'median_ms': statistics.median(run['invocation_ms'] for run in runs),
+            'min_ms': min(run['invocation_ms'] for run in runs),
+            'lazy_modules_imported': runs[-1]['lazy_modules_imported'],
+        }
+        print(
+            f'{step:<18}{steps[step]["median_ms"]:>10.1f}{steps[step]["min_ms"]:>10.1f}'
+            f'  {", ".join(steps[step]["lazy_modules_imported"]) or "-"}'
+        )
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            results = {'import_ms': import_ms, 'imports': imports[-1], 'steps': steps}
+            json.dump(results, output, indent=2)
+
+    failed = False
+    if loaded:
+        print(f'Imported at module load: {loaded}', file=sys.stderr)
+        failed = True
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print(
+            f'Import took {import_ms:.1f} ms, more than {args.max_import_ms:.1f} ms',
+            file=sys.stderr,
+        )
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
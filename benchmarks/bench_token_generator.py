@@ -0,0 +1,64 @@
+""" Benchmark the local CSPRNG token generator against the GetRandomPassword backend. """
+
+import argparse
+import statistics
+import sys
+import time
+
+import boto3
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+from random_token_generator import RandomTokenGenerator
+
+
+def timed(call, iterations):
+    """Run call repeatedly and return the latencies in milliseconds."""
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name, latencies):
+    """Print a one line summary of the latencies."""
+
+    print(
+        f'{name:<28} mean {statistics.mean(latencies):8.3f} ms'
+        f'  p50 {statistics.median(latencies):8.3f} ms  max {max(latencies):8.3f} ms'
+    )
+
+
+def main():
+    """Run the benchmark."""
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument(
+        '--aws',
+        action='store_true',
+        help='also call the real GetRandomPassword API with the default credentials',
+    )
+    args = parser.parse_args()
+
+    local = RandomTokenGenerator(backend='local')
+    report('local', timed(local.generate_random_token, args.iterations))
+
+    # moto runs in process, so this is the cost of the botocore call path without the network
+    with mock_secretsmanager():
+        client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        remote = RandomTokenGenerator(backend='secretsmanager', client=client)
+        report('secretsmanager (moto)', timed(remote.generate_random_token, args.iterations))
+
+    if args.aws:
+        client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        remote = RandomTokenGenerator(backend='secretsmanager', client=client)
+        report('secretsmanager (aws)', timed(remote.generate_random_token, args.iterations))
+
+
+if __name__ == '__main__':
+    main()
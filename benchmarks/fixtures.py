@@ -0,0 +1,42 @@
+""" moto and stand-in setup shared by the rotation benchmarks. """
+
+import sys
+
+sys.path.append('.')
+
+import alb_standin
+import aws_clients
+
+REGION = 'ap-southeast-2'
+SECRET_ID = 'cf-alb-token'
+API_KEY_SECRET_ID = 'cf-access-token-to-modify-transform-rules'
+STEPS = ('createSecret', 'setSecret', 'testSecret', 'finishSecret')
+
+
+class RotationEnabledClient:
+    """Secrets Manager client reporting rotation as enabled, moto only enables it by invoking a Lambda"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def describe_secret(self, **kwargs):
+        return dict(self.client.describe_secret(**kwargs), RotationEnabled=True)
+
+
+def create_secrets(token='old_token'):
+    """Create the rotated secret and the Cloudflare API key in moto, and inject the rotation client."""
+
+    client = aws_clients.get_session().client('secretsmanager', region_name=REGION)
+    client.create_secret(Name=API_KEY_SECRET_ID, SecretString='key')
+    client.create_secret(Name=SECRET_ID, SecretString=token)
+    aws_clients.set_client('secretsmanager', RotationEnabledClient(client), None)
+
+
+def create_listener_rules(count=1, token='old_token'):
+    """Create a moto load balancer with count listener rules accepting token."""
+
+    hosts = [f'app{index}.example.com' for index in range(count)]
+    return alb_standin.create_listener_rules(REGION, hosts, token)
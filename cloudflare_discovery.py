@@ -0,0 +1,185 @@
+"""Module to discover the Cloudflare transform rules setting the token header and keep an index of them"""
+
+import os
+import threading
+import time
+
+from json_file import load_json, save_json
+from targets import CloudflareTarget, run_concurrently
+
+# Set to true to roll every discovered rule instead of CF_TARGETS
+CF_DISCOVERY = os.environ.get("CF_DISCOVERY", "false").lower() == "true"
+CF_DISCOVERY_TTL = float(os.environ.get("CF_DISCOVERY_TTL", "3600"))
+CF_DISCOVERY_INDEX = os.environ.get("CF_DISCOVERY_INDEX", "/tmp/cf-discovery-index.json")
+CF_DISCOVERY_CONCURRENCY = int(os.environ.get("CF_DISCOVERY_CONCURRENCY", "10"))
+
+# Transform rules modifying request headers live in the zone entrypoint ruleset of this phase
+TRANSFORM_PHASE = "http_request_late_transform"
+ZONES_PER_PAGE = 50
+
+# Version of the zone entries layout, see alb_discovery.INDEX_VERSION
+INDEX_VERSION = 1
+
+
+def list_zones(client, cf_api_key):
+    """Return the ID of every zone the API key can read, page by page."""
+
+    zones = []
+    page = 1
+    while True:
+        response = client.request(
+            "GET", f"/zones?page={page}&per_page={ZONES_PER_PAGE}", cf_api_key
+        ).json()
+        zones.extend(zone["id"] for zone in response["result"])
+        if page >= response.get("result_info", {}).get("total_pages", 1):
+            return zones
+        page += 1
+
+
+def ruleset_rules(ruleset):
+    """Rules of a ruleset setting headers, with the names of the headers."""
+
+    rules = []
+    for rule in ruleset.get("rules", []):
+        headers = rule.get("action_parameters", {}).get("headers", {})
+        names = [name for name, header in headers.items() if header.get("operation") == "set"]
+        if names:
+            rules.append({"rule_id": rule["id"], "headers": names})
+    return rules
+
+
+def fetch_ruleset(client, cf_api_key, zone_id, ruleset_id, cached):
+    """Download a ruleset unless the cached copy's ETag still matches, returning its index entry."""
+
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else {}
+    response = client.request(
+        "GET", f"/zones/{zone_id}/rulesets/{ruleset_id}", cf_api_key, headers=headers
+    )
+    if response.status_code == 304:
+        return cached
+    ruleset = response.json()["result"]
+    return {
+        "version": ruleset.get("version"),
+        "etag": response.headers.get("ETag"),
+        "rules": ruleset_rules(ruleset),
+    }
+
+
+def scan_zone(client, cf_api_key, zone_id, cached):
+    """Index the transform rulesets of a zone, downloading only those changed since cached."""
+
+    response = client.request("GET", f"/zones/{zone_id}/rulesets", cf_api_key).json()
+    entry = {}
+    for ruleset in response["result"]:
+        if ruleset.get("phase") != TRANSFORM_PHASE or ruleset.get("kind") != "zone":
+            continue
+        ruleset_id = ruleset["id"]
+        known = cached.get(ruleset_id)
+        # The listing carries each ruleset's version, an unchanged one is not downloaded again
+        version = ruleset.get("version")
+        if known and version is not None and known["version"] == version:
+            entry[ruleset_id] = known
+        else:
+            fetched = fetch_ruleset(client, cf_api_key, zone_id, ruleset_id, known)
+            # A 304 returns the cached entry, which the listed version brings up to date
+            entry[ruleset_id] = fetched if version is None else dict(fetched, version=version)
+    return entry
+
+
+class CloudflareDiscoveryIndex:
+    """Index of the transform rules of every zone by the headers they set, persisted to a file
+    and revalidated once older than the TTL"""
+
+    def __init__(self, enabled=None, path=None, ttl=None, clock=time.time):
+        self.enabled = CF_DISCOVERY if enabled is None else enabled
+        self.path = CF_DISCOVERY_INDEX if path is None else path
+        self.ttl = CF_DISCOVERY_TTL if ttl is None else ttl
+        self.clock = clock
+        # {"scanned_at", "zones": {zone ID: {ruleset ID: entry}}}, read from the file on first use
+        self.entries = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the persisted entries, a missing, unreadable or outdated file reads as empty."""
+
+        return load_json(self.path, INDEX_VERSION).get("index", {})
+
+    def save(self):
+        """Persist the entries, replacing the file in one step."""
+
+        save_json(self.path, {"index": self.entries}, INDEX_VERSION)
+
+    def refresh(self, client, force=False):
+        """Revalidate the index once older than the TTL, or now when forced, and persist it.
+
+        client is a CloudflareHelper, so the scan shares its retries and rate limiter. Zones
+        are scanned in parallel and only rulesets whose version changed are downloaded. A zone
+        that fails keeps its previous entry, a zone never scanned raises, and so does failing to
+        list the zones without an index to fall back on.
+        """
+
+        with self._lock:
+            if self.entries is None:
+                self.entries = self.load()
+            if (
+                not force
+                and self.entries
+                and self.clock() - self.entries["scanned_at"] < self.ttl
+            ):
+                return
+
+            scanned_at = self.clock()
+            cf_api_key = client.get_api_key()
+            previous = self.entries.get("zones", {})
+            try:
+                zone_ids = list_zones(client, cf_api_key)
+            except Exception as error:
+                if not previous:
+                    raise
+                print(f"Could not list the zones, keeping the index: {error}")
+                return
+            results = run_concurrently(
+                lambda zone_id: scan_zone(client, cf_api_key, zone_id, previous.get(zone_id, {})),
+                zone_ids,
+                CF_DISCOVERY_CONCURRENCY,
+            )
+
+            zones = {}
+            for result in results:
+                if result.success:
+                    zones[result.target] = result.response
+                elif result.target in previous:
+                    print(f"Could not rescan {result.target}, keeping its index: {result.error}")
+                    zones[result.target] = previous[result.target]
+                else:
+                    # A zone never indexed raises, as a region does in DiscoveryIndex.refresh
+                    raise result.error
+            self.entries = {"scanned_at": scanned_at, "zones": zones}
+            self.save()
+
+    def invalidate(self):
+        """Mark the index stale so the next lookup revalidates it, e.g. after a rule was deleted."""
+
+        with self._lock:
+            if self.entries:
+                self.entries["scanned_at"] = float("-inf")
+
+    def targets(self, client, header_name):
+        """Return a CloudflareTarget for every indexed rule setting the header."""
+
+        self.refresh(client)
+        targets = []
+        for zone_id, rulesets in self.entries["zones"].items():
+            for ruleset_id, ruleset in rulesets.items():
+                for rule in ruleset["rules"]:
+                    # Header names are not case sensitive, the target keeps the rule's spelling
+                    for name in rule["headers"]:
+                        if name.lower() == header_name.lower():
+                            targets.append(
+                                CloudflareTarget(zone_id, ruleset_id, rule["rule_id"], name)
+                            )
+        return targets
+
+
+# Kept for the life of the process, like alb_discovery.INDEX
+INDEX = CloudflareDiscoveryIndex()
@@ -1,59 +1,456 @@
 """Module is to make an API call to roll the cloudflare WAF token in the HTTP Request Header Modification rule"""
 
+import os
+import random
+import threading
+import time
+
 import requests
-import boto3
+from requests.adapters import HTTPAdapter
 from botocore.exceptions import ClientError
 
+from aws_clients import get_client
+from cloudflare_discovery import INDEX
+from deadline import Deadline
+from metrics import METRICS
+from rate_limiter import TokenBucket, parse_retry_after
+from targets import HEADER_NAME, CloudflareTarget, load_targets, run_concurrently
+
+CF_API_BASE_URL = os.environ.get(
+    "CF_API_BASE_URL", "https://api.cloudflare.com/client/v4"
+)
 CF_ZONE_ID = "72bab892f6318efaa9451b6fa18b9a26"
 CF_RULSET_ID = "c3032c1ce882457eabf5a92822ff910d"
 CF_RULE_ID = "fa091ae69f304775a1f5fee1e20b4a55"
+CF_HEADER_NAME = HEADER_NAME
+
+# Rules to roll, CF_TARGETS is a JSON list of {"zone_id", "ruleset_id", "rule_id"} objects
+CF_TARGETS = load_targets(
+    "CF_TARGETS", CloudflareTarget, [CloudflareTarget(CF_ZONE_ID, CF_RULSET_ID, CF_RULE_ID)]
+)
+
+# Connection pool and retry settings for the Cloudflare API
+CF_POOL_SIZE = int(os.environ.get("CF_POOL_SIZE", "10"))
+CF_MAX_RETRIES = int(os.environ.get("CF_MAX_RETRIES", "3"))
+CF_BACKOFF_BASE = 0.5
+CF_BACKOFF_MAX = 8.0
+CF_TIMEOUT = (3.05, 10)
+CF_MAX_CONCURRENCY = int(os.environ.get("CF_MAX_CONCURRENCY", str(CF_POOL_SIZE)))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+AUTH_STATUS_CODES = (401, 403)
+# Rule fields the API returns but does not take in an update
+RULE_READ_ONLY_FIELDS = ("id", "version", "last_updated")
+
+# How long the Cloudflare API key is cached, and how early it is refreshed in the background
+CF_API_KEY_TTL = float(os.environ.get("CF_API_KEY_TTL", "300"))
+CF_API_KEY_REFRESH_AHEAD = float(os.environ.get("CF_API_KEY_REFRESH_AHEAD", "60"))
+
+# Client side limit shared by every Cloudflare request, the API allows 1200 requests per 5 minutes
+CF_RATE_LIMIT = float(os.environ.get("CF_RATE_LIMIT", "4"))
+CF_RATE_LIMIT_BURST = int(os.environ.get("CF_RATE_LIMIT_BURST", "10"))
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+class CloudflareError(Exception):
+    """Base class for errors calling the Cloudflare API"""
+
+
+class CloudflareConnectionError(CloudflareError):
+    """The Cloudflare API could not be reached"""
+
+
+class CloudflareAPIError(CloudflareError):
+    """The Cloudflare API answered with an error status"""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        try:
+            self.errors = response.json().get("errors", [])
+        except ValueError:
+            self.errors = []
+        super().__init__(f"Cloudflare API returned {self.status_code}: {self.errors}")
+
+
+class CloudflareRateLimitError(CloudflareAPIError):
+    """The Cloudflare API kept rate limiting the request"""
+
+
+class CloudflareAuthError(CloudflareAPIError):
+    """The Cloudflare API rejected the API key"""
+
+
+class CloudflareRuleNotFoundError(CloudflareError):
+    """A discovered rule is no longer in its ruleset"""
+
+
+class ApiKeyCache:
+    """In-process cache of the Cloudflare API key with background refresh"""
+
+    def __init__(self, ttl=CF_API_KEY_TTL, refresh_ahead=CF_API_KEY_REFRESH_AHEAD):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.value = None
+        self.expires_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        # Serialises loads so concurrent misses fetch the key once
+        self.load_lock = threading.Lock()
+
+    def get(self, loader):
+        """Return the cached key, calling loader when it is missing or expired."""
+
+        now = time.monotonic()
+        with self.lock:
+            if self.value is not None and now < self.expires_at:
+                if now >= self.expires_at - self.refresh_ahead and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(
+                        target=self._refresh, args=(loader,), daemon=True
+                    ).start()
+                return self.value
+
+        with self.load_lock:
+            with self.lock:
+                if self.value is not None and time.monotonic() < self.expires_at:
+                    return self.value
+            value = loader()
+            self._store(value)
+            return value
+
+    def invalidate(self):
+        """Drop the cached key so the next call fetches it again."""
+
+        with self.lock:
+            self.value = None
+            self.expires_at = 0.0
+
+    def _store(self, value):
+        with self.lock:
+            self.value = value
+            self.expires_at = time.monotonic() + self.ttl
+
+    def _refresh(self, loader):
+        try:
+            with self.load_lock:
+                self._store(loader())
+        except Exception:
+            # Keep serving the cached key until it expires, the next get retries the load
+            pass
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+
+API_KEY_CACHE = ApiKeyCache()
+RATE_LIMITER = TokenBucket(CF_RATE_LIMIT, CF_RATE_LIMIT_BURST)
+
+
+def get_http_session():
+    """Return the pooled keep-alive session shared across warm invocations."""
+
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            # Retries are handled in CloudflareHelper.request so Retry-After is honoured
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=CF_POOL_SIZE, max_retries=0
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def reset_http_session():
+    """Close the pooled session, the next call opens a new one."""
+
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is not None:
+            _http_session.close()
+        _http_session = None
+
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before the next attempt, honouring a Retry-After header."""
+
+    seconds = parse_retry_after(retry_after)
+    if seconds is not None:
+        return seconds
+
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(CF_BACKOFF_MAX, CF_BACKOFF_BASE * 2**attempt))
+
+
+def attempt_delay(call, rate_limiter, attempt, response=None, error=None):
+    """Decide what follows an attempt of a Cloudflare request, for both engines.
+
+    Returns the seconds to back off before retrying, or None when the response is
+    final. Raises once the retries run out on a connection error or rate limiting.
+    """
+
+    last_attempt = attempt == CF_MAX_RETRIES
+    if error is not None:
+        if last_attempt:
+            raise CloudflareConnectionError(str(error) or type(error).__name__) from error
+        return retry_delay(attempt)
+
+    call.status = response.status_code
+    rate_limiter.update_from_headers(response.headers)
+    if response.status_code not in RETRY_STATUS_CODES:
+        return None
+    if last_attempt:
+        if response.status_code == 429:
+            raise CloudflareRateLimitError(response)
+        return None
+    return retry_delay(attempt, response.headers.get("Retry-After"))
+
+
+def checked_response(response):
+    """Return the final response of a request, raising when its status is an error."""
+
+    if response.status_code in AUTH_STATUS_CODES:
+        # The key was revoked or rolled, fetch it again on the next call
+        API_KEY_CACHE.invalidate()
+        raise CloudflareAuthError(response)
+    if not response.ok:
+        raise CloudflareAPIError(response)
+    return response
+
+
+def rule_path(target):
+    """API path of a transform rule."""
+
+    return f"/zones/{target.zone_id}/rulesets/{target.ruleset_id}/rules/{target.rule_id}"
+
+
+def rule_update(token, rule, header_name=CF_HEADER_NAME):
+    """Body of the request setting the token header in a transform rule as read from its ruleset.
+
+    The rule is written back with only the token value changed, so its expression,
+    description, enabled state and other headers are kept.
+    """
+
+    update = {key: value for key, value in rule.items() if key not in RULE_READ_ONLY_FIELDS}
+    action_parameters = dict(update.get("action_parameters", {}))
+    headers = dict(action_parameters.get("headers", {}))
+    headers[header_name] = dict(headers.get(header_name, {}), operation="set", value=token)
+    update["action_parameters"] = dict(action_parameters, headers=headers)
+    return update
+
+
+def target_update(token, target, rules):
+    """Body of the request rolling the token of a target, rules maps targets to their rules."""
+
+    if target not in rules:
+        raise CloudflareRuleNotFoundError(f"{target} is not in its ruleset")
+    return rule_update(token, rules[target], target.header_name)
+
+
+def ruleset_rules(zone_id, ruleset_id, ruleset):
+    """Map every rule of a ruleset to its target."""
+
+    return {CloudflareTarget(zone_id, ruleset_id, rule["id"]): rule for rule in ruleset["rules"]}
+
+
+def rules_by_target(results):
+    """Map every rule of get ruleset results keyed by (zone, ruleset) to its target."""
+
+    rules = {}
+    for result in results:
+        if not result.success:
+            raise result.error
+        rules.update(ruleset_rules(*result.target, result.response))
+    return rules
+
+
+def header_values(targets, rules):
+    """Map each target to the token header value of its rule, see rules_by_target for rules."""
+
+    values = {}
+    for target in targets:
+        headers = rules.get(target, {}).get("action_parameters", {}).get("headers", {})
+        values[target] = headers.get(target.header_name, {}).get("value")
+    return values
 
 
 class CloudflareHelper:
     """Cloudflare WAF token refresher class"""
 
+    def __init__(
+        self, base_url=None, session=None, targets=None, deadline=None, rate_limiter=None
+    ):
+        self.base_url = (base_url or CF_API_BASE_URL).rstrip("/")
+        self.session = session or get_http_session()
+        self.rate_limiter = rate_limiter or RATE_LIMITER
+        self.deadline = deadline or Deadline()
+        # With CF_DISCOVERY on the rules come from the discovery index, not CF_TARGETS
+        self.discovered = targets is None and INDEX.enabled
+        if targets is None:
+            targets = INDEX.targets(self, CF_HEADER_NAME) if self.discovered else CF_TARGETS
+        self.targets = targets
+
     # roll cloudflare token secret
-    def roll_token(self, token):
-        """Roll token method"""
+    def roll_token(self, token, targets=None, rules=None):
+        """Roll token method, returns a TargetResult per rule updated concurrently.
+
+        rules are the rules as returned by get_rules, None reads them first.
+        """
 
         # Get the cloudflare API key to access cloudflare
         cf_api_key = self.get_api_key()
+        targets = self.targets if targets is None else targets
 
-        # Modify Token for Http Request Header
-        try:
-            response = requests.patch(
-                f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/rulesets/{CF_RULSET_ID}/rules/{CF_RULE_ID}",
-                headers={
-                    "Authorization": f"Bearer {cf_api_key}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "action": "rewrite",
-                    "expression": '(http.host ne "1")',
-                    "description": "X-ALB-SECRET",
-                    "enabled": True,
-                    "action_parameters": {
-                        "headers": {
-                            "X-ALB-SECRET": {"operation": "set", "value": token}
-                        }
-                    },
-                },
-                timeout=10,
-            )
-            return response
-        except Exception as error:
-            return error
+        # The rules are written back with only the token changed
+        if rules is None:
+            rules = rules_by_target(self.get_rulesets(targets, cf_api_key))
+        results = run_concurrently(
+            lambda target: self.update_rule(token, target, cf_api_key, rules),
+            targets,
+            CF_MAX_CONCURRENCY,
+        )
+        for result in results:
+            self.check_discovered(result.error)
+        return results
+
+    # revalidate the index after a discovered rule disappeared
+    def check_discovered(self, error):
+        """Revalidate the discovery index on the next rotation when a discovered rule is gone."""
+
+        gone = isinstance(error, CloudflareRuleNotFoundError) or (
+            isinstance(error, CloudflareAPIError) and error.status_code == 404
+        )
+        if self.discovered and gone:
+            INDEX.invalidate()
+
+    # read the token currently set by the rules
+    def get_token_values(self, targets=None):
+        """Return the token header value set by each rule, None when the rule does not set it."""
+
+        targets = self.targets if targets is None else targets
+        return header_values(targets, self.get_rules(targets))
+
+    # read the rules of the targets
+    def get_rules(self, targets=None):
+        """Return every rule of the targets' rulesets by target, one request per ruleset."""
+
+        targets = self.targets if targets is None else targets
+        cf_api_key = self.get_api_key()
+        return rules_by_target(self.get_rulesets(targets, cf_api_key))
+
+    # read the rulesets of the rules
+    def get_rulesets(self, targets, cf_api_key):
+        """Return a TargetResult per (zone, ruleset) of the targets, read concurrently."""
+
+        # Rules in the same ruleset are read with a single request
+        rulesets = sorted({(target.zone_id, target.ruleset_id) for target in targets})
+        return run_concurrently(
+            lambda ruleset: self.get_ruleset(*ruleset, cf_api_key),
+            rulesets,
+            CF_MAX_CONCURRENCY,
+        )
+
+    # get a ruleset with its rules
+    def get_ruleset(self, zone_id, ruleset_id, cf_api_key):
+        """Return a zone ruleset including its rules."""
+
+        response = self.request("GET", f"/zones/{zone_id}/rulesets/{ruleset_id}", cf_api_key)
+        return response.json()["result"]
+
+    # modify token for http request header in a single rule
+    def update_rule(self, token, target, cf_api_key, rules=None):
+        """Update the token header value in one transform rule.
+
+        rules maps targets to their rules as read, None reads the target's ruleset first.
+        """
+
+        if rules is None:
+            ruleset = self.get_ruleset(target.zone_id, target.ruleset_id, cf_api_key)
+            rules = ruleset_rules(target.zone_id, target.ruleset_id, ruleset)
+        response = self.request(
+            "PATCH",
+            rule_path(target),
+            cf_api_key,
+            json=target_update(token, target, rules),
+        )
+        if not response.json().get("success"):
+            raise CloudflareAPIError(response)
+        return response
+
+    # call the cloudflare api, retrying rate limits and server errors
+    def request(self, method, path, cf_api_key, headers=None, **kwargs):
+        """Send a request to the Cloudflare API and return the successful response."""
+
+        headers = {
+            "Authorization": f"Bearer {cf_api_key}",
+            "Content-Type": "application/json",
+            **(headers or {}),
+        }
+        url = f"{self.base_url}{path}"
+
+        with METRICS.timed_call("cloudflare", method, path) as call:
+            call.queue_wait = 0.0
+            for attempt in range(CF_MAX_RETRIES + 1):
+                call.retries = attempt
+                call.queue_wait += self.throttle(method, path)
+                try:
+                    response = self.session.request(
+                        method,
+                        url,
+                        headers=headers,
+                        timeout=self.deadline.timeout(f"{method} {path}", CF_TIMEOUT),
+                        **kwargs,
+                    )
+                except requests.RequestException as error:
+                    delay = attempt_delay(call, self.rate_limiter, attempt, error=error)
+                else:
+                    delay = attempt_delay(call, self.rate_limiter, attempt, response)
+                    if delay is None:
+                        return checked_response(response)
+                self.backoff(method, path, delay)
+
+    # wait for the shared rate limiter before sending a request
+    def throttle(self, method, path):
+        """Take a rate limiter token and return the seconds waited for it.
+
+        Raises DeadlineExceeded if the wait would outlast the invocation.
+        """
+
+        delay = self.rate_limiter.reserve()
+        if delay > 0:
+            self.deadline.check(f"{method} {path}", needed=delay)
+            time.sleep(delay)
+        return delay
+
+    # wait before retrying unless the invocation would run out of time
+    def backoff(self, method, path, delay):
+        """Sleep delay seconds, raising DeadlineExceeded if no time is left to retry after it."""
+
+        self.deadline.check(f"retrying {method} {path}", needed=delay)
+        time.sleep(delay)
 
     # get cloudflare api key for access
     def get_api_key(self):
-        """Method to get the API Key."""
+        """Method to get the API Key, cached for CF_API_KEY_TTL seconds."""
+
+        return API_KEY_CACHE.get(self.fetch_api_key)
+
+    # read the cloudflare api key from secrets manager
+    def fetch_api_key(self):
+        """Method to fetch the API Key from the secret manager."""
 
         secret_name = "cf-access-token-to-modify-transform-rules"
         region_name = "ap-southeast-2"
 
-        # Create a Secrets Manager client
-        session = boto3.session.Session()
-        client = session.client(service_name="secretsmanager", region_name=region_name)
+        # Get the shared Secrets Manager client with timeouts fitting the time left
+        timeouts = self.deadline.client_timeouts("get_secret_value")
+        client = get_client("secretsmanager", region_name, timeouts=timeouts)
 
         try:
             get_secret_value_response = client.get_secret_value(SecretId=secret_name)
@@ -0,0 +1,470 @@
+"""Local stand-ins for the Cloudflare rulesets API and edge used by tests and benchmarks"""
+
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ZONES_PATH = re.compile(r"^/client/v4/zones$")
+RULESETS_PATH = re.compile(r"^/client/v4/zones/(?P<zone>[^/]+)/rulesets$")
+RULESET_PATH = re.compile(r"^/client/v4/zones/(?P<zone>[^/]+)/rulesets/(?P<ruleset>[^/]+)$")
+RULE_PATH = re.compile(
+    r"^/client/v4/zones/(?P<zone>[^/]+)/rulesets/(?P<ruleset>[^/]+)/rules/(?P<rule>[^/]+)$"
+)
+ZONES_PER_PAGE = 20
+ZONES_MAX_PER_PAGE = 50
+
+
+class StandinServer(ThreadingHTTPServer):
+    """Threaded server accepting the bursts of connections a concurrent client opens"""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class LocalServer:
+    """HTTP server on a free local port, served on a background thread by handler_class"""
+
+    def __init__(self, handler_class):
+        self.server = StandinServer(("127.0.0.1", 0), handler_class)
+        self.thread = None
+
+    @property
+    def address(self):
+        """http://host:port of the server."""
+
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve requests on a background thread."""
+
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Shut the server down."""
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class CloudflareStandin(LocalServer):
+    """In-process HTTP server imitating the Cloudflare zones and rulesets API.
+
+    It serves the zone list, a zone's rulesets, get and replace (PUT) of a ruleset and update
+    (PATCH) of a rule, storing the rules in memory. Unknown rulesets read as empty and patching
+    an unknown rule creates it. A ruleset is served with an ETag of its version, and a get
+    sending that ETag in If-None-Match is answered with a 304 until the ruleset changes.
+    Every request can be delayed by latency, fail with a 500 at error_rate, or be rejected
+    with a 429 and Retry-After once a Bearer token has sent rate_limit requests within
+    rate_limit_window seconds.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        error_rate=0.0,
+        rate_limit=None,
+        rate_limit_window=60.0,
+        api_keys=None,
+        seed=None,
+        clock=time.monotonic,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        # Bearer tokens accepted, None accepts any
+        self.api_keys = api_keys
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.zones = {}
+        self.rulesets = {}
+        self.rules = {}
+        # (time.monotonic(), rule) of every update per rule, for the edge stand-in
+        self.history = {}
+        self.requests = []
+        # Responses queued by tests as (status, headers), served to writes before the normal response
+        self.scripted = []
+        # (window start, requests) per Bearer token
+        self.windows = {}
+        self.lock = threading.Lock()
+        super().__init__(self._handler_class())
+
+    @property
+    def base_url(self):
+        """Base URL to point CloudflareHelper at."""
+
+        return f"{self.address}/client/v4"
+
+    def add_zone(self, zone_id, name=None):
+        """Add a zone, returning it."""
+
+        with self.lock:
+            return self._zone(zone_id, name)
+
+    def add_rule(self, zone_id, ruleset_id, rule_id, token=None, header_name="X-ALB-SECRET"):
+        """Add a transform rule setting the token header, returning it."""
+
+        rule = {
+            "id": rule_id,
+            "action": "rewrite",
+            "expression": "true",
+            "enabled": True,
+            "action_parameters": {"headers": {}},
+        }
+        if token is not None:
+            rule["action_parameters"]["headers"][header_name] = {"operation": "set", "value": token}
+        with self.lock:
+            self._store_rule((zone_id, ruleset_id, rule_id), rule)
+            self._touch(zone_id, ruleset_id)
+        return rule
+
+    def header_value(self, zone_id, ruleset_id, rule_id, header_name="X-ALB-SECRET", at=None):
+        """Return the header value set by a rule, now or at a time.monotonic() value."""
+
+        key = (zone_id, ruleset_id, rule_id)
+        with self.lock:
+            if at is None:
+                rule = self.rules.get(key)
+            else:
+                updates = [rule for updated, rule in self.history.get(key, []) if updated <= at]
+                rule = updates[-1] if updates else None
+        if rule is None:
+            return None
+        header = rule["action_parameters"]["headers"].get(header_name, {})
+        return header.get("value")
+
+    def _zone(self, zone_id, name=None):
+        zone = self.zones.get(zone_id)
+        if zone is None:
+            zone = {"id": zone_id, "name": name or f"{zone_id}.example.com", "status": "active"}
+            self.zones[zone_id] = zone
+        return zone
+
+    def _ruleset(self, zone_id, ruleset_id):
+        self._zone(zone_id)
+        key = (zone_id, ruleset_id)
+        ruleset = self.rulesets.get(key)
+        if ruleset is None:
+            ruleset = {
+                "id": ruleset_id,
+                "name": "default",
+                "kind": "zone",
+                "phase": "http_request_late_transform",
+                "version": "0",
+            }
+            self.rulesets[key] = ruleset
+        return ruleset
+
+    def _touch(self, zone_id, ruleset_id):
+        ruleset = self._ruleset(zone_id, ruleset_id)
+        ruleset["version"] = str(int(ruleset["version"]) + 1)
+        return ruleset
+
+    def _store_rule(self, key, rule):
+        self._ruleset(*key[:2])
+        self.rules[key] = rule
+        self.history.setdefault(key, []).append((time.monotonic(), rule))
+
+    def _ruleset_result(self, zone_id, ruleset_id):
+        ruleset = dict(self._ruleset(zone_id, ruleset_id))
+        ruleset["rules"] = [
+            rule
+            for (zone, ruleset_key, _), rule in self.rules.items()
+            if (zone, ruleset_key) == (zone_id, ruleset_id)
+        ]
+        return ruleset
+
+    def _rate_limit(self, token):
+        """Count a request of token, returning the rate limit headers and whether it is over the limit."""
+
+        if self.rate_limit is None:
+            return {}, False
+        now = self.clock()
+        start, count = self.windows.get(token, (now, 0))
+        if now - start >= self.rate_limit_window:
+            start, count = now, 0
+        count += 1
+        self.windows[token] = (start, count)
+        reset = max(math.ceil(start + self.rate_limit_window - now), 1)
+        headers = {
+            "Ratelimit": f'"default";r={max(self.rate_limit - count, 0)};t={reset}',
+            "Ratelimit-Policy": f'"default";q={self.rate_limit};w={self.rate_limit_window:g}',
+        }
+        if count > self.rate_limit:
+            headers["Retry-After"] = str(reset)
+            return headers, True
+        return headers, False
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Request handler bound to the stand-in state"""
+
+            # Keep connections open so clients can reuse them
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_PATCH(self):
+                self._handle()
+
+            def do_PUT(self):
+                self._handle()
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    body = None
+                write = self.command != "GET"
+                with standin.lock:
+                    standin.requests.append((self.command, self.path))
+                    scripted = standin.scripted.pop(0) if write and standin.scripted else None
+                if standin.latency:
+                    time.sleep(standin.latency)
+                if scripted is not None:
+                    status, headers = scripted
+                    self._error(status, status, headers)
+                    return
+
+                authorization = self.headers.get("Authorization", "")
+                token = authorization[len("Bearer "):]
+                if not authorization.startswith("Bearer ") or (
+                    standin.api_keys is not None and token not in standin.api_keys
+                ):
+                    self._error(401 if not token else 403, 10000)
+                    return
+                with standin.lock:
+                    headers, limited = standin._rate_limit(token)
+                    failed = standin.error_rate and standin.random.random() < standin.error_rate
+                if limited:
+                    self._error(429, 10013, headers)
+                    return
+                if failed:
+                    self._error(500, 10001, headers)
+                    return
+                if body is None:
+                    self._error(400, 10026, headers)
+                    return
+
+                url = urlsplit(self.path)
+                for pattern, method, route in (
+                    (ZONES_PATH, "GET", self._list_zones),
+                    (RULESETS_PATH, "GET", self._list_rulesets),
+                    (RULESET_PATH, "GET", self._get_ruleset),
+                    (RULESET_PATH, "PUT", self._put_ruleset),
+                    (RULE_PATH, "PATCH", self._patch_rule),
+                ):
+                    match = pattern.match(url.path)
+                    if match is not None and method == self.command:
+                        status, payload, *extra = route(match, parse_qs(url.query), body)
+                        self._send(status, payload, dict(headers, **(extra[0] if extra else {})))
+                        return
+                self._error(404, 7003, headers)
+
+            def _list_zones(self, match, query, body):
+                try:
+                    page = max(int(query.get("page", ["1"])[0]), 1)
+                    per_page = int(query.get("per_page", [str(ZONES_PER_PAGE)])[0])
+                except ValueError:
+                    return 400, self._payload(None, [{"code": 1001}])
+                per_page = min(max(per_page, 1), ZONES_MAX_PER_PAGE)
+                with standin.lock:
+                    zones = sorted(standin.zones.values(), key=lambda zone: zone["name"])
+                names = query.get("name")
+                if names:
+                    zones = [zone for zone in zones if zone["name"] == names[0]]
+                payload = self._payload(zones[(page - 1) * per_page:page * per_page])
+                payload["result_info"] = {
+                    "page": page,
+                    "per_page": per_page,
+                    "count": len(payload["result"]),
+                    "total_count": len(zones),
+                    "total_pages": math.ceil(len(zones) / per_page),
+                }
+                return 200, payload
+
+            def _list_rulesets(self, match, query, body):
+                with standin.lock:
+                    if match["zone"] not in standin.zones:
+                        return 404, self._payload(None, [{"code": 1001}])
+                    rulesets = [
+                        dict(ruleset)
+                        for (zone, _), ruleset in standin.rulesets.items()
+                        if zone == match["zone"]
+                    ]
+                return 200, self._payload(rulesets)
+
+            def _get_ruleset(self, match, query, body):
+                with standin.lock:
+                    ruleset = standin._ruleset_result(match["zone"], match["ruleset"])
+                etag = f'W/"{match["zone"]}/{match["ruleset"]}/{ruleset["version"]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return 304, None, {"ETag": etag}
+                return 200, self._payload(ruleset), {"ETag": etag}
+
+            def _put_ruleset(self, match, query, body):
+                rules = body.get("rules")
+                if not isinstance(rules, list):
+                    return 400, self._payload(None, [{"code": 10026}])
+                zone_id, ruleset_id = match["zone"], match["ruleset"]
+                with standin.lock:
+                    for key in [key for key in standin.rules if key[:2] == (zone_id, ruleset_id)]:
+                        del standin.rules[key]
+                    for rule in rules:
+                        rule = dict(rule, id=rule.get("id") or uuid.uuid4().hex)
+                        standin._store_rule((zone_id, ruleset_id, rule["id"]), rule)
+                    ruleset = standin._touch(zone_id, ruleset_id)
+                    for name in ("name", "description"):
+                        if name in body:
+                            ruleset[name] = body[name]
+                    return 200, self._payload(standin._ruleset_result(zone_id, ruleset_id))
+
+            def _patch_rule(self, match, query, body):
+                key = (match["zone"], match["ruleset"], match["rule"])
+                with standin.lock:
+                    rule = dict(body, id=match["rule"])
+                    standin._store_rule(key, rule)
+                    standin._touch(*key[:2])
+                    result = dict(standin._ruleset_result(*key[:2]), rules=[rule])
+                return 200, self._payload(result)
+
+            def _payload(self, result, errors=None):
+                return {
+                    "result": result,
+                    "success": not errors,
+                    "errors": errors or [],
+                    "messages": [],
+                }
+
+            def _error(self, status, code, headers=None):
+                self._send(status, self._payload(None, [{"code": code}]), headers)
+
+            def _send(self, status, payload, headers=None):
+                # A 304 carries no body
+                data = b"" if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+class EdgeStandin(LocalServer):
+    """Cloudflare edge stand-in adding the token header of the transform rule to requests.
+
+    The rule value reaches the edge propagation_delay seconds after it was updated in the
+    API stand-in, like a real edge deployment. Requests are forwarded to upstream when it is
+    set, otherwise, and always on ECHO_PATH, the edge answers with the headers it would send.
+    """
+
+    ECHO_PATH = "/echo"
+
+    def __init__(
+        self, standin, target, propagation_delay=0.0, header_name="X-ALB-SECRET", upstream=None
+    ):
+        self.standin = standin
+        self.target = target
+        self.propagation_delay = propagation_delay
+        self.header_name = header_name
+        self.upstream = upstream
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=64, max_retries=0)
+        self.session.mount("http://", adapter)
+        super().__init__(self._handler_class())
+
+    def stop(self):
+        super().stop()
+        self.session.close()
+
+    def edge_value(self):
+        """Header value the edge currently adds to requests."""
+
+        return self.standin.header_value(
+            self.target.zone_id,
+            self.target.ruleset_id,
+            self.target.rule_id,
+            self.header_name,
+            at=time.monotonic() - self.propagation_delay,
+        )
+
+    def _handler_class(self):
+        edge = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Forwarding and echo handler bound to the edge stand-in"""
+
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with edge.lock:
+                    edge.requests += 1
+                value = edge.edge_value()
+
+                if edge.upstream is None or self.path.split("?")[0] == edge.ECHO_PATH:
+                    headers = dict(self.headers)
+                    if value is not None:
+                        headers[edge.header_name] = value
+                    self._send(200, json.dumps({"headers": headers}).encode(), "application/json")
+                    return
+
+                try:
+                    response = edge.session.get(
+                        f"{edge.upstream}{self.path}",
+                        headers={} if value is None else {edge.header_name: value},
+                        timeout=10,
+                    )
+                except requests.RequestException:
+                    self._send(502, b"Bad Gateway", "text/plain")
+                    return
+                self._send(
+                    response.status_code,
+                    response.content,
+                    response.headers.get("Content-Type", "text/plain"),
+                )
+
+            def _send(self, status, data, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
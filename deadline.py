@@ -0,0 +1,91 @@
+"""Module to bound remote calls by the time left in the Lambda invocation"""
+
+import math
+import os
+import time
+
+# Time kept back to stop cleanly before the runtime kills the invocation
+DEADLINE_SAFETY_MARGIN_MS = int(os.environ.get("DEADLINE_SAFETY_MARGIN_MS", "1000"))
+
+# Most attempts of a botocore client, and the shortest connect and read timeouts worth retrying
+CLIENT_MAX_ATTEMPTS = 4
+CLIENT_MIN_TIMEOUT = 0.5
+# botocore's default connect and read timeouts
+BOTOCORE_DEFAULT_TIMEOUT = 60
+
+
+class DeadlineExceeded(Exception):
+    """Not enough time is left to finish, retrying the step resumes it from its checkpoint"""
+
+
+class Deadline:
+    """Time budget of an invocation, shrinking the timeouts of every remote call"""
+
+    def __init__(self, expires_at=None):
+        # time.monotonic() value the work must finish by, None when unbounded
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_context(cls, context, safety_margin_ms=DEADLINE_SAFETY_MARGIN_MS):
+        """Deadline of a Lambda invocation, unbounded when context is not a Lambda context."""
+
+        get_remaining_time = getattr(context, "get_remaining_time_in_millis", None)
+        if get_remaining_time is None:
+            return cls()
+        return cls(time.monotonic() + (get_remaining_time() - safety_margin_ms) / 1000)
+
+    @classmethod
+    def after(cls, seconds):
+        """Deadline a number of seconds from now."""
+
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self):
+        """Seconds left, infinite when unbounded."""
+
+        if self.expires_at is None:
+            return math.inf
+        return self.expires_at - time.monotonic()
+
+    def check(self, operation, needed=0.0):
+        """Raise DeadlineExceeded unless more than needed seconds are left for operation."""
+
+        remaining = self.remaining()
+        if remaining <= needed:
+            raise DeadlineExceeded(
+                f"Stopping before {operation}, {max(remaining, 0):.3f}s left of the invocation"
+            )
+        return remaining
+
+    def timeout(self, operation, timeout):
+        """Clamp a requests (connect, read) timeout to the time left."""
+
+        remaining = self.check(operation)
+        connect, read = timeout
+        return (min(connect, remaining), min(read, remaining))
+
+    def client_timeouts(self, operation):
+        """(connect, read, max attempts) for a botocore client, None when unbounded.
+
+        The time left is rounded down to a power of two seconds so only a handful of
+        clients are created for the shrinking budget. The attempts share half of it and the
+        backoff between them the other half, so retries cannot outlast the invocation either.
+        Fewer attempts are made when the backoff or timeouts would not fit, down to a single
+        attempt that may use all of it.
+        """
+
+        remaining = self.check(operation)
+        if math.isinf(remaining):
+            return None
+        seconds = 2.0 ** max(math.floor(math.log2(remaining)), -2)
+        attempts = CLIENT_MAX_ATTEMPTS
+        # The backoff of botocore's standard mode waits at most 1, 2, 4... seconds
+        while attempts > 1 and (
+            2 ** (attempts - 1) - 1 > seconds / 2
+            or seconds / (4 * attempts) < CLIENT_MIN_TIMEOUT
+        ):
+            attempts -= 1
+        if attempts == 1:
+            return (seconds / 2, seconds / 2, 1)
+        timeout = min(seconds / (4 * attempts), BOTOCORE_DEFAULT_TIMEOUT)
+        return (timeout, timeout, attempts)
@@ -1,6 +1,7 @@
-import boto3
 from botocore.exceptions import ClientError
 
+from aws_clients import get_client
+
 """Save Token to Secret Manager Class"""
 
 
@@ -9,9 +10,8 @@ class GetToken:
 
         secret_name = "cf-alb-token"
         region_name = "ap-southeast-2"
-        """ Create a Secrets Manager client"""
-        session = boto3.session.Session()
-        client = session.client(service_name="secretsmanager", region_name=region_name)
+        """ Get the shared Secrets Manager client"""
+        client = get_client("secretsmanager", region_name)
         try:
             response = client.get_secret_value(
                 SecretId=secret_name, VersionStage="AWSCURRENT"
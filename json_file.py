@@ -0,0 +1,40 @@
+"""Module to persist small JSON documents, such as the discovery indexes and checkpoints, in local files"""
+
+import json
+import os
+
+
+def load_json(path, version=None):
+    """Return the document stored in path.
+
+    A missing or unreadable file reads as an empty document, and so does one saved with
+    another version when a version is given.
+    """
+
+    try:
+        with open(path, encoding="utf-8") as document_file:
+            document = json.load(document_file)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(document, dict):
+        return {}
+    if version is not None and document.get("version") != version:
+        return {}
+    return document
+
+
+def save_json(path, document, version=None):
+    """Store document in path, creating its directory and stamping the version when given.
+
+    The document is written to a temporary file which then replaces path, so a concurrent or
+    interrupted invocation never reads a half written file.
+    """
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if version is not None:
+        document = {"version": version, **document}
+    with open(f"{path}.tmp", "w", encoding="utf-8") as document_file:
+        json.dump(document, document_file)
+    os.replace(f"{path}.tmp", path)
@@ -1,118 +1,214 @@
 """ Module for Lambda handler for secret rotation. """
 
-import boto3
+import json
+import os
+import sys
+
+# Imported first, so PROFILE=imports also times the imports below
+from profiling import PROFILER  # isort: skip
+from aws_tracer import TRACER
+from deadline import Deadline
+from metrics import METRICS
+from random_token_generator import RandomTokenGenerator
+from rotation_context import RotationContext
+from targets import run_concurrently
+
+# The Cloudflare and load balancer modules, with requests and aiohttp, are imported by the
+# steps using them, so the cold start of createSecret and finishSecret skips them. testSecret
+# only imports the light probe module, which leaves requests until there are URLs to probe
+
+# Secrets rotated in parallel by batch_handler
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "10"))
+# "threads" updates the rules on thread pools, "asyncio" on the shared event loop
+ROTATION_ENGINE = os.environ.get("ROTATION_ENGINE", "threads")
+
+
+@PROFILER.profiled
+def lambda_handler(event, context):
+    """Lambda handler function."""
 
-from cloudflare_helper import CloudflareHelper
-from loadbalancer_helper import LoadbalancerHelper
+    # Every remote call is bounded by the time left in the invocation
+    with TRACER.invocation():
+        rotate_secret(event, Deadline.from_context(context))
 
 
-def lambda_handler(event, context):
-    """Lambda handler function."""
+@PROFILER.profiled
+def batch_handler(event, context):
+    """Lambda handler rotating a batch of events, e.g. from SQS, reporting the failed items."""
+
+    deadline = Deadline.from_context(context)
+
+    # Steps of the same secret run in order, different secrets run concurrently
+    secrets = {}
+    items, failures = batch_items(event)
+    for item_id, rotation_event in items:
+        secrets.setdefault(rotation_event.get("SecretId"), []).append((item_id, rotation_event))
+
+    with TRACER.invocation():
+        results = run_concurrently(
+            lambda secret_id: rotate_secrets_in_order(secrets[secret_id], deadline),
+            list(secrets),
+            BATCH_MAX_CONCURRENCY,
+        )
+
+    for result in results:
+        failures.extend(result.error.failed_items if result.error else [])
+    return {"batchItemFailures": [{"itemIdentifier": item_id} for item_id in failures]}
+
+
+def batch_items(event):
+    """Return the (item id, rotation event) pairs of an SQS event or a list of rotation events,
+    and the ids of the items that are not rotation events."""
+
+    if isinstance(event, dict) and "Records" in event:
+        items = [(record["messageId"], record["body"]) for record in event["Records"]]
+    else:
+        events = event["Events"] if isinstance(event, dict) else event
+        items = [(str(index), rotation_event) for index, rotation_event in enumerate(events)]
+
+    parsed, malformed = [], []
+    for item_id, rotation_event in items:
+        try:
+            if isinstance(rotation_event, str):
+                rotation_event = json.loads(rotation_event)
+            if not isinstance(rotation_event, dict):
+                raise ValueError(f"expected a JSON object, got {type(rotation_event).__name__}")
+        except ValueError as error:
+            # Report only this item, failing the batch would retry every message with it
+            print(f"Rotation event {item_id} is malformed: {error}")
+            malformed.append(item_id)
+            continue
+        parsed.append((item_id, rotation_event))
+    return parsed, malformed
+
+
+class BatchItemsFailed(Exception):
+    """Steps of a secret in a batch failed, the items are reported to be retried"""
+
+    def __init__(self, failed_items, error):
+        self.failed_items = failed_items
+        super().__init__(f"{failed_items} failed: {error}")
+
+
+def rotate_secrets_in_order(items, deadline):
+    """Run the rotation events of one secret in order, stopping at the first failure."""
+
+    for index, (item_id, rotation_event) in enumerate(items):
+        try:
+            rotate_secret(rotation_event, deadline)
+        except Exception as error:
+            # The following steps of the secret depend on this one, report them as failed too
+            print(f"Rotation event {item_id} failed: {error!r}")
+            raise BatchItemsFailed([item for item, _ in items[index:]], error) from error
+
+
+def rotate_secret(event, deadline):
+    """Run the rotation step of a single Secrets Manager rotation event."""
 
     arn = event["SecretId"]
     token = event["ClientRequestToken"]
     step = event["Step"]
 
-    # Setup the client
-    service_client = boto3.client("secretsmanager")
+    # Every step emits its duration, and the calls it makes, as CloudWatch embedded metrics
+    with METRICS.step(arn, step):
+        # Secret reads are made once per invocation and shared by the steps, every call takes
+        # a shared client with timeouts fitting the time left when it starts
+        rotation = RotationContext(None, arn, token, deadline)
 
-    # Make sure the version is staged correctly
-    metadata = service_client.describe_secret(SecretId=arn)
-    if not metadata["RotationEnabled"]:
-        raise ValueError(f"Secret {arn} is not enabled for rotation")
+        # Make sure the version is staged correctly
+        if not rotation.metadata["RotationEnabled"]:
+            raise ValueError(f"Secret {arn} is not enabled for rotation")
 
-    if step == "createSecret":
-        create_secret(service_client, arn, token)
+        if step == "createSecret":
+            create_secret(rotation)
 
-    elif step == "setSecret":
-        set_secret(service_client, arn, token)
+        elif step == "setSecret":
+            set_secret(rotation)
 
-    elif step == "testSecret":
-        test_secret(service_client, arn, token)
+        elif step == "testSecret":
+            test_secret(rotation)
 
-    elif step == "finishSecret":
-        finish_secret(service_client, arn, token)
+        elif step == "finishSecret":
+            finish_secret(rotation)
 
-    else:
-        raise ValueError("Invalid step parameter")
+        else:
+            raise ValueError("Invalid step parameter")
 
 
-def create_secret(service_client, arn, token):
+def create_secret(rotation):
     """Function to create a new secret."""
 
     # There are three version stages for a secret: AWSPREVIOUS, AWSCURRENT, AWSPENDING.
     # When a new secret is generated, it is in the AWSPENDING stage untill the version stage is updated.
     # If a secret with AWSPENDING stage exists, get that secret, else generate a new secret value.
-    try:
-        service_client.get_secret_value(
-            SecretId=arn, VersionId=token, VersionStage="AWSPENDING"
-        )
-    except service_client.exceptions.ResourceNotFoundException:
-        # Generate a new token
-        new_token = service_client.get_random_password(
-            ExcludePunctuation=True, PasswordLength=32
-        )
+    if rotation.pending_value is None:
+        # Generate a new token, locally unless TOKEN_GENERATOR selects GetRandomPassword
+        token_generator = RandomTokenGenerator()
+        if token_generator.backend != "local":
+            token_generator.client = rotation.client("get_random_password")
+        new_token = token_generator.generate_random_token()
         # Put the secret
-        service_client.put_secret_value(
-            SecretId=arn,
-            ClientRequestToken=token,
-            SecretString=new_token["RandomPassword"],
-            VersionStages=["AWSPENDING"],
-        )
+        rotation.put_pending_value(new_token)
 
 
-def set_secret(service_client, arn, token):
+def set_secret(rotation):
     """Set the new token in cloudflare and application load balancer."""
 
-    # Retrieve the old secret
-    old_token = service_client.get_secret_value(SecretId=arn, VersionStage="AWSCURRENT")
-    # Retrieve the new secret
-    new_token = service_client.get_secret_value(SecretId=arn, VersionStage="AWSPENDING")
+    from propagation import PropagationVerifier
+    from rotation_state import get_checkpoint_store
+
+    if ROTATION_ENGINE == "threads":
+        from cloudflare_helper import CloudflareHelper
+        from loadbalancer_helper import LoadbalancerHelper
+        from rotation_state import SetSecretStateMachine
+
+        modify_listener = LoadbalancerHelper(deadline=rotation.deadline)
+        token_refresh = CloudflareHelper(deadline=rotation.deadline)
+        state_machine_class = SetSecretStateMachine
+    elif ROTATION_ENGINE == "asyncio":
+        from async_rotation import (
+            AsyncCloudflareHelper,
+            AsyncLoadbalancerHelper,
+            AsyncSetSecretStateMachine,
+        )
 
-    # Modify the token in the listener rule
-    print("Modifying ELB listener rule with two token values...")
-    modify_listener = LoadbalancerHelper()
-    response = modify_listener.modify_rule(
-        [old_token['SecretString'], new_token['SecretString']]
+        modify_listener = AsyncLoadbalancerHelper(deadline=rotation.deadline)
+        token_refresh = AsyncCloudflareHelper(deadline=rotation.deadline)
+        # The tokens are read with the remote state on the event loop
+        state_machine_class = AsyncSetSecretStateMachine
+    else:
+        raise ValueError(f"Invalid ROTATION_ENGINE {ROTATION_ENGINE}")
+
+    # The phases are checkpointed per token version, a retry resumes after the last completed one
+    state_machine = state_machine_class(
+        rotation,
+        get_checkpoint_store(rotation),
+        modify_listener,
+        token_refresh,
+        PropagationVerifier(deadline=rotation.deadline),
     )
-    # print(response)
-    result = response['ResponseMetadata']
-    print(result['HTTPStatusCode'])
-
-    if result['HTTPStatusCode'] == 200:
-        # Change token in cloudflare
-        print("Rotating the token in cloudflare...")
-        token_refresh = CloudflareHelper()
-        response = token_refresh.roll_token(new_token["SecretString"])
-        result = response.json()
-        print(result["success"])
-
-        if result["success"] == True:
-            # Updating listener rule and removing the old token
-            print("Updating the ELB listener rule with only the new token...")
-            modify_listener = LoadbalancerHelper()
-            response = modify_listener.modify_rule([new_token["SecretString"]])
-            response = response["ResponseMetadata"]
-            print(response["HTTPStatusCode"])
+    state_machine.run()
 
-        else:
-            print("Rotation failed at Cloudflare!")
 
-    else:
-        print("Rotation failed!")
+def test_secret(rotation):
+    """Method to test the new token against the protected hosts."""
 
+    from secret_probe import ProbeHarness
 
-def test_secret(service_client, arn, token):
-    """Method to test the new token."""
+    harness = ProbeHarness(deadline=rotation.deadline)
+    if not harness.urls:
+        print("No need to test against any service.")
+        return
 
-    print("No need to test against any service.")
+    print(f"Probing {len(harness.urls)} protected hosts with the pending token...")
+    harness.check(rotation.pending_value)
 
 
-def finish_secret(service_client, arn, token):
+def finish_secret(rotation):
     """Method to set the Version stage of the new token."""
 
-    # First describe the secret to get the current version
-    metadata = service_client.describe_secret(SecretId=arn)
+    # The secret was described by lambda_handler, use it to get the current version
+    metadata = rotation.metadata
 
     # Response sample of service_client.describe_secret(SecretId=arn): {
     #     'ARN': 'SECRET-ARN','Name': 'SECRET-NAME','Description': 'SECRET-DESCRIPTION','RotationEnabled': True|False,'RotationLambdaARN': 'LAMBDA-ARN',
@@ -120,16 +216,22 @@ def finish_secret(service_client, arn, token):
     #     'VersionIdsToStages': { 'old-secret-versionid': ['AWSCURRENT','AWSPREVIOUS'],'new-secret-versionid': ['AWSPENDING'] },}
     for version in metadata["VersionIdsToStages"]:
         if "AWSCURRENT" in metadata["VersionIdsToStages"][version]:
-            if version == token:
+            if version == rotation.token:
                 # The new secret version is already marked as AWSCURRENT, return
                 return
 
             # Finalize by staging the new secret version to AWSCURRENT.
-            service_client.update_secret_version_stage(
-                SecretId=arn,
+            rotation.client("update_secret_version_stage").update_secret_version_stage(
+                SecretId=rotation.arn,
                 VersionStage="AWSCURRENT",
-                MoveToVersionId=token,
+                MoveToVersionId=rotation.token,
                 RemoveFromVersionId=version,
             )
 
             break
+
+
+if __name__ == "__main__":
+    # Rotate a local JSON file of rotation events: python lambda_function.py events.json
+    with open(sys.argv[1], encoding="utf-8") as events_file:
+        print(json.dumps(batch_handler(json.load(events_file), None), indent=2))
@@ -1,43 +1,136 @@
 """Module to modify the ELB Listener Rule"""
 
-import boto3
+import os
+
 from botocore.exceptions import ClientError
 
+from alb_discovery import INDEX
+from aws_clients import get_client
+from deadline import Deadline
+from targets import ListenerRuleTarget, load_targets, run_concurrently
+
+# Listener rules to update, ALB_TARGETS is a JSON list of
+# {"rule_arn", "conditions", "header_name", "role_arn"} objects
+ALB_TARGETS = load_targets(
+    "ALB_TARGETS",
+    ListenerRuleTarget,
+    [
+        ListenerRuleTarget(
+            rule_arn="arn:aws:elasticloadbalancing:ap-southeast-2:177970211836:listener-rule/app/sheba-loadbalancer/38a97bd60a7d8892/44531f4d8ead8087/526eb7337545c69d",
+            conditions=[
+                {
+                    "Field": "path-pattern",
+                    "PathPatternConfig": {"Values": ["embeds/*", "static/*"]},
+                },
+                {
+                    "Field": "host-header",
+                    "HostHeaderConfig": {
+                        "Values": [
+                            "sandbox-authoringtools.company.co.nz",
+                        ]
+                    },
+                },
+            ],
+        )
+    ],
+)
+ALB_MAX_CONCURRENCY = int(os.environ.get("ALB_MAX_CONCURRENCY", "10"))
+
 
 class LoadbalancerHelper:
     """Class to modify token in elb listener rule"""
 
-    def modify_rule(self, token):
-        """Method to modify listener rule"""
+    def __init__(self, targets=None, deadline=None):
+        self.deadline = deadline or Deadline()
+        # With ALB_DISCOVERY_REGIONS set the rules come from the discovery index, not ALB_TARGETS
+        self.discovered = targets is None and INDEX.enabled
+        if targets is None:
+            targets = INDEX.targets(deadline=self.deadline) if self.discovered else ALB_TARGETS
+        self.targets = targets
+
+    def modify_rule(self, token, targets=None):
+        """Method to modify listener rules, returns a TargetResult per rule updated concurrently"""
+
+        results = run_concurrently(
+            lambda target: self.modify_target(token, target),
+            self.targets if targets is None else targets,
+            ALB_MAX_CONCURRENCY,
+        )
+        for result in results:
+            self.check_discovered(result.target.region_name, result.error)
+        return results
+
+    def check_discovered(self, region_name, error):
+        """Rescan the region on the next rotation when a discovered rule was deleted since the last scan"""
+
+        if (
+            self.discovered
+            and isinstance(error, ClientError)
+            and error.response["Error"]["Code"] == "RuleNotFound"
+        ):
+            INDEX.invalidate(region_name)
+
+    def get_token_values(self, targets=None):
+        """Method to read the token values checked by each listener rule, keyed by rule arn"""
+
+        targets = self.targets if targets is None else targets
+
+        # Rules in the same region and account are described with a single request
+        groups = {}
+        for target in targets:
+            groups.setdefault((target.region_name, target.role_arn), []).append(target)
+        results = run_concurrently(
+            lambda group: self.describe_rules(groups[group]),
+            list(groups),
+            ALB_MAX_CONCURRENCY,
+        )
+
+        values = {}
+        for result in results:
+            if not result.success:
+                self.check_discovered(result.target[0], result.error)
+                raise result.error
+            for target in groups[result.target]:
+                values[target.rule_arn] = result.response.get(target.rule_arn)
+        return values
 
-        region_name = "ap-southeast-2"
+    def describe_rules(self, targets):
+        """Method to return the token values of listener rules in one region and account"""
 
-        # Create secret manager client
-        session = boto3.session.Session()
-        client = session.client(service_name="elbv2", region_name=region_name)
+        timeouts = self.deadline.client_timeouts("describe_rules")
+        client = get_client("elbv2", targets[0].region_name, targets[0].role_arn, timeouts)
+        try:
+            response = client.describe_rules(RuleArns=[target.rule_arn for target in targets])
+        except ClientError as error:
+            raise error
+
+        header_names = {target.rule_arn: target.header_name for target in targets}
+        values = {}
+        for rule in response["Rules"]:
+            for condition in rule["Conditions"]:
+                config = condition.get("HttpHeaderConfig", {})
+                if config.get("HttpHeaderName") == header_names[rule["RuleArn"]]:
+                    values[rule["RuleArn"]] = config["Values"]
+        return values
+
+    def modify_target(self, token, target):
+        """Method to modify a single listener rule"""
+
+        # Get the shared elbv2 client for the region and account of the rule
+        timeouts = self.deadline.client_timeouts("modify_rule")
+        client = get_client("elbv2", target.region_name, target.role_arn, timeouts)
         try:
             response = client.modify_rule(
-                RuleArn="arn:aws:elasticloadbalancing:ap-southeast-2:177970211836:listener-rule/app/sheba-loadbalancer/38a97bd60a7d8892/44531f4d8ead8087/526eb7337545c69d",
+                RuleArn=target.rule_arn,
                 Conditions=[
                     {
                         "Field": "http-header",
                         "HttpHeaderConfig": {
-                            "HttpHeaderName": "X-ALB-SECRET",
+                            "HttpHeaderName": target.header_name,
                             "Values": token,
                         },
                     },
-                    {
-                        "Field": "path-pattern",
-                        "PathPatternConfig": {"Values": ["embeds/*", "static/*"]},
-                    },
-                    {
-                        "Field": "host-header",
-                        "HostHeaderConfig": {
-                            "Values": [
-                                "sandbox-authoringtools.company.co.nz",
-                            ]
-                        },
-                    },
+                    *target.conditions,
                 ],
             )
             # print(response)
@@ -0,0 +1,207 @@
+"""Module to emit rotation metrics as CloudWatch Embedded Metric Format log lines"""
+
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CloudflareAlbTokenRotation")
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+
+# Secret and step of the rotation running in the current thread or task
+_invocation = contextvars.ContextVar("invocation", default={})
+
+
+def current_invocation():
+    """Secret and step of the rotation running in the current thread or task, empty outside one."""
+
+    return dict(_invocation.get())
+
+
+class StdoutSink:
+    """Prints every record on its own line, where CloudWatch Logs picks EMF records up"""
+
+    def write(self, record):
+        print(json.dumps(record, default=str), flush=True)
+
+
+class MemorySink:
+    """Keeps the records in memory, for tests"""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def find(self, **fields):
+        """Return the records with the given field values."""
+
+        with self.lock:
+            return [
+                record
+                for record in self.records
+                if all(record.get(name) == value for name, value in fields.items())
+            ]
+
+
+class CallMetrics:
+    """Outcome of an external call, filled in while it runs"""
+
+    def __init__(self):
+        self.status = None
+        self.retries = 0
+        # Seconds spent waiting for the rate limiter, None for calls it does not pace
+        self.queue_wait = None
+
+
+class MetricsLogger:
+    """Emits a metric record per rotation step and per call to Cloudflare or AWS"""
+
+    def __init__(self, namespace=None, sink=None, enabled=None):
+        self.namespace = namespace or METRICS_NAMESPACE
+        self.sink = sink or StdoutSink()
+        self.enabled = METRICS_ENABLED if enabled is None else enabled
+
+    def put(self, dimensions, metrics, properties=None):
+        """Emit one record, metrics maps each metric name to a (value, unit) pair."""
+
+        if not self.enabled:
+            return
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()
+                        ],
+                    }
+                ],
+            },
+        }
+        record.update(_invocation.get())
+        properties = properties or {}
+        record.update({name: value for name, value in properties.items() if value is not None})
+        record.update(dimensions)
+        record.update({name: value for name, (value, _) in metrics.items()})
+        self.sink.write(record)
+
+    @contextmanager
+    def step(self, secret_id, step):
+        """Time a rotation step, tagging the calls made meanwhile with the secret and step."""
+
+        token = _invocation.set({"SecretId": secret_id, "Step": step})
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            _invocation.reset(token)
+            self.put(
+                {"Step": step},
+                {
+                    "Duration": ((time.perf_counter() - start) * 1000, "Milliseconds"),
+                    "Errors": (int(error is not None), "Count"),
+                },
+                {"SecretId": secret_id, "ErrorType": error and type(error).__name__},
+            )
+
+    @contextmanager
+    def timed_call(self, service, operation, target=None):
+        """Time a call to an external service, the block sets the status and retries it yields."""
+
+        call = CallMetrics()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield call
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self.call(
+                service,
+                operation,
+                time.perf_counter() - start,
+                status=call.status,
+                retries=call.retries,
+                target=target,
+                error=error,
+                queue_wait=call.queue_wait,
+            )
+
+    def call(
+        self,
+        service,
+        operation,
+        duration,
+        status=None,
+        retries=0,
+        target=None,
+        error=None,
+        queue_wait=None,
+    ):
+        """Emit the metrics of one call to an external service, durations in seconds."""
+
+        metrics = {
+            "Duration": (duration * 1000, "Milliseconds"),
+            "Retries": (retries, "Count"),
+            "Errors": (int(error is not None or (status or 0) >= 400), "Count"),
+        }
+        if queue_wait is not None:
+            metrics["QueueWait"] = (queue_wait * 1000, "Milliseconds")
+        self.put(
+            {"Service": service, "Operation": operation},
+            metrics,
+            {
+                "StatusCode": status,
+                "Target": target and str(target),
+                "ErrorType": error and type(error).__name__,
+            },
+        )
+
+
+def register_botocore_events(events):
+    """Emit the metrics of every AWS API call made by a client with these events."""
+
+    def before_call(model, context, **kwargs):
+        context["metrics_model"] = model
+        context["metrics_start"] = time.perf_counter()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        METRICS.call(
+            model.service_model.service_name,
+            model.name,
+            time.perf_counter() - context.get("metrics_start", time.perf_counter()),
+            status=http_response.status_code,
+            retries=parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+        )
+
+    def after_call_error(exception, context, **kwargs):
+        model = context.get("metrics_model")
+        if model is None:
+            return
+        METRICS.call(
+            model.service_model.service_name,
+            model.name,
+            time.perf_counter() - context["metrics_start"],
+            error=exception,
+        )
+
+    # unique_id keeps a handler from being registered twice on the same client
+    events.register("before-call", before_call, unique_id="metrics-before-call")
+    events.register("after-call", after_call, unique_id="metrics-after-call")
+    events.register("after-call-error", after_call_error, unique_id="metrics-after-call-error")
+
+
+METRICS = MetricsLogger()
@@ -0,0 +1,202 @@
+"""Module to profile invocations on demand, writing CPU, memory and import profiles to /tmp"""
+
+import builtins
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+# Comma separated profiles to capture: cpu, memory, imports or all, unset disables profiling
+PROFILE = {kind.strip() for kind in os.environ.get("PROFILE", "").split(",") if kind.strip()}
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+# Functions, allocation sites and imports listed in the text reports
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "30"))
+PROFILE_KINDS = ("cpu", "memory", "imports")
+
+
+class DirectorySink:
+    """Writes every profile to a file in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, name, data):
+        """Write a text or binary profile, returning its path."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        mode = "wb" if isinstance(data, bytes) else "w"
+        with open(path, mode) as profile_file:
+            profile_file.write(data)
+        return path
+
+
+class ImportTimer:
+    """Times the first import of every module by wrapping builtins.__import__"""
+
+    def __init__(self):
+        # (module, seconds including the modules it imported, seconds of its own)
+        self.timings = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.original_import = None
+
+    def install(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        builtins.__import__ = self.original_import
+
+    def take(self):
+        """Return the timings recorded since the last take."""
+
+        with self.lock:
+            timings, self.timings = self.timings, []
+        return timings
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.timings.append((name, elapsed, elapsed - children))
+
+
+def import_report(timings, top):
+    """Text report of import timings, slowest first."""
+
+    lines = [f"{'cumulative ms':>14}{'self ms':>10}  module"]
+    for name, cumulative, own in sorted(timings, key=lambda timing: -timing[1])[:top]:
+        lines.append(f"{cumulative * 1000:>14.2f}{own * 1000:>10.2f}  {name}")
+    total = sum(own for _, _, own in timings)
+    lines.append(f"{len(timings)} modules imported in {total * 1000:.2f} ms")
+    return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """Captures the profiles selected by PROFILE around an invocation"""
+
+    def __init__(self, kinds=None, sink=None, top=None):
+        kinds = PROFILE if kinds is None else set(kinds)
+        self.kinds = set(PROFILE_KINDS) if "all" in kinds else kinds
+        self.sink = sink or DirectorySink(PROFILE_DIR)
+        self.top = top or PROFILE_TOP
+        self.import_timer = None
+        if "imports" in self.kinds:
+            self.import_timer = ImportTimer()
+            self.import_timer.install()
+
+    @property
+    def enabled(self):
+        """True when any profile is captured."""
+
+        return bool(self.kinds)
+
+    def profiled(self, func):
+        """Decorate func to profile every call, returning func itself when profiling is off."""
+
+        if not self.enabled:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with self.invocation(func.__name__):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+
+    @contextmanager
+    def invocation(self, name):
+        """Profile the block, writing the profiles named after name when it ends."""
+
+        if not self.enabled:
+            yield
+            return
+
+        prefix = f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profile = thread_profiles = None
+        snapshot = None
+        started_tracing = False
+        if "memory" in self.kinds:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            snapshot = tracemalloc.take_snapshot()
+        if "cpu" in self.kinds:
+            profile, thread_profiles = cProfile.Profile(), []
+
+            # Threads started meanwhile, e.g. the rule update pools, get a profile of their own
+            def profile_thread(*args):
+                thread_profile = cProfile.Profile()
+                thread_profiles.append((threading.current_thread(), thread_profile))
+                thread_profile.enable()
+
+            threading.setprofile(profile_thread)
+            profile.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            paths = []
+            if profile is not None:
+                profile.disable()
+                threading.setprofile(None)
+                paths.extend(self._write_cpu(prefix, profile, thread_profiles))
+            if snapshot is not None:
+                paths.append(self._write_memory(prefix, snapshot))
+                if started_tracing:
+                    tracemalloc.stop()
+            if self.import_timer is not None:
+                # The first invocation reports the cold start imports, later ones any lazy imports
+                report = import_report(self.import_timer.take(), self.top)
+                paths.append(self.sink.write(f"{prefix}-imports.txt", report))
+            print(f"Profiled {name} in {elapsed:.3f}s, wrote {', '.join(map(str, paths))}")
+
+    def _write_cpu(self, prefix, profile, thread_profiles):
+        stats = pstats.Stats(profile)
+        # Threads still running, like the shared event loop, are left out
+        for thread, thread_profile in thread_profiles:
+            if not thread.is_alive():
+                stats.add(thread_profile)
+
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats("cumulative").print_stats(self.top)
+        # The .prof file loads in pstats, snakeviz or any other pstats viewer
+        return [
+            self.sink.write(f"{prefix}-cpu.prof", marshal.dumps(stats.stats)),
+            self.sink.write(f"{prefix}-cpu.txt", report.getvalue()),
+        ]
+
+    def _write_memory(self, prefix, snapshot):
+        _, peak = tracemalloc.get_traced_memory()
+        differences = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        lines = [f"Peak traced memory {peak / 1024:.1f} KiB", "Allocated during the invocation:"]
+        lines.extend(str(difference) for difference in differences[: self.top])
+        return self.sink.write(f"{prefix}-memory.txt", "\n".join(lines) + "\n")
+
+
+PROFILER = Profiler()
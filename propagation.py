@@ -0,0 +1,142 @@
+"""Module to wait until the Cloudflare edge sends the new token before the old one is dropped"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cloudflare_helper import CF_HEADER_NAME
+from deadline import Deadline
+from metrics import METRICS
+from targets import run_concurrently
+
+# URLs behind Cloudflare echoing the request headers as JSON, comma separated, unset skips the wait
+CF_PROPAGATION_PROBE_URLS = [
+    url.strip() for url in os.environ.get("CF_PROPAGATION_PROBE_URLS", "").split(",") if url.strip()
+]
+CF_PROPAGATION_TIMEOUT = float(os.environ.get("CF_PROPAGATION_TIMEOUT", "60"))
+# Rounds in a row every probe must see the new token
+CF_PROPAGATION_MATCHES = int(os.environ.get("CF_PROPAGATION_MATCHES", "3"))
+CF_PROPAGATION_INTERVAL = float(os.environ.get("CF_PROPAGATION_INTERVAL", "0.25"))
+CF_PROPAGATION_MAX_INTERVAL = float(os.environ.get("CF_PROPAGATION_MAX_INTERVAL", "4"))
+PROBE_TIMEOUT = (3.05, 5)
+
+_probe_session = None
+_probe_session_lock = threading.Lock()
+
+
+def get_probe_session():
+    """Return the keep-alive session for the probes, shared across warm invocations.
+
+    It is separate from the Cloudflare API session, whose single pool would be evicted by
+    every probe host and would mix probe connections with the API ones.
+    """
+
+    global _probe_session
+
+    with _probe_session_lock:
+        if _probe_session is None:
+            session = requests.Session()
+            # One pool per probe host, each probed once per round
+            pools = max(len(CF_PROPAGATION_PROBE_URLS), 1)
+            adapter = HTTPAdapter(pool_connections=pools, pool_maxsize=pools, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _probe_session = session
+        return _probe_session
+
+
+class PropagationTimeout(RuntimeError):
+    """The edge did not send the new token in time, retrying the step waits again"""
+
+
+class PropagationVerifier:
+    """Polls echo endpoints behind Cloudflare until they all receive the new token header"""
+
+    def __init__(
+        self,
+        probe_urls=None,
+        header_name=CF_HEADER_NAME,
+        deadline=None,
+        session=None,
+        timeout=None,
+        required_matches=None,
+        interval=None,
+        max_interval=None,
+    ):
+        self.probe_urls = CF_PROPAGATION_PROBE_URLS if probe_urls is None else probe_urls
+        self.header_name = header_name
+        self.deadline = deadline or Deadline()
+        self.session = session or get_probe_session()
+        self.timeout = CF_PROPAGATION_TIMEOUT if timeout is None else timeout
+        self.required_matches = required_matches or CF_PROPAGATION_MATCHES
+        self.interval = interval or CF_PROPAGATION_INTERVAL
+        self.max_interval = max_interval or CF_PROPAGATION_MAX_INTERVAL
+
+    def observe(self, url):
+        """Return the token header value the probe received, None when it could not be read."""
+
+        try:
+            response = self.session.get(
+                url,
+                # Keep caches between the edge and the probe out of the way
+                headers={"Cache-Control": "no-cache"},
+                params={"probe": time.time_ns()},
+                timeout=self.deadline.timeout(f"GET {url}", PROBE_TIMEOUT),
+            )
+            response.raise_for_status()
+            body = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+        headers = body.get("headers", body) if isinstance(body, dict) else {}
+        for name, value in headers.items():
+            if name.lower() == self.header_name.lower():
+                return value
+        return None
+
+    def wait_for(self, value):
+        """Block until every probe saw value required_matches rounds in a row, returning the seconds waited.
+
+        Polling backs off exponentially while the old value is still seen and returns to the
+        short interval once the new one shows up, to confirm it quickly.
+        """
+
+        if not self.probe_urls:
+            return 0.0
+
+        print(f"Waiting for the new token to reach {len(self.probe_urls)} edge probes...")
+        start = time.monotonic()
+        matches = 0
+        interval = self.interval
+        rounds = 0
+        while True:
+            results = run_concurrently(self.observe, self.probe_urls, len(self.probe_urls))
+            rounds += 1
+            elapsed = time.monotonic() - start
+            if all(result.response == value for result in results):
+                matches += 1
+                if matches >= self.required_matches:
+                    print(f"The new token reached the edge in {elapsed:.3f}s after {rounds} rounds.")
+                    METRICS.call("cloudflare-edge", "WaitForPropagation", elapsed, retries=rounds - 1)
+                    return elapsed
+                delay = self.interval
+            else:
+                matches = 0
+                delay = interval
+                interval = min(interval * 2, self.max_interval)
+
+            if elapsed + delay > self.timeout:
+                error = PropagationTimeout(
+                    f"The new token did not reach the edge within {self.timeout:.0f}s"
+                )
+                METRICS.call(
+                    "cloudflare-edge", "WaitForPropagation", elapsed, retries=rounds - 1, error=error
+                )
+                raise error
+            # Stop rather than be killed while the listener rules still accept both tokens
+            self.deadline.check("waiting for propagation", needed=delay)
+            time.sleep(random.uniform(delay / 2, delay))
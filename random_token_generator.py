@@ -1,29 +1,76 @@
-import random
+import os
+import secrets
 import string
-import boto3
+
 from botocore.exceptions import ClientError
-import os
+
+from aws_clients import get_client
 
 """Random token generator class"""
 
+TOKEN_LENGTH = int(os.environ.get("TOKEN_LENGTH", "32"))
+# Same characters as GetRandomPassword with ExcludePunctuation
+TOKEN_ALPHABET = os.environ.get("TOKEN_ALPHABET", string.ascii_letters + string.digits)
+EXCLUDE_CHARACTERS = (
+    os.environ["EXCLUDE_CHARACTERS"] if "EXCLUDE_CHARACTERS" in os.environ else "/@\"'\\"
+)
+# "local" generates tokens in process, "secretsmanager" calls GetRandomPassword
+TOKEN_GENERATOR = os.environ.get("TOKEN_GENERATOR", "local")
+
 
 class RandomTokenGenerator:
+    def __init__(
+        self, length=None, alphabet=None, exclude_characters=None, backend=None, client=None
+    ):
+        self.length = length or TOKEN_LENGTH
+        self.exclude_characters = (
+            EXCLUDE_CHARACTERS if exclude_characters is None else exclude_characters
+        )
+        self.alphabet = "".join(
+            sorted(set(alphabet or TOKEN_ALPHABET) - set(self.exclude_characters))
+        )
+        self.backend = backend or TOKEN_GENERATOR
+        self.client = client
+
     def generate_random_token(self):
+        if self.backend == "local":
+            return self.generate_local_token()
+        if self.backend == "secretsmanager":
+            return self.generate_remote_token()
+        raise ValueError(f"Invalid TOKEN_GENERATOR {self.backend}")
+
+    def generate_local_token(self):
+        """ Generate the token with the operating system CSPRNG"""
+        if not self.alphabet:
+            raise ValueError("Every token character is excluded")
 
+        # Like GetRandomPassword, include each character type of the alphabet at least once
+        required = [
+            group
+            for group in (string.ascii_lowercase, string.ascii_uppercase, string.digits)
+            if set(group) & set(self.alphabet)
+        ]
+        while True:
+            token = "".join(secrets.choice(self.alphabet) for _ in range(self.length))
+            if self.length < len(required) or all(set(group) & set(token) for group in required):
+                return token
+
+    def generate_remote_token(self):
         region_name = "ap-southeast-2"
-        exclude_characters = (
-            os.environ["EXCLUDE_CHARACTERS"]
-            if "EXCLUDE_CHARACTERS" in os.environ
-            else "/@\"'\\"
-        )
 
-        # return "".join(random.choice(string.hexdigits) for _ in range(30))
-        """ Create a Secrets Manager client"""
-        session = boto3.session.Session()
-        client = session.client(service_name="secretsmanager", region_name=region_name)
+        """ Get the shared Secrets Manager client"""
+        client = self.client or get_client("secretsmanager", region_name)
+        # GetRandomPassword has no alphabet setting, exclude every other printable character
+        printable = string.ascii_letters + string.digits + string.punctuation
+        exclude_characters = set(printable) - set(self.alphabet)
+        exclude_punctuation = set(string.punctuation) <= exclude_characters
+        if exclude_punctuation:
+            exclude_characters -= set(string.punctuation)
         try:
             response = client.get_random_password(
-                ExcludePunctuation=True, PasswordLength=32
+                PasswordLength=self.length,
+                ExcludePunctuation=exclude_punctuation,
+                ExcludeCharacters="".join(sorted(exclude_characters)),
             )
             return response["RandomPassword"]
         except ClientError as e:
@@ -0,0 +1,153 @@
+"""Module to keep API calls within a rate limit shared by every thread in the process"""
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Token bucket limiter that adapts to Retry-After and rate limit response headers"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        # rate is in requests per second, burst is the bucket size
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.delayed = 0
+        self.pauses = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self):
+        """Take a token and return the seconds the caller must wait before using it.
+
+        The bucket may go negative, so concurrent callers queue up behind each other. It does
+        not refill before updated, so the queue forms behind the end of a pause or a rate
+        limit window.
+        """
+
+        with self.lock:
+            now = self.clock()
+            elapsed = max(now - self.updated, 0.0)
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = max(now, self.updated)
+            self.tokens -= 1
+
+            if self.tokens < 0:
+                wait = self.updated - now - self.tokens / self.rate
+            else:
+                wait = max(self.paused_until - now, 0.0)
+
+            self.acquired += 1
+            if wait > 0:
+                self.delayed += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self, sleep=time.sleep):
+        """Wait until a request may be sent, returning the seconds waited."""
+
+        wait = self.reserve()
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """Hold every caller back for seconds, e.g. after a 429 with Retry-After."""
+
+        with self.lock:
+            now = self.clock()
+            if now + seconds > self.paused_until:
+                self.paused_until = now + seconds
+                self.pauses += 1
+            # Do not refill during the pause, otherwise a burst follows it
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = max(self.updated, self.paused_until)
+
+    def limit_remaining(self, remaining, reset):
+        """Never spend more than the remaining requests the server reported before reset seconds."""
+
+        if remaining <= 0:
+            self.pause(reset)
+            return
+        with self.lock:
+            self.tokens = min(self.tokens, float(remaining))
+            # The remaining requests last until the window resets, no refill before then
+            self.updated = max(self.updated, self.clock() + reset)
+
+    def update_from_headers(self, headers):
+        """Adapt to the Retry-After and rate limit headers of a response."""
+
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        if retry_after is not None:
+            self.pause(retry_after)
+
+        remaining, reset = parse_rate_limit(headers)
+        if remaining is not None:
+            self.limit_remaining(remaining, reset or 1.0)
+
+    def metrics(self):
+        """Queue wait metrics since the limiter was created."""
+
+        with self.lock:
+            return {
+                "acquired": self.acquired,
+                "delayed": self.delayed,
+                "pauses": self.pauses,
+                "total_wait_seconds": self.total_wait,
+                "max_wait_seconds": self.max_wait,
+                "mean_wait_seconds": self.total_wait / self.acquired if self.acquired else 0.0,
+            }
+
+
+def parse_retry_after(value):
+    """Seconds of a Retry-After header given as seconds or an HTTP date, None when absent."""
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+
+def parse_rate_limit(headers):
+    """Remaining requests and seconds to reset from rate limit headers, (None, None) when absent.
+
+    Understands the structured "Ratelimit: ...;r=<remaining>;t=<reset>" header as well as
+    the X-RateLimit-Remaining and X-RateLimit-Reset pair.
+    """
+
+    structured = headers.get("Ratelimit")
+    if structured:
+        params = dict(
+            part.strip().split("=", 1) for part in structured.split(";") if "=" in part
+        )
+        try:
+            return int(params["r"]), float(params.get("t", 0))
+        except (KeyError, ValueError):
+            pass
+
+    remaining = headers.get("X-RateLimit-Remaining")
+    if remaining is None:
+        return None, None
+    try:
+        reset = float(headers.get("X-RateLimit-Reset", 0))
+    except ValueError:
+        reset = 0.0
+    # Some servers send the reset as an epoch time rather than seconds
+    if reset > 1e9:
+        reset = max(reset - time.time(), 0.0)
+    try:
+        return int(remaining), reset
+    except ValueError:
+        return None, None
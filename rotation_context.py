@@ -0,0 +1,96 @@
+"""Module to share the Secrets Manager reads made while rotating a secret"""
+
+import threading
+
+from aws_clients import get_client
+from deadline import Deadline
+
+
+class RotationContext:
+    """Secret metadata and version values for one rotation invocation, fetched once on first use.
+
+    Reads may run on several threads at once, each value is fetched once by the first of them.
+    """
+
+    def __init__(self, service_client, arn, token, deadline=None):
+        # None takes the shared client with timeouts fitting the time left before every call
+        self.service_client = service_client
+        self.arn = arn
+        self.token = token
+        self.deadline = deadline or Deadline()
+        self._metadata = None
+        self._values = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _key_lock(self, key):
+        """Lock serialising the fetch of one value, so different values are fetched concurrently."""
+
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def client(self, operation):
+        """Secrets Manager client for operation, raising DeadlineExceeded when out of time."""
+
+        if self.service_client is not None:
+            self.deadline.check(operation)
+            return self.service_client
+        return get_client(
+            "secretsmanager", region_name=None, timeouts=self.deadline.client_timeouts(operation)
+        )
+
+    @property
+    def metadata(self):
+        """Response of describe_secret for the secret being rotated."""
+
+        with self._key_lock("metadata"):
+            if self._metadata is None:
+                client = self.client("describe_secret")
+                self._metadata = client.describe_secret(SecretId=self.arn)
+        return self._metadata
+
+    def get_secret_value(self, stage, version_id=None):
+        """Return the get_secret_value response for a stage, or None when the version does not exist."""
+
+        key = (stage, version_id)
+        with self._key_lock(key):
+            if key not in self._values:
+                kwargs = {"SecretId": self.arn, "VersionStage": stage}
+                if version_id is not None:
+                    kwargs["VersionId"] = version_id
+                client = self.client("get_secret_value")
+                try:
+                    self._values[key] = client.get_secret_value(**kwargs)
+                except client.exceptions.ResourceNotFoundException:
+                    self._values[key] = None
+            return self._values[key]
+
+    @property
+    def current_value(self):
+        """The AWSCURRENT token."""
+
+        return self.get_secret_value("AWSCURRENT")["SecretString"]
+
+    @property
+    def pending_value(self):
+        """The AWSPENDING token for this rotation, or None when it is not created yet."""
+
+        response = self.get_secret_value("AWSPENDING", self.token)
+        return None if response is None else response["SecretString"]
+
+    def put_pending_value(self, secret_string):
+        """Store the AWSPENDING token for this rotation."""
+
+        self.client("put_secret_value").put_secret_value(
+            SecretId=self.arn,
+            ClientRequestToken=self.token,
+            SecretString=secret_string,
+            VersionStages=["AWSPENDING"],
+        )
+        with self._key_lock(("AWSPENDING", self.token)):
+            self._values[("AWSPENDING", self.token)] = {
+                "ARN": self.arn,
+                "VersionId": self.token,
+                "SecretString": secret_string,
+                "VersionStages": ["AWSPENDING"],
+            }
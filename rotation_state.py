@@ -0,0 +1,251 @@
+"""Module to run setSecret as a checkpointed state machine that resumes after a timeout"""
+
+import hashlib
+import os
+
+from botocore.exceptions import ClientError
+
+from cloudflare_helper import header_values
+from deadline import DeadlineExceeded
+from json_file import load_json, save_json
+from targets import report_results, run_concurrently
+
+# Where checkpoints are kept, "secret" tags the rotated secret, "file" writes to CHECKPOINT_DIR
+CHECKPOINT_STORE = os.environ.get("CHECKPOINT_STORE", "secret")
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", "/tmp/rotation-checkpoints")
+CHECKPOINT_TAG_PREFIX = "rotation-checkpoint-"
+
+# setSecret phases in the order they must complete
+PHASES = ("alb_dual", "cloudflare", "alb_single")
+
+
+class FileCheckpointStore:
+    """Keeps the last completed phase of each token version in a local file"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or CHECKPOINT_DIR
+
+    def path(self, arn, token):
+        """File holding the checkpoint of a token version."""
+
+        digest = hashlib.sha256(f"{arn}:{token}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def load(self, arn, token):
+        """Return the last completed phase, or None."""
+
+        return load_json(self.path(arn, token)).get("phase")
+
+    def save(self, arn, token, phase):
+        """Record phase as completed."""
+
+        save_json(self.path(arn, token), {"arn": arn, "token": token, "phase": phase})
+
+
+class SecretTagCheckpointStore:
+    """Keeps the last completed phase of each token version in a tag on the rotated secret"""
+
+    def __init__(self, rotation):
+        self.rotation = rotation
+        self.saved = {}
+        self.cleaned = False
+
+    def load(self, arn, token):
+        """Return the last completed phase, or None."""
+
+        if token in self.saved:
+            return self.saved[token]
+        for tag in self.rotation.metadata.get("Tags", []):
+            if tag["Key"] == f"{CHECKPOINT_TAG_PREFIX}{token}":
+                return tag["Value"]
+        return None
+
+    def save(self, arn, token, phase):
+        """Record phase as completed and drop the checkpoints of older versions.
+
+        Raises DeadlineExceeded rather than start a write the invocation has no time left for.
+        """
+
+        stale = []
+        if not self.cleaned:
+            stale = [
+                tag["Key"]
+                for tag in self.rotation.metadata.get("Tags", [])
+                if tag["Key"].startswith(CHECKPOINT_TAG_PREFIX)
+                and tag["Key"] != f"{CHECKPOINT_TAG_PREFIX}{token}"
+            ]
+        try:
+            self.rotation.client("tag_resource").tag_resource(
+                SecretId=arn, Tags=[{"Key": f"{CHECKPOINT_TAG_PREFIX}{token}", "Value": phase}]
+            )
+            if stale:
+                self.rotation.client("untag_resource").untag_resource(SecretId=arn, TagKeys=stale)
+            self.cleaned = True
+        except ClientError as error:
+            # Checkpoints only save work on a retry, never fail the rotation over them
+            print(f"Could not save the {phase} checkpoint: {error}")
+        self.saved[token] = phase
+
+
+class NullCheckpointStore:
+    """Keeps no checkpoints, every retry reads the remote state"""
+
+    def load(self, arn, token):
+        """Return the last completed phase, always None."""
+
+        return None
+
+    def save(self, arn, token, phase):
+        """Discard the checkpoint."""
+
+
+def get_checkpoint_store(rotation):
+    """Return the checkpoint store configured by CHECKPOINT_STORE."""
+
+    if CHECKPOINT_STORE == "secret":
+        return SecretTagCheckpointStore(rotation)
+    if CHECKPOINT_STORE == "file":
+        return FileCheckpointStore()
+    if CHECKPOINT_STORE == "none":
+        return NullCheckpointStore()
+    raise ValueError(f"Invalid CHECKPOINT_STORE {CHECKPOINT_STORE}")
+
+
+def plan_set_secret(old_token, new_token, alb_targets, alb_values, cf_targets, cf_values):
+    """Work out which listener rules and cloudflare rules still need to be written."""
+
+    # Cloudflare rules not sending the new token yet
+    cloudflare = [target for target in cf_targets if cf_values.get(target) != new_token]
+
+    # While any cloudflare rule still sends the old token the listener rules must accept both
+    alb_dual = [
+        target
+        for target in alb_targets
+        if cloudflare and not {old_token, new_token} <= set(alb_values.get(target.rule_arn) or [])
+    ]
+
+    # Listener rules still accepting anything but the new token
+    alb_single = [
+        target for target in alb_targets if alb_values.get(target.rule_arn) != [new_token]
+    ]
+
+    return {"alb_dual": alb_dual, "cloudflare": cloudflare, "alb_single": alb_single}
+
+
+class SetSecretStateMachine:
+    """Runs the setSecret phases in order, checkpointing each completed phase per token version"""
+
+    def __init__(self, rotation, store, modify_listener, token_refresh, propagation=None):
+        self.rotation = rotation
+        self.store = store
+        self.modify_listener = modify_listener
+        self.token_refresh = token_refresh
+        # Verifies the edge sends the new token before the old one is dropped, None skips it
+        self.propagation = propagation
+        # Read by plan together with the remote state
+        self.old_token = None
+        self.new_token = None
+        # Cloudflare rules as read for the plan, written back by the cloudflare phase
+        self.cf_rules = None
+
+    def remaining_phases(self):
+        """Phases still to run, after the last checkpointed one."""
+
+        completed = self.store.load(self.rotation.arn, self.rotation.token)
+        if completed is None:
+            return list(PHASES)
+        return list(PHASES[PHASES.index(completed) + 1 :])
+
+    def read_state(self, remaining):
+        """Read the tokens and the remote state concurrently, none of the reads depend on each other."""
+
+        reads = {
+            "old_token": lambda: self.rotation.current_value,
+            "new_token": lambda: self.rotation.pending_value,
+            "alb_values": self.modify_listener.get_token_values,
+        }
+        # Once cloudflare is checkpointed it already sends the new token, skip reading it.
+        # Otherwise the read also fetches the API key and the rules the cloudflare phase writes.
+        if "cloudflare" in remaining:
+            reads["cf_rules"] = self.token_refresh.get_rules
+
+        results = run_concurrently(lambda name: reads[name](), list(reads), len(reads))
+        for result in results:
+            if not result.success:
+                raise result.error
+        return {result.target: result.response for result in results}
+
+    def plan(self, remaining):
+        """Read the remote state the remaining phases depend on and plan their writes."""
+
+        state = self.read_state(remaining)
+        self.old_token = state["old_token"]
+        self.new_token = state["new_token"]
+
+        cf_targets = self.token_refresh.targets
+        if "cf_rules" in state:
+            self.cf_rules = state["cf_rules"]
+            cf_values = header_values(cf_targets, self.cf_rules)
+        else:
+            cf_values = {target: self.new_token for target in cf_targets}
+
+        plan = plan_set_secret(
+            self.old_token,
+            self.new_token,
+            self.modify_listener.targets,
+            state["alb_values"],
+            cf_targets,
+            cf_values,
+        )
+        if "alb_dual" not in remaining:
+            plan["alb_dual"] = []
+        return plan
+
+    def run(self):
+        """Run the remaining phases, saving a checkpoint after each one."""
+
+        remaining = self.remaining_phases()
+        if not remaining:
+            print("setSecret already completed for this version.")
+            return
+
+        plan = self.plan(remaining)
+        for phase in remaining:
+            # Stop before a phase rather than be killed half way through it
+            self.rotation.deadline.check(phase)
+            getattr(self, phase)(plan[phase])
+            self.store.save(self.rotation.arn, self.rotation.token, phase)
+
+    def check_results(self, results, message):
+        """Raise unless every target succeeded, keeping a DeadlineExceeded resumable."""
+
+        if report_results(results):
+            return
+        for result in results:
+            if isinstance(result.error, DeadlineExceeded):
+                raise result.error
+        raise RuntimeError(message)
+
+    def alb_dual(self, targets):
+        """Modify the token in the listener rules to accept both tokens."""
+
+        print(f"Modifying {len(targets)} ELB listener rules with two token values...")
+        results = self.modify_listener.modify_rule([self.old_token, self.new_token], targets)
+        self.check_results(results, "Rotation failed!")
+
+    def cloudflare(self, targets):
+        """Change the token in cloudflare."""
+
+        print(f"Rotating the token in {len(targets)} cloudflare rules...")
+        results = self.token_refresh.roll_token(self.new_token, targets, self.cf_rules)
+        self.check_results(results, "Rotation failed at Cloudflare!")
+
+    def alb_single(self, targets):
+        """Update the listener rules removing the old token."""
+
+        if targets and self.propagation is not None:
+            self.propagation.wait_for(self.new_token)
+
+        print(f"Updating {len(targets)} ELB listener rules with only the new token...")
+        results = self.modify_listener.modify_rule([self.new_token], targets)
+        self.check_results(results, "Rotation failed removing the old token!")
@@ -0,0 +1,151 @@
+"""Module to test a pending token against the protected hosts before it becomes current"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+from deadline import Deadline, DeadlineExceeded
+from targets import HEADER_NAME, run_concurrently
+
+# Protected URLs to probe in testSecret, comma separated, unset skips the test
+PROBE_URLS = [url.strip() for url in os.environ.get("PROBE_URLS", "").split(",") if url.strip()]
+PROBE_REQUESTS = int(os.environ.get("PROBE_REQUESTS", "20"))
+PROBE_CONCURRENCY = int(os.environ.get("PROBE_CONCURRENCY", "10"))
+# Share of probes per URL that must be accepted, and the slowest p99 latency tolerated
+PROBE_MIN_ACCEPTANCE = float(os.environ.get("PROBE_MIN_ACCEPTANCE", "1.0"))
+PROBE_MAX_P99_MS = float(os.environ.get("PROBE_MAX_P99_MS", "2000"))
+PROBE_TIMEOUT = (3.05, 5)
+
+
+class ProbeFailed(RuntimeError):
+    """The pending token was rejected too often or answered too slowly"""
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of values, None when there are none."""
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(int(len(values) * fraction + 0.5) - 1, 0))]
+
+
+@dataclass
+class ProbeReport:
+    """Outcome of the probes sent to one URL"""
+
+    url: str
+    sent: int = 0
+    accepted: int = 0
+    latencies: list = field(default_factory=list)
+    statuses: dict = field(default_factory=dict)
+
+    @property
+    def acceptance(self):
+        return self.accepted / self.sent if self.sent else 0.0
+
+    @property
+    def p50(self):
+        return percentile(self.latencies, 0.5)
+
+    @property
+    def p99(self):
+        return percentile(self.latencies, 0.99)
+
+    def __str__(self):
+        p50 = "n/a" if self.p50 is None else f"{self.p50:.1f} ms"
+        p99 = "n/a" if self.p99 is None else f"{self.p99:.1f} ms"
+        return (
+            f"{self.url} accepted {self.accepted}/{self.sent} "
+            f"p50 {p50} p99 {p99} statuses {self.statuses}"
+        )
+
+
+class ProbeHarness:
+    """Sends a burst of concurrent requests carrying the token to every protected URL"""
+
+    def __init__(
+        self,
+        urls=None,
+        header_name=HEADER_NAME,
+        requests_per_url=None,
+        concurrency=None,
+        min_acceptance=None,
+        max_p99_ms=None,
+        deadline=None,
+    ):
+        self.urls = PROBE_URLS if urls is None else urls
+        self.header_name = header_name
+        self.requests_per_url = requests_per_url or PROBE_REQUESTS
+        self.concurrency = concurrency or PROBE_CONCURRENCY
+        self.min_acceptance = PROBE_MIN_ACCEPTANCE if min_acceptance is None else min_acceptance
+        self.max_p99_ms = max_p99_ms or PROBE_MAX_P99_MS
+        self.deadline = deadline or Deadline()
+
+    def probe_url(self, session, url, token):
+        """Send the burst to one URL, stopping early once the acceptance threshold is out of reach."""
+
+        import requests
+
+        report = ProbeReport(url)
+        lock = threading.Lock()
+        allowed_rejections = int(self.requests_per_url * (1 - self.min_acceptance) + 1e-9)
+
+        def probe(_):
+            with lock:
+                if report.sent - report.accepted > allowed_rejections:
+                    return
+            start = time.perf_counter()
+            try:
+                response = session.get(
+                    url,
+                    headers={self.header_name: token},
+                    timeout=self.deadline.timeout(f"GET {url}", PROBE_TIMEOUT),
+                )
+                status = response.status_code
+            except requests.RequestException as error:
+                status = type(error).__name__
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                report.sent += 1
+                report.statuses[status] = report.statuses.get(status, 0) + 1
+                # Latency of every answer, failed connections only count against acceptance
+                if isinstance(status, int):
+                    report.latencies.append(elapsed)
+                    if status < 400:
+                        report.accepted += 1
+
+        results = run_concurrently(probe, range(self.requests_per_url), self.concurrency)
+        for result in results:
+            if isinstance(result.error, DeadlineExceeded):
+                raise result.error
+        return report
+
+    def run(self, token):
+        """Probe every URL and return a ProbeReport per URL."""
+
+        # Imported here, so a testSecret without URLs to probe starts without requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_maxsize=self.concurrency, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            return [self.probe_url(session, url, token) for url in self.urls]
+
+    def check(self, token):
+        """Probe every URL with the token and raise ProbeFailed on a regression."""
+
+        reports = self.run(token)
+        failures = []
+        for report in reports:
+            print(report)
+            if report.acceptance < self.min_acceptance:
+                failures.append(f"{report.url} accepted {report.acceptance:.0%} of probes")
+            elif report.p99 is not None and report.p99 > self.max_p99_ms:
+                failures.append(f"{report.url} p99 {report.p99:.1f} ms over {self.max_p99_ms:.0f} ms")
+        if failures:
+            raise ProbeFailed("testSecret failed: " + "; ".join(failures))
+        return reports
@@ -0,0 +1,102 @@
+"""Module to describe the rules a rotation updates and update them concurrently"""
+
+import contextvars
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+# Header carrying the token, checked by the listener rules and set by the transform rules
+HEADER_NAME = "X-ALB-SECRET"
+
+
+@dataclass(frozen=True)
+class CloudflareTarget:
+    """A Cloudflare transform rule that sets the token header"""
+
+    zone_id: str
+    ruleset_id: str
+    rule_id: str
+    # Name the rule sets the header under, discovered rules keep their own spelling
+    header_name: str = field(default=HEADER_NAME, compare=False)
+
+    def __str__(self):
+        return f"{self.zone_id}/{self.ruleset_id}/{self.rule_id}"
+
+
+@dataclass(frozen=True)
+class ListenerRuleTarget:
+    """An ALB listener rule that checks the token header, with the rest of its conditions"""
+
+    rule_arn: str
+    conditions: list = field(default_factory=list)
+    header_name: str = HEADER_NAME
+    # Role to assume when the load balancer is in another account
+    role_arn: str = None
+
+    @property
+    def region_name(self):
+        """Region of the listener rule, taken from its ARN."""
+
+        return self.rule_arn.split(":")[3]
+
+    def __str__(self):
+        return self.rule_arn
+
+
+@dataclass
+class TargetResult:
+    """Outcome of updating a single target"""
+
+    target: object
+    response: object = None
+    error: Exception = None
+    elapsed: float = 0.0
+
+    @property
+    def success(self):
+        """True when the target was updated."""
+
+        return self.error is None
+
+
+def report_results(results):
+    """Print the outcome of every target and return True when they all succeeded."""
+
+    for result in results:
+        outcome = "succeeded" if result.success else f"failed: {result.error}"
+        print(f"{result.target} {outcome} in {result.elapsed:.3f}s")
+    return all(result.success for result in results)
+
+
+def run_concurrently(func, targets, max_workers):
+    """Call func for every target on a bounded thread pool, returning results in target order."""
+
+    def run(target):
+        start = time.perf_counter()
+        try:
+            response = func(target)
+        except Exception as error:
+            return TargetResult(target, error=error, elapsed=time.perf_counter() - start)
+        return TargetResult(target, response=response, elapsed=time.perf_counter() - start)
+
+    targets = list(targets)
+    if len(targets) <= 1:
+        return [run(target) for target in targets]
+
+    # Each call runs in a copy of the caller's context, so metrics know the secret and step
+    contexts = [contextvars.copy_context() for _ in targets]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as executor:
+        return list(
+            executor.map(lambda context, target: context.run(run, target), contexts, targets)
+        )
+
+
+def load_targets(env_name, target_class, default):
+    """Read targets from a JSON list of objects in an environment variable."""
+
+    value = os.environ.get(env_name)
+    if not value:
+        return list(default)
+    return [target_class(**item) for item in json.loads(value)]
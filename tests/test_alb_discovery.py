@@ -0,0 +1,172 @@
+""" Tests for the listener rule discovery index. """
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+from moto import mock_ec2, mock_elbv2
+
+sys.path.append('.')
+
+import alb_discovery
+import aws_clients
+from alb_discovery import DiscoveryIndex
+from async_rotation import AsyncLoadbalancerHelper
+from deadline import Deadline, DeadlineExceeded
+from loadbalancer_helper import LoadbalancerHelper
+from targets import ListenerRuleTarget
+from test_loadbalancer_helper import create_listener_rule
+
+
+def add_rule(target, priority, conditions):
+    """Add a rule to the listener of an existing listener rule."""
+
+    client = boto3.client('elbv2', region_name=target.region_name)
+    rule = client.describe_rules(RuleArns=[target.rule_arn])['Rules'][0]
+    # A rule ARN is its listener's ARN with the rule ID appended
+    listener_arn = target.rule_arn.replace(':listener-rule/', ':listener/').rsplit('/', 1)[0]
+    return client.create_rule(
+        ListenerArn=listener_arn,
+        Priority=priority,
+        Conditions=conditions,
+        Actions=rule['Actions'],
+    )['Rules'][0]['RuleArn']
+
+
+@mock_ec2
+@mock_elbv2
+class DiscoveryIndexTestCase(unittest.TestCase):
+    """Tests for scanning, persisting and refreshing the index under moto."""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'index.json')
+        self.now = 1000.0
+
+    def tearDown(self):
+        aws_clients.reset_clients()
+
+    def index(self, regions):
+        """Index of the regions kept in the test's file, on the test's clock."""
+
+        return DiscoveryIndex(regions, self.path, ttl=60, clock=lambda: self.now)
+
+    def test_targets(self):
+        """Test rules checking the header are found in every region with their other conditions."""
+
+        first = create_listener_rule('ap-southeast-2', 'one.example.com')
+        second = create_listener_rule('us-east-1', 'two.example.com')
+        other_header = add_rule(
+            first,
+            2,
+            [
+                {
+                    'Field': 'http-header',
+                    'HttpHeaderConfig': {'HttpHeaderName': 'X-Other', 'Values': ['a']},
+                }
+            ],
+        )
+        add_rule(
+            first, 3, [{'Field': 'path-pattern', 'PathPatternConfig': {'Values': ['/open/*']}}]
+        )
+
+        index = self.index(['ap-southeast-2', 'us-east-1'])
+
+        self.assertEqual(index.targets(), [first, second])
+        self.assertEqual(
+            index.targets('x-other'),
+            [ListenerRuleTarget(other_header, [], header_name='X-Other')],
+        )
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_persisted_index(self):
+        """Test a fresh index is read from the file and only stale or new regions are rescanned."""
+
+        target = create_listener_rule('ap-southeast-2', 'one.example.com')
+        self.index(['ap-southeast-2']).refresh()
+
+        with patch('alb_discovery.scan_region', wraps=alb_discovery.scan_region) as scan_region:
+            self.assertEqual(self.index(['ap-southeast-2']).targets(), [target])
+            scan_region.assert_not_called()
+
+            second = create_listener_rule('us-east-1', 'two.example.com')
+            index = self.index(['ap-southeast-2', 'us-east-1'])
+            self.assertEqual(index.targets(), [target, second])
+            self.assertEqual([call.args[0] for call in scan_region.call_args_list], ['us-east-1'])
+
+            scan_region.reset_mock()
+            self.now += 60
+            index.targets()
+            self.assertEqual(
+                sorted(call.args[0] for call in scan_region.call_args_list),
+                ['ap-southeast-2', 'us-east-1'],
+            )
+
+    def test_failed_scan(self):
+        """Test a region failing to rescan keeps its rules and one never scanned raises."""
+
+        target = create_listener_rule('ap-southeast-2', 'one.example.com')
+        index = self.index(['ap-southeast-2'])
+        index.refresh()
+        self.now += 60
+
+        with patch('alb_discovery.scan_region', side_effect=RuntimeError('throttled')):
+            self.assertEqual(index.targets(), [target])
+            with self.assertRaises(RuntimeError):
+                self.index(['us-east-1']).targets()
+
+    def test_deadline(self):
+        """Test a scan stops at the deadline and the regions finished before it are kept."""
+
+        target = create_listener_rule('ap-southeast-2', 'one.example.com')
+        second = create_listener_rule('us-east-1', 'two.example.com')
+        with self.assertRaises(DeadlineExceeded):
+            self.index(['ap-southeast-2']).refresh(deadline=Deadline.after(0))
+
+        real_scan_region = alb_discovery.scan_region
+
+        def scan_region(region_name, deadline):
+            if region_name == 'us-east-1':
+                raise DeadlineExceeded('Stopping before describe_rules')
+            return real_scan_region(region_name, deadline)
+
+        with patch('alb_discovery.scan_region', side_effect=scan_region):
+            with self.assertRaises(DeadlineExceeded):
+                self.index(['ap-southeast-2', 'us-east-1']).refresh()
+
+        # The retry reads the finished region from the file and scans only the other one
+        with patch('alb_discovery.scan_region', wraps=alb_discovery.scan_region) as scan_region:
+            index = self.index(['ap-southeast-2', 'us-east-1'])
+            self.assertEqual(index.targets(deadline=Deadline.after(30)), [target, second])
+            self.assertEqual([call.args[0] for call in scan_region.call_args_list], ['us-east-1'])
+
+    def assert_deleted_rule_rescans(self, helper_class):
+        """Check a helper updates the discovered rules and rescans after a rule is deleted."""
+
+        target = create_listener_rule('ap-southeast-2', 'one.example.com')
+
+        with patch.object(alb_discovery.INDEX, 'regions', ['ap-southeast-2']), patch.object(
+            alb_discovery.INDEX, 'path', self.path
+        ), patch.object(alb_discovery.INDEX, 'entries', None):
+            helper = helper_class()
+            self.assertEqual(helper.targets, [target])
+            self.assertTrue(all(result.success for result in helper.modify_rule(['new_token'])))
+
+            boto3.client('elbv2', region_name='ap-southeast-2').delete_rule(
+                RuleArn=target.rule_arn
+            )
+            results = helper.modify_rule(['newer_token'])
+            self.assertFalse(results[0].success)
+            self.assertEqual(helper_class().targets, [])
+
+    def test_loadbalancer_helper(self):
+        """Test the helper updates the discovered rules and rescans after a rule is deleted."""
+
+        self.assert_deleted_rule_rescans(LoadbalancerHelper)
+
+    def test_async_loadbalancer_helper(self):
+        """Test the asyncio engine's helper also rescans after a discovered rule is deleted."""
+
+        self.assert_deleted_rule_rescans(AsyncLoadbalancerHelper)
@@ -0,0 +1,228 @@
+""" Tests for the asyncio rotation engine. """
+
+import asyncio
+import sys
+import threading
+import time
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+from moto import mock_ec2, mock_elbv2
+
+sys.path.append('.')
+
+import aws_clients
+from async_rotation import (
+    AsyncCloudflareHelper,
+    AsyncLoadbalancerHelper,
+    AsyncSetSecretStateMachine,
+    EVENT_LOOP,
+    gather_results,
+    read_secret_values,
+    run,
+)
+from cloudflare_helper import CloudflareAuthError, CloudflareRateLimitError, CF_MAX_RETRIES
+from cloudflare_standin import CloudflareStandin
+from deadline import Deadline, DeadlineExceeded
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+from test_loadbalancer_helper import create_listener_rule, header_values
+
+
+class AsyncCloudflareHelperTestCase(unittest.TestCase):
+    """Tests for the aiohttp cloudflare helper against the local stand-in."""
+
+    def setUp(self):
+        self.standin = CloudflareStandin().start()
+        self.addCleanup(self.standin.stop)
+        self.rate_limiter = TokenBucket(rate=1000, burst=1000)
+        self.targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(6)]
+        for target in self.targets:
+            self.standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+        self.cloudflare_helper = AsyncCloudflareHelper(
+            base_url=self.standin.base_url, targets=self.targets, rate_limiter=self.rate_limiter
+        )
+        self.cloudflare_helper.helper.get_api_key = Mock(return_value='dummy_secret')
+        sleep_patcher = patch('async_rotation.asyncio.sleep', side_effect=self.no_sleep)
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    async def no_sleep(self, delay):
+        """Replace asyncio.sleep so retries do not wait."""
+
+    def test_roll_token(self):
+        """Test every rule is updated concurrently with a result per target."""
+
+        self.standin.latency = 0.2
+
+        start = time.perf_counter()
+        results = self.cloudflare_helper.roll_token('dummy_token')
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.2 * len(self.targets) / 2)
+        self.assertEqual([result.target for result in results], self.targets)
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(self.standin.header_value('zone3', 'ruleset', 'rule'), 'dummy_token')
+        self.cloudflare_helper.helper.get_api_key.assert_called_once_with()
+
+    def test_get_token_values(self):
+        """Test the header values are read with one request per ruleset."""
+
+        self.cloudflare_helper.roll_token('dummy_token', self.targets[:2])
+        self.standin.requests.clear()
+
+        values = self.cloudflare_helper.get_token_values(self.targets[:3])
+
+        self.assertEqual(
+            values,
+            {self.targets[0]: 'dummy_token', self.targets[1]: 'dummy_token', self.targets[2]: None},
+        )
+        self.assertEqual(len(self.standin.requests), 3)
+
+    def test_retry_after(self):
+        """Test rate limits and server errors are retried honouring Retry-After."""
+
+        self.standin.scripted = [(429, {'Retry-After': '2'}), (503, {})]
+
+        results = self.cloudflare_helper.roll_token('dummy_token', self.targets[:1])
+
+        self.assertTrue(results[0].success)
+        # The ruleset read, then the write and its two retries
+        self.assertEqual(len(self.standin.requests), 4)
+        self.assertEqual(self.mock_sleep.call_args_list[0].args, (2.0,))
+        self.assertEqual(self.rate_limiter.metrics()['pauses'], 1)
+
+    def test_errors(self):
+        """Test rate limit and auth errors are reported per target."""
+
+        self.standin.scripted = [(429, {'Retry-After': '1'})] * (CF_MAX_RETRIES + 1) + [(403, {})]
+        self.cloudflare_helper.helper.targets = self.targets[:1]
+
+        first = self.cloudflare_helper.roll_token('dummy_token')
+        second = self.cloudflare_helper.roll_token('dummy_token')
+
+        self.assertIsInstance(first[0].error, CloudflareRateLimitError)
+        self.assertIsInstance(second[0].error, CloudflareAuthError)
+
+    def test_deadline(self):
+        """Test a request is not sent once the invocation is out of time."""
+
+        self.cloudflare_helper.helper.deadline = Deadline.after(0)
+
+        with self.assertRaises(DeadlineExceeded):
+            self.cloudflare_helper.roll_token('dummy_token', self.targets[:1])
+        self.assertEqual(self.standin.requests, [])
+
+
+class EventLoopTestCase(unittest.TestCase):
+    """Tests for the shared event loop."""
+
+    def test_gather_results(self):
+        """Test results keep the target order and capture errors within the concurrency limit."""
+
+        in_flight = []
+
+        async def func(target):
+            in_flight.append(target)
+            await asyncio.sleep(0.01)
+            self.assertLessEqual(len(in_flight), 2)
+            in_flight.remove(target)
+            if target == 3:
+                raise ValueError(target)
+            return target * 2
+
+        results = run(gather_results(func, [1, 2, 3, 4], 2))
+
+        self.assertEqual([result.response for result in results], [2, 4, None, 8])
+        self.assertIsInstance(results[2].error, ValueError)
+
+    def test_run_from_threads(self):
+        """Test synchronous callers on many threads share the one loop."""
+
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        loops = []
+        threads = [
+            threading.Thread(target=lambda: loops.append(run(current_loop()))) for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(set(loops), {EVENT_LOOP.loop})
+
+    def test_run_on_loop_thread(self):
+        """Test blocking on the loop from its own thread is refused."""
+
+        async def nested():
+            run(asyncio.sleep(0))
+
+        with self.assertRaises(RuntimeError):
+            run(nested())
+
+
+class AsyncSetSecretStateMachineTestCase(unittest.TestCase):
+    """Tests for the reads of the asyncio engine's set secret state machine."""
+
+    def setUp(self):
+        self.rotation = Mock(current_value='old_token', pending_value='new_token')
+        self.modify_listener = Mock()
+        self.modify_listener.get_token_values_async = AsyncMock(return_value={'rule': ['old_token']})
+        self.token_refresh = Mock()
+        self.token_refresh.get_rules_async = AsyncMock(return_value={'target': {}})
+        self.state_machine = AsyncSetSecretStateMachine(
+            self.rotation, Mock(), self.modify_listener, self.token_refresh
+        )
+
+    def test_read_secret_values(self):
+        """Test both tokens are read."""
+
+        self.assertEqual(run(read_secret_values(self.rotation)), ('old_token', 'new_token'))
+
+    def test_read_state(self):
+        """Test the tokens and the remote state are read on the event loop."""
+
+        self.assertEqual(
+            self.state_machine.read_state(['alb_dual', 'cloudflare', 'alb_single']),
+            {
+                'old_token': 'old_token',
+                'new_token': 'new_token',
+                'alb_values': {'rule': ['old_token']},
+                'cf_rules': {'target': {}},
+            },
+        )
+
+        state = self.state_machine.read_state(['alb_single'])
+
+        self.assertNotIn('cf_rules', state)
+        self.token_refresh.get_rules_async.assert_awaited_once_with()
+
+
+@mock_ec2
+@mock_elbv2
+class AsyncLoadbalancerHelperTestCase(unittest.TestCase):
+    """Tests for the asyncio listener rule updater under moto."""
+
+    def tearDown(self):
+        aws_clients.reset_clients()
+
+    def test_modify_rule(self):
+        """Test every listener rule is updated and read back."""
+
+        targets = [
+            create_listener_rule('ap-southeast-2', 'one.example.com'),
+            create_listener_rule('us-east-1', 'two.example.com'),
+        ]
+        loadbalancer_helper = AsyncLoadbalancerHelper(targets=targets)
+
+        results = loadbalancer_helper.modify_rule(['old_token', 'new_token'])
+
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(header_values(targets[1]), ['old_token', 'new_token'])
+        self.assertEqual(
+            loadbalancer_helper.get_token_values(),
+            {target.rule_arn: ['old_token', 'new_token'] for target in targets},
+        )
+
@@ -0,0 +1,58 @@
+""" Tests for the shared aws client registry. """
+
+import sys
+import unittest
+
+import boto3
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+import aws_clients
+
+
+class AwsClientsTestCase(unittest.TestCase):
+    """Tests for the shared aws client registry."""
+
+    def tearDown(self):
+        aws_clients.reset_clients()
+
+    def test_get_client_is_reused(self):
+        """Test the same client is returned for the same service and region."""
+
+        client = aws_clients.get_client('secretsmanager', 'ap-southeast-2')
+
+        self.assertIs(aws_clients.get_client('secretsmanager', 'ap-southeast-2'), client)
+        self.assertIsNot(aws_clients.get_client('secretsmanager', 'us-east-1'), client)
+        self.assertIsNot(aws_clients.get_client('elbv2', 'ap-southeast-2'), client)
+
+    @mock_secretsmanager
+    def test_set_client(self):
+        """Test an injected moto client is used by the helpers."""
+
+        from get_curent_token import GetToken
+
+        mocked_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        mocked_client.create_secret(Name='cf-alb-token', SecretString='current')
+        aws_clients.set_client('secretsmanager', mocked_client)
+
+        self.assertIs(aws_clients.get_client('secretsmanager'), mocked_client)
+        self.assertEqual(GetToken.get_token(), 'current')
+
+    def test_deadline_client(self):
+        """Test a client created for a deadline has its timeouts and attempts."""
+
+        client = aws_clients.get_client('secretsmanager', timeouts=(2.0, 2.0, 1))
+
+        self.assertEqual(client.meta.config.connect_timeout, 2.0)
+        self.assertEqual(client.meta.config.read_timeout, 2.0)
+        self.assertEqual(client.meta.config.retries['total_max_attempts'], 1)
+        self.assertIsNot(aws_clients.get_client('secretsmanager'), client)
+
+    def test_reset_clients(self):
+        """Test reset drops every registered client."""
+
+        client = aws_clients.get_client('secretsmanager')
+        aws_clients.reset_clients()
+
+        self.assertIsNot(aws_clients.get_client('secretsmanager'), client)
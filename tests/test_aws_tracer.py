@@ -0,0 +1,135 @@
+""" Tests for the AWS API call tracer. """
+
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from botocore.awsrequest import AWSResponse
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+import aws_clients
+from aws_tracer import TRACER, body_size
+
+SECRET_ID = 'cf-alb-token'
+
+
+class RawResponse:
+    """Raw HTTP response body for a botocore AWSResponse."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self):
+        yield self.body
+
+
+class AwsTracerTestCase(unittest.TestCase):
+    """Tests for the spans and summary of the AWS API calls."""
+
+    def setUp(self):
+        self.trace_file = os.path.join(tempfile.mkdtemp(), 'spans.jsonl')
+        for name, value in (('enabled', True), ('trace_file', self.trace_file)):
+            patcher = patch.object(TRACER, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Clients only carry the tracer when created while it is on
+        aws_clients.reset_clients()
+        self.addCleanup(aws_clients.reset_clients)
+
+    def invoke(self, func):
+        """Run func as one traced invocation, returning the printed report."""
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            with TRACER.invocation():
+                func()
+        return output.getvalue()
+
+    @mock_secretsmanager
+    def test_invocation_summary(self):
+        """Test every call is summarised per operation and exported as a span."""
+
+        client = aws_clients.get_client('secretsmanager', 'ap-southeast-2')
+
+        def rotate():
+            client.create_secret(Name=SECRET_ID, SecretString='token')
+            client.get_secret_value(SecretId=SECRET_ID)
+            client.get_secret_value(SecretId=SECRET_ID)
+            with self.assertRaises(client.exceptions.ResourceNotFoundException):
+                client.describe_secret(SecretId='missing')
+
+        report = self.invoke(rotate)
+
+        summary = TRACER.summary()
+        self.assertEqual(
+            set(summary),
+            {
+                'secretsmanager.CreateSecret',
+                'secretsmanager.GetSecretValue',
+                'secretsmanager.DescribeSecret',
+            },
+        )
+        get_secret_value = summary['secretsmanager.GetSecretValue']
+        self.assertEqual((get_secret_value['calls'], get_secret_value['attempts']), (2, 2))
+        self.assertGreater(get_secret_value['request_bytes'], 0)
+        self.assertGreater(get_secret_value['response_bytes'], 0)
+        self.assertEqual(summary['secretsmanager.DescribeSecret']['errors'], 1)
+        self.assertIn('secretsmanager.GetSecretValue: 2 calls, 2 attempts', report)
+
+        with open(self.trace_file, encoding='utf-8') as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        self.assertEqual(len(spans), 4)
+        self.assertEqual(spans[-1]['error'], 'ResourceNotFoundException')
+        self.assertEqual({span['invocation_id'] for span in spans}, {TRACER.invocation_id})
+        self.assertEqual(spans[0]['region'], 'ap-southeast-2')
+
+    @patch('botocore.endpoint.time.sleep')
+    @patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing'})
+    def test_throttling_retries(self, mock_sleep):
+        """Test the attempts and throttling errors botocore retried quietly are counted."""
+
+        client = aws_clients.get_client('secretsmanager', 'ap-southeast-2')
+        responses = [
+            (400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'}),
+            (200, {'SecretList': []}),
+        ]
+
+        def respond(request, **kwargs):
+            status, body = responses.pop(0)
+            return AWSResponse(request.url, status, {}, RawResponse(json.dumps(body).encode()))
+
+        client.meta.events.register('before-send', respond)
+
+        self.invoke(client.list_secrets)
+
+        list_secrets = TRACER.summary()['secretsmanager.ListSecrets']
+        self.assertEqual(list_secrets['attempts'], 2)
+        self.assertEqual(list_secrets['throttles'], 1)
+        self.assertEqual(list_secrets['errors'], 0)
+        mock_sleep.assert_called_once()
+
+    def test_disabled(self):
+        """Test clients created while tracing is off record nothing."""
+
+        TRACER.enabled = False
+        aws_clients.reset_clients()
+        with mock_secretsmanager():
+            client = aws_clients.get_client('secretsmanager', 'ap-southeast-2')
+            TRACER.spans = []
+            client.list_secrets()
+
+        self.assertEqual(TRACER.spans, [])
+
+    def test_body_size(self):
+        """Test JSON, query protocol and empty bodies are measured."""
+
+        self.assertEqual(body_size(b'{"a": 1}'), 8)
+        self.assertEqual(body_size({'Action': 'ModifyRule', 'Version': '2015-12-01'}), 36)
+        self.assertEqual(body_size(None), 0)
@@ -0,0 +1,163 @@
+""" Tests for the Cloudflare transform rule discovery index. """
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path.append('.')
+
+import cloudflare_discovery
+from cloudflare_discovery import CloudflareDiscoveryIndex
+from cloudflare_helper import CloudflareAuthError, CloudflareHelper
+from cloudflare_standin import CloudflareStandin
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+
+class CloudflareDiscoveryTestCase(unittest.TestCase):
+    """Tests for scanning, persisting and revalidating the index against the local stand-in."""
+
+    def setUp(self):
+        self.standin = CloudflareStandin().start()
+        self.addCleanup(self.standin.stop)
+        self.path = os.path.join(tempfile.mkdtemp(), 'index.json')
+        self.now = 1000.0
+        api_key_patcher = patch(
+            'cloudflare_helper.CloudflareHelper.get_api_key', return_value='dummy_secret'
+        )
+        api_key_patcher.start()
+        self.addCleanup(api_key_patcher.stop)
+        # Two zones per page, so three zones take two pages
+        page_patcher = patch('cloudflare_discovery.ZONES_PER_PAGE', 2)
+        page_patcher.start()
+        self.addCleanup(page_patcher.stop)
+
+        self.standin.add_rule('zone1', 'transform1', 'rule1', token='old_token')
+        self.standin.add_rule('zone1', 'transform1', 'other', token='a', header_name='X-Other')
+        self.standin.add_rule('zone2', 'transform2', 'rule2', token='t', header_name='x-alb-secret')
+        self.standin.add_rule('zone3', 'firewall3', 'rule3', token='old_token')
+        self.standin.rulesets[('zone3', 'firewall3')]['phase'] = 'http_request_firewall_custom'
+        self.helper = CloudflareHelper(
+            base_url=self.standin.base_url,
+            targets=[],
+            rate_limiter=TokenBucket(rate=100, burst=100),
+        )
+
+    def index(self):
+        """Index kept in the test's file, on the test's clock."""
+
+        return CloudflareDiscoveryIndex(True, self.path, ttl=60, clock=lambda: self.now)
+
+    def ruleset_downloads(self):
+        """Paths of the rulesets downloaded so far."""
+
+        return [
+            path
+            for method, path in self.standin.requests
+            if method == 'GET' and path.rsplit('/', 2)[-2] == 'rulesets'
+        ]
+
+    def test_targets(self):
+        """Test every zone is listed and the transform rules setting the header are found."""
+
+        targets = self.index().targets(self.helper, 'X-ALB-SECRET')
+
+        self.assertEqual(
+            targets,
+            [
+                CloudflareTarget('zone1', 'transform1', 'rule1'),
+                CloudflareTarget('zone2', 'transform2', 'rule2'),
+            ],
+        )
+        zone_pages = [path for _, path in self.standin.requests if '/zones?' in path]
+        self.assertEqual(len(zone_pages), 2)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_revalidation(self):
+        """Test the persisted index is reused and only changed rulesets are downloaded again."""
+
+        self.index().refresh(self.helper)
+        self.assertEqual(len(self.ruleset_downloads()), 2)
+
+        self.standin.requests.clear()
+        index = self.index()
+        index.targets(self.helper, 'X-ALB-SECRET')
+        self.assertEqual(self.standin.requests, [])
+
+        self.now += 60
+        self.standin.add_rule('zone1', 'transform1', 'rule4', token='old_token')
+        self.assertIn(
+            CloudflareTarget('zone1', 'transform1', 'rule4'),
+            index.targets(self.helper, 'X-ALB-SECRET'),
+        )
+        self.assertEqual(
+            self.ruleset_downloads(), ['/client/v4/zones/zone1/rulesets/transform1']
+        )
+
+        # A cached version out of step with the listing is revalidated with its ETag
+        self.standin.requests.clear()
+        cached = index.entries['zones']['zone2']['transform2']
+        cached.update(version='unknown', rules=[])
+        index.refresh(self.helper, force=True)
+        self.assertEqual(len(self.ruleset_downloads()), 1)
+        # The 304 kept the cached rules
+        self.assertEqual(index.entries['zones']['zone2']['transform2'], dict(cached, version='1'))
+
+    def test_failed_scan(self):
+        """Test a failed revalidation keeps the index and a failed first scan raises."""
+
+        index = self.index()
+        index.refresh(self.helper)
+        self.standin.api_keys = {'other'}
+
+        index.refresh(self.helper, force=True)
+        self.assertEqual(len(index.targets(self.helper, 'X-ALB-SECRET')), 2)
+        with self.assertRaises(CloudflareAuthError):
+            CloudflareDiscoveryIndex(True, f'{self.path}.new').refresh(self.helper)
+
+    def discovered_helper(self):
+        """Helper reading its targets from the shared index kept in the test's file."""
+
+        with patch.object(cloudflare_discovery.INDEX, 'enabled', True), patch.object(
+            cloudflare_discovery.INDEX, 'path', self.path
+        ), patch.object(cloudflare_discovery.INDEX, 'entries', None):
+            return CloudflareHelper(
+                base_url=self.standin.base_url, rate_limiter=TokenBucket(rate=100, burst=100)
+            )
+
+    def test_cloudflare_helper(self):
+        """Test the helper rolls the token of every discovered rule."""
+
+        results = self.discovered_helper().roll_token('new_token')
+
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(result.success for result in results))
+        self.assertEqual(self.standin.header_value('zone1', 'transform1', 'rule1'), 'new_token')
+        self.assertEqual(self.standin.header_value('zone3', 'firewall3', 'rule3'), 'old_token')
+
+    def test_rolled_rule_is_kept(self):
+        """Test a rolled rule keeps its state and other headers, under its own header spelling."""
+
+        rule = self.standin.rules[('zone2', 'transform2', 'rule2')]
+        rule.update(enabled=False, description='edge secret', expression='http.host eq "a"')
+        rule['action_parameters']['headers']['X-Other'] = {'operation': 'set', 'value': 'kept'}
+        helper = self.discovered_helper()
+
+        self.assertTrue(all(result.success for result in helper.roll_token('new_token')))
+
+        rule = self.standin.rules[('zone2', 'transform2', 'rule2')]
+        self.assertFalse(rule['enabled'])
+        self.assertEqual(rule['description'], 'edge secret')
+        self.assertEqual(rule['expression'], 'http.host eq "a"')
+        self.assertEqual(
+            rule['action_parameters']['headers'],
+            {
+                'x-alb-secret': {'operation': 'set', 'value': 'new_token'},
+                'X-Other': {'operation': 'set', 'value': 'kept'},
+            },
+        )
+        # The value is read back under the same spelling, so a retry sees the rule as done
+        values = helper.get_token_values()
+        self.assertEqual(values[CloudflareTarget('zone2', 'transform2', 'rule2')], 'new_token')
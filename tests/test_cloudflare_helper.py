@@ -1,6 +1,8 @@
 """ Tests for cloudflare helper. """
 
 import sys
+import threading
+import time
 import unittest
 from unittest.mock import Mock, patch
 
@@ -9,26 +11,52 @@ from moto import mock_secretsmanager
 
 sys.path.append(".")
 
-from cloudflare_helper import CloudFlareHelper
+import aws_clients
+from cloudflare_helper import (
+    API_KEY_CACHE,
+    CF_BACKOFF_MAX,
+    CF_MAX_RETRIES,
+    CF_RULE_ID,
+    CF_TARGETS,
+    CF_RULSET_ID,
+    CF_ZONE_ID,
+    ApiKeyCache,
+    CloudflareAPIError,
+    CloudflareAuthError,
+    CloudflareConnectionError,
+    CloudflareHelper,
+    CloudflareRateLimitError,
+    CloudflareRuleNotFoundError,
+    attempt_delay,
+    retry_delay,
+)
+from cloudflare_standin import CloudflareStandin
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
 
 
 class CloudflareHelperTestCase(unittest.TestCase):
     """Tests for cloudflare helper."""
 
+    def tearDown(self):
+        aws_clients.reset_clients()
+        API_KEY_CACHE.invalidate()
+
     # Using moto to mock the secret manager
     @mock_secretsmanager
     def test_get_api_key(self):
         """Test for get api key function from secret manager."""
 
-        cloudflare_helper = CloudFlareHelper()
+        cloudflare_helper = CloudflareHelper()
         region_name = 'ap-southeast-2'
         session = boto3.session.Session()
         mockedClient = session.client(
             service_name='secretsmanager', region_name=region_name
         )
+        aws_clients.set_client('secretsmanager', mockedClient, region_name)
 
         mockedClient.create_secret(
-            Name='nzh-cf-access-token-to-modify-transform-rules',
+            Name='cf-access-token-to-modify-transform-rules',
             SecretString='dummysecret',
         )
         secret = cloudflare_helper.get_api_key()
@@ -36,7 +64,7 @@ class CloudflareHelperTestCase(unittest.TestCase):
         assert secret == 'dummysecret'
 
     # patch the get_api_key method and requests.patch method
-    @patch('cloudflare_helper.CloudFlareHelper.get_api_key')
+    @patch('cloudflare_helper.CloudflareHelper.get_api_key')
     @patch('cloudflare_helper.requests.patch')
     def test_roll_token(self, mock_patch, mock_get_api_key):
         """Test for roll token function in cloudflare Http Header modification rule."""
@@ -44,7 +72,7 @@ class CloudflareHelperTestCase(unittest.TestCase):
         cf_api_key = 'dummy_secret'
         token = 'dummy_token'
 
-        cloudflare_helper = CloudFlareHelper()
+        cloudflare_helper = CloudflareHelper()
         cloudflare_helper.roll_token = Mock(return_value=True)
 
         mock_get_api_key.return_value = cf_api_key
@@ -83,3 +111,212 @@ class CloudflareHelperTestCase(unittest.TestCase):
         }
 
         self.assertEqual(cloudflare_helper.roll_token(token), True)
+
+
+class CloudflareRequestTestCase(unittest.TestCase):
+    """Tests for the pooled cloudflare api requests against the local stand-in."""
+
+    def setUp(self):
+        self.standin = CloudflareStandin().start()
+        self.addCleanup(self.standin.stop)
+        self.standin.add_rule(CF_ZONE_ID, CF_RULSET_ID, CF_RULE_ID, token='old_token')
+        self.rate_limiter = TokenBucket(rate=100, burst=100)
+        self.cloudflare_helper = CloudflareHelper(
+            base_url=self.standin.base_url, rate_limiter=self.rate_limiter
+        )
+        self.cloudflare_helper.get_api_key = Mock(return_value='dummy_secret')
+        sleep_patcher = patch('cloudflare_helper.time.sleep')
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_roll_token(self):
+        """Test roll token updates the rule header value."""
+
+        results = self.cloudflare_helper.roll_token('dummy_token')
+
+        self.assertTrue(results[0].success)
+        self.assertTrue(results[0].response.json()['success'])
+        self.assertEqual(
+            self.standin.header_value(CF_ZONE_ID, CF_RULSET_ID, CF_RULE_ID),
+            'dummy_token',
+        )
+
+    def test_roll_token_keeps_rule(self):
+        """Test a configured rule keeps its state and other headers, only the token changes."""
+
+        rule = self.standin.rules[(CF_ZONE_ID, CF_RULSET_ID, CF_RULE_ID)]
+        rule.update(enabled=False, description='edge secret', expression='http.host eq "a"')
+        rule['action_parameters']['headers']['X-Other'] = {'operation': 'set', 'value': 'kept'}
+
+        self.assertTrue(self.cloudflare_helper.roll_token('dummy_token')[0].success)
+
+        rule = self.standin.rules[(CF_ZONE_ID, CF_RULSET_ID, CF_RULE_ID)]
+        self.assertFalse(rule['enabled'])
+        self.assertEqual(rule['description'], 'edge secret')
+        self.assertEqual(rule['expression'], 'http.host eq "a"')
+        self.assertEqual(
+            rule['action_parameters']['headers'],
+            {
+                'X-ALB-SECRET': {'operation': 'set', 'value': 'dummy_token'},
+                'X-Other': {'operation': 'set', 'value': 'kept'},
+            },
+        )
+
+    def test_missing_rule(self):
+        """Test a configured rule missing from its ruleset fails instead of being created."""
+
+        targets = [CloudflareTarget(CF_ZONE_ID, CF_RULSET_ID, 'gone')]
+
+        results = self.cloudflare_helper.roll_token('dummy_token', targets)
+
+        self.assertIsInstance(results[0].error, CloudflareRuleNotFoundError)
+        self.assertNotIn('PATCH', [method for method, _ in self.standin.requests])
+
+    def test_retry_after(self):
+        """Test rate limits and server errors are retried honouring Retry-After."""
+
+        self.standin.scripted = [(429, {'Retry-After': '2'}), (503, {})]
+
+        results = self.cloudflare_helper.roll_token('dummy_token')
+
+        self.assertEqual(results[0].response.status_code, 200)
+        # The ruleset read, then the write and its two retries
+        self.assertEqual(len(self.standin.requests), 4)
+        self.assertEqual(self.mock_sleep.call_args_list[0].args, (2.0,))
+
+    def test_retry_after_pauses_rate_limiter(self):
+        """Test a 429 holds back every request sharing the rate limiter."""
+
+        self.standin.scripted = [(429, {'Retry-After': '2'})]
+
+        self.cloudflare_helper.update_rule('dummy_token', CF_TARGETS[0], 'key')
+
+        metrics = self.rate_limiter.metrics()
+        # The ruleset read, the rate limited write and its retry
+        self.assertEqual(metrics['acquired'], 3)
+        self.assertEqual(metrics['pauses'], 1)
+
+    def test_rate_limit_error(self):
+        """Test a request still rate limited after every retry raises."""
+
+        self.standin.scripted = [(429, {'Retry-After': '1'})] * (CF_MAX_RETRIES + 1)
+
+        with self.assertRaises(CloudflareRateLimitError) as raised:
+            self.cloudflare_helper.update_rule('dummy_token', CF_TARGETS[0], 'key')
+        self.assertEqual(raised.exception.status_code, 429)
+
+    def test_api_error(self):
+        """Test a client error is reported without retrying."""
+
+        self.standin.scripted = [(400, {})]
+
+        results = self.cloudflare_helper.roll_token('dummy_token')
+
+        self.assertFalse(results[0].success)
+        self.assertIsInstance(results[0].error, CloudflareAPIError)
+        self.assertEqual(results[0].error.status_code, 400)
+        self.assertEqual([method for method, _ in self.standin.requests], ['GET', 'PATCH'])
+
+    def test_roll_token_targets(self):
+        """Test every target is updated concurrently with a result per target."""
+
+        self.standin.latency = 0.2
+        self.standin.scripted = [(400, {})]
+        targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(6)]
+        for target in targets:
+            self.standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+
+        start = time.perf_counter()
+        results = self.cloudflare_helper.roll_token('dummy_token', targets)
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.2 * len(targets) / 2)
+        self.assertEqual([result.target for result in results], targets)
+        self.assertEqual(sum(not result.success for result in results), 1)
+        self.cloudflare_helper.get_api_key.assert_called_once_with()
+
+    def test_auth_error_invalidates_api_key(self):
+        """Test a rejected API key is dropped from the cache."""
+
+        API_KEY_CACHE.get(lambda: 'revoked_secret')
+        self.standin.scripted = [(403, {})]
+
+        results = self.cloudflare_helper.roll_token('dummy_token')
+
+        self.assertIsInstance(results[0].error, CloudflareAuthError)
+        self.assertIsNone(API_KEY_CACHE.value)
+
+    def test_retry_delay(self):
+        """Test the backoff is jittered and capped."""
+
+        self.assertEqual(retry_delay(0, '3'), 3.0)
+        for attempt in range(10):
+            self.assertLessEqual(retry_delay(attempt), CF_BACKOFF_MAX)
+
+    def test_attempt_delay(self):
+        """Test the retry decisions shared by both engines."""
+
+        call = Mock()
+        rate_limiter = Mock()
+        response = Mock(status_code=503, headers={'Retry-After': '2'})
+
+        self.assertEqual(attempt_delay(call, rate_limiter, 0, response), 2.0)
+        self.assertIsNone(attempt_delay(call, rate_limiter, CF_MAX_RETRIES, response))
+        response.status_code = 429
+        with self.assertRaises(CloudflareRateLimitError):
+            attempt_delay(call, rate_limiter, CF_MAX_RETRIES, response)
+        response.status_code = 200
+        self.assertIsNone(attempt_delay(call, rate_limiter, 0, response))
+        self.assertEqual(call.status, 200)
+        rate_limiter.update_from_headers.assert_called_with(response.headers)
+
+        error = OSError('reset')
+        self.assertLessEqual(attempt_delay(call, rate_limiter, 0, error=error), CF_BACKOFF_MAX)
+        with self.assertRaises(CloudflareConnectionError):
+            attempt_delay(call, rate_limiter, CF_MAX_RETRIES, error=error)
+
+
+class ApiKeyCacheTestCase(unittest.TestCase):
+    """Tests for the cloudflare api key cache."""
+
+    def test_get_is_cached(self):
+        """Test the loader is only called once within the ttl."""
+
+        loader = Mock(return_value='key')
+        cache = ApiKeyCache(ttl=60, refresh_ahead=0)
+
+        self.assertEqual(cache.get(loader), 'key')
+        self.assertEqual(cache.get(loader), 'key')
+        self.assertEqual(loader.call_count, 1)
+
+    def test_expired_key_is_reloaded(self):
+        """Test an expired or invalidated key is fetched again."""
+
+        loader = Mock(side_effect=['old_key', 'new_key', 'newer_key'])
+        cache = ApiKeyCache(ttl=0, refresh_ahead=0)
+
+        self.assertEqual(cache.get(loader), 'old_key')
+        self.assertEqual(cache.get(loader), 'new_key')
+        cache.ttl = 60
+        cache.invalidate()
+        self.assertEqual(cache.get(loader), 'newer_key')
+
+    def test_refresh_ahead(self):
+        """Test a key close to expiry is served while it refreshes in the background."""
+
+        refreshed = threading.Event()
+
+        def loader():
+            if cache.value is not None:
+                refreshed.set()
+                return 'new_key'
+            return 'old_key'
+
+        cache = ApiKeyCache(ttl=60, refresh_ahead=60)
+
+        self.assertEqual(cache.get(loader), 'old_key')
+        self.assertEqual(cache.get(loader), 'old_key')
+        self.assertTrue(refreshed.wait(5))
+        while cache.refreshing:
+            time.sleep(0.01)
+        self.assertEqual(cache.value, 'new_key')
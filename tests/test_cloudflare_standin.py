@@ -0,0 +1,196 @@
+""" Tests for the local Cloudflare API stand-in. """
+
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+
+sys.path.append('.')
+
+from cloudflare_helper import CloudflareAPIError, CloudflareHelper
+from cloudflare_standin import CloudflareStandin
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+
+class FakeClock:
+    """Clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class CloudflareStandinTestCase(unittest.TestCase):
+    """Tests for the stand-in endpoints."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.standin = CloudflareStandin(clock=self.clock).start()
+        self.addCleanup(self.standin.stop)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer key'
+        self.addCleanup(self.session.close)
+
+    def get(self, path, **kwargs):
+        """GET a stand-in API path."""
+
+        return self.session.get(f'{self.standin.base_url}{path}', **kwargs)
+
+    def test_list_zones(self):
+        """Test zones are listed a page at a time."""
+
+        for index in range(5):
+            self.standin.add_zone(f'zone{index}')
+
+        first = self.get('/zones', params={'per_page': 2}).json()
+        last = self.get('/zones', params={'per_page': 2, 'page': 3}).json()
+
+        self.assertEqual([zone['id'] for zone in first['result']], ['zone0', 'zone1'])
+        self.assertEqual(first['result_info']['total_pages'], 3)
+        self.assertEqual([zone['id'] for zone in last['result']], ['zone4'])
+        self.assertEqual(last['result_info']['total_count'], 5)
+
+    def test_put_then_patch(self):
+        """Test PUT replaces the rules of a ruleset and PATCH updates one, bumping its version."""
+
+        response = self.session.put(
+            f'{self.standin.base_url}/zones/zone/rulesets/ruleset',
+            json={'rules': [{'id': 'first', 'action': 'rewrite'}, {'action': 'rewrite'}]},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['result']['rules']), 2)
+
+        cloudflare_helper = CloudflareHelper(
+            base_url=self.standin.base_url, rate_limiter=TokenBucket(rate=100, burst=100)
+        )
+        cloudflare_helper.update_rule('token', CloudflareTarget('zone', 'ruleset', 'first'), 'key')
+
+        ruleset = self.get('/zones/zone/rulesets/ruleset').json()['result']
+        self.assertEqual(ruleset['version'], '2')
+        self.assertEqual(self.standin.header_value('zone', 'ruleset', 'first'), 'token')
+        rulesets = self.get('/zones/zone/rulesets').json()['result']
+        self.assertEqual([ruleset['phase'] for ruleset in rulesets], ['http_request_late_transform'])
+
+    def test_ruleset_etag(self):
+        """Test a ruleset is answered with a 304 while its ETag still matches."""
+
+        self.standin.add_rule('zone', 'ruleset', 'rule', token='old_token')
+        etag = self.get('/zones/zone/rulesets/ruleset').headers['ETag']
+
+        response = self.get('/zones/zone/rulesets/ruleset', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        self.standin.add_rule('zone', 'ruleset', 'rule', token='new_token')
+        response = self.get('/zones/zone/rulesets/ruleset', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_unknown_path(self):
+        """Test unknown paths and methods are answered with a 404."""
+
+        self.assertEqual(self.get('/zones/zone/rules').status_code, 404)
+        self.assertEqual(self.get('/zones/missing/rulesets').status_code, 404)
+        response = self.session.patch(f'{self.standin.base_url}/zones/zone/rulesets/ruleset', json={})
+        self.assertEqual(response.status_code, 404)
+
+    def test_api_keys(self):
+        """Test only the configured API keys are accepted."""
+
+        self.standin.api_keys = {'other'}
+
+        self.assertEqual(self.get('/zones').status_code, 403)
+        self.assertEqual(requests.get(f'{self.standin.base_url}/zones').status_code, 401)
+
+    def test_rate_limit_per_token(self):
+        """Test each token is rate limited in its own window with Retry-After."""
+
+        self.standin.rate_limit = 2
+        self.standin.rate_limit_window = 60
+
+        statuses = [self.get('/zones').status_code for _ in range(3)]
+        other = self.get('/zones', headers={'Authorization': 'Bearer other'})
+        self.clock.now += 45
+        limited = self.get('/zones')
+        self.clock.now += 15
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(limited.headers['Retry-After'], '15')
+        self.assertEqual(other.headers['Ratelimit'], '"default";r=1;t=60')
+        self.assertEqual(self.get('/zones').status_code, 200)
+
+    def test_error_rate(self):
+        """Test a share of the requests fail with a server error."""
+
+        self.standin.error_rate = 0.5
+        self.standin.random.seed(1)
+
+        statuses = [self.get('/zones').status_code for _ in range(40)]
+
+        self.assertIn(500, statuses)
+        self.assertIn(200, statuses)
+
+
+class CloudflareHelperStandinTestCase(unittest.TestCase):
+    """Tests for the cloudflare helper HTTP paths against the stand-in."""
+
+    def setUp(self):
+        # The stand-in, the rate limiter and the patched sleep share a clock
+        self.clock = FakeClock()
+        self.standin = CloudflareStandin(seed=1, clock=self.clock).start()
+        self.addCleanup(self.standin.stop)
+        self.rate_limiter = TokenBucket(rate=1000, burst=1000, clock=self.clock)
+        self.cloudflare_helper = CloudflareHelper(
+            base_url=self.standin.base_url, rate_limiter=self.rate_limiter
+        )
+        self.cloudflare_helper.get_api_key = Mock(return_value='dummy_secret')
+        sleep_patcher = patch('cloudflare_helper.time.sleep', side_effect=self.sleep)
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        self.targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(8)]
+        self.rules = {
+            target: self.standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+            for target in self.targets
+        }
+
+    def sleep(self, seconds):
+        """Advance the clock instead of sleeping."""
+
+        self.clock.now += seconds
+
+    def test_error_rate_retried(self):
+        """Test a server error is retried until the rule is updated."""
+
+        # The seeded stand-in fails the first request and accepts the second
+        self.standin.error_rate = 0.5
+
+        self.cloudflare_helper.update_rule('dummy_token', self.targets[0], 'key', self.rules)
+
+        self.assertEqual(len(self.standin.requests), 2)
+        values = self.cloudflare_helper.get_token_values(self.targets[:1])
+        self.assertEqual(values[self.targets[0]], 'dummy_token')
+
+    def test_server_errors_exhaust_retries(self):
+        """Test a rule failing on every attempt is reported as failed."""
+
+        self.standin.error_rate = 1.0
+
+        with self.assertRaises(CloudflareAPIError) as raised:
+            self.cloudflare_helper.update_rule('dummy_token', self.targets[0], 'key')
+        self.assertEqual(raised.exception.status_code, 500)
+
+    def test_rate_limit_slows_client(self):
+        """Test the stand-in rate limit headers hold back the shared rate limiter."""
+
+        self.standin.rate_limit = 5
+
+        results = self.cloudflare_helper.roll_token('dummy_token', self.targets)
+
+        self.assertTrue(all(result.success for result in results))
+        self.assertGreater(self.rate_limiter.metrics()['pauses'], 0)
+        self.assertGreaterEqual(self.clock.now, 160)
@@ -0,0 +1,80 @@
+""" Tests for the invocation deadline. """
+
+import math
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+sys.path.append('.')
+
+from cloudflare_helper import CloudflareHelper
+from cloudflare_standin import CloudflareStandin
+from deadline import Deadline, DeadlineExceeded
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+
+class DeadlineTestCase(unittest.TestCase):
+    """Tests for the invocation deadline."""
+
+    def test_from_context(self):
+        """Test the deadline keeps the safety margin back from the lambda context."""
+
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 10000
+
+        deadline = Deadline.from_context(context, safety_margin_ms=1000)
+
+        self.assertAlmostEqual(deadline.remaining(), 9, places=1)
+        self.assertEqual(Deadline.from_context('context').remaining(), math.inf)
+
+    def test_check(self):
+        """Test check raises once the time left is used up."""
+
+        Deadline.after(5).check('describe_secret', needed=1)
+        with self.assertRaises(DeadlineExceeded):
+            Deadline.after(5).check('describe_secret', needed=6)
+        with self.assertRaises(DeadlineExceeded):
+            Deadline.after(-1).check('describe_secret')
+
+    def test_timeouts(self):
+        """Test timeouts shrink to the time left."""
+
+        connect, read = Deadline.after(2.5).timeout('PATCH', (3.05, 10))
+        self.assertAlmostEqual(connect, 2.5, places=2)
+        self.assertAlmostEqual(read, 2.5, places=2)
+        self.assertEqual(Deadline().timeout('PATCH', (3.05, 10)), (3.05, 10))
+        self.assertIsNone(Deadline().client_timeouts('modify_rule'))
+
+    def test_client_timeouts(self):
+        """Test client timeouts and attempts together fit in the time left."""
+
+        self.assertEqual(Deadline.after(120).client_timeouts('modify_rule'), (4.0, 4.0, 4))
+        self.assertEqual(Deadline.after(3600).client_timeouts('modify_rule'), (60, 60, 4))
+        # Under a 10 second Lambda timeout calls are still retried, with shorter timeouts
+        self.assertEqual(Deadline.after(9.5).client_timeouts('modify_rule'), (8 / 12, 8 / 12, 3))
+        self.assertEqual(Deadline.after(4.5).client_timeouts('modify_rule'), (0.5, 0.5, 2))
+        self.assertEqual(Deadline.after(2.5).client_timeouts('modify_rule'), (1.0, 1.0, 1))
+        self.assertEqual(Deadline.after(0.1).client_timeouts('modify_rule'), (0.125, 0.125, 1))
+        for remaining in (0.6, 3, 9.5, 17, 50, 120, 900):
+            connect, read, attempts = Deadline.after(remaining).client_timeouts('modify_rule')
+            # The backoff of botocore's standard mode waits at most 1, 2, 4... seconds
+            backoff = 2 ** (attempts - 1) - 1
+            self.assertLessEqual(attempts * (connect + read) + backoff, remaining)
+
+    @patch('cloudflare_helper.time.sleep')
+    def test_cloudflare_retry_stops_at_deadline(self, mock_sleep):
+        """Test a retry that would outlast the invocation stops instead of sleeping."""
+
+        with CloudflareStandin() as standin:
+            standin.add_rule('z', 'r', 'id')
+            standin.scripted = [(429, {'Retry-After': '30'})]
+            cloudflare_helper = CloudflareHelper(
+                base_url=standin.base_url,
+                deadline=Deadline.after(5),
+                rate_limiter=TokenBucket(rate=100, burst=100),
+            )
+
+            with self.assertRaises(DeadlineExceeded):
+                cloudflare_helper.update_rule('token', CloudflareTarget('z', 'r', 'id'), 'key')
+        mock_sleep.assert_not_called()
@@ -0,0 +1,49 @@
+""" Tests for the JSON file persistence helpers. """
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('.')
+
+from json_file import load_json, save_json
+
+
+class JsonFileTestCase(unittest.TestCase):
+    """Tests for load_json and save_json."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'nested', 'document.json')
+
+    def test_round_trip(self):
+        """Test a saved document reads back and no temporary file is left."""
+
+        save_json(self.path, {'phase': 'cloudflare'})
+
+        self.assertEqual(load_json(self.path), {'phase': 'cloudflare'})
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['document.json'])
+
+    def test_version(self):
+        """Test a document saved with another version reads as empty."""
+
+        save_json(self.path, {'regions': {'a': 1}}, version=1)
+
+        self.assertEqual(load_json(self.path, 1), {'version': 1, 'regions': {'a': 1}})
+        self.assertEqual(load_json(self.path, 2), {})
+
+    def test_unreadable(self):
+        """Test a missing or corrupt file reads as empty."""
+
+        self.assertEqual(load_json(self.path), {})
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w', encoding='utf-8') as document_file:
+            document_file.write('{"phase": ')
+
+        self.assertEqual(load_json(self.path), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,38 @@
 """ Tests for the lambda function. """
 
 import datetime
+import json
+import os
+import subprocess
 import sys
 import unittest
 from unittest.mock import Mock, patch
 
 import boto3
+from moto import mock_ec2, mock_elbv2
 
 sys.path.append('.')
 
+import aws_clients
 import lambda_function
-from cloudflare_helper import CloudFlareHelper
-from loadbalancer_helper import LoadBalancerHelper
+from cloudflare_helper import CloudflareHelper
+from cloudflare_standin import CloudflareStandin
+from deadline import Deadline
+from loadbalancer_helper import LoadbalancerHelper
+from rate_limiter import TokenBucket
+from rotation_state import NullCheckpointStore, plan_set_secret
+from targets import CloudflareTarget
+from test_loadbalancer_helper import create_listener_rule, header_values
 
 
 class LambdaHandlerTestCase(unittest.TestCase):
     """Class to test the lambda handler."""
 
+    def setUp(self):
+        # Some tests replace the module functions with mocks, restore them afterwards
+        saved = dict(vars(lambda_function))
+        self.addCleanup(vars(lambda_function).update, saved)
+
     # Patch the functions create_secret, set_secret, test_secret, finish_secret
     @patch('lambda_function.finish_secret')
     @patch('lambda_function.test_secret')
@@ -35,7 +51,7 @@ class LambdaHandlerTestCase(unittest.TestCase):
         step = ['createSecret', 'setSecret', 'testSecret', 'finishSecret']
 
         # Setup the client
-        service_client = boto3.client('secretsmanager')
+        service_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
         service_client.describe_secret = Mock(
             return_value={
                 'ARN': arn,
@@ -60,7 +76,7 @@ class LambdaHandlerTestCase(unittest.TestCase):
         """Test for the create secret method."""
 
         print('Testing create secret')
-        service_client = boto3.client('secretsmanager')
+        service_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
         token = 'dummy_token'
         arn = 'dummy_arn'
         service_client.get_secret_value = Mock(return_value='old_dummy_secret')
@@ -72,13 +88,13 @@ class LambdaHandlerTestCase(unittest.TestCase):
         self.assertEqual(lambda_function.create_secret(service_client, arn, token), 200)
 
     # Patch the modify_rule and roll_token methods
-    @patch('loadbalancer_helper.LoadBalancerHelper.modify_rule')
-    @patch('cloudflare_helper.CloudFlareHelper.roll_token')
+    @patch('loadbalancer_helper.LoadbalancerHelper.modify_rule')
+    @patch('cloudflare_helper.CloudflareHelper.roll_token')
     def test_set_secret(self, mock_cf_rolltoken, mock_alb_modifyrule):
         """Test for the set secret method."""
 
         print('Testing set secret')
-        service_client = boto3.client('secretsmanager')
+        service_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
         token = 'dummy_token'
         arn = 'dummy_arn'
         service_client.get_secret_value = Mock(return_value='old dummy secret')
@@ -157,10 +173,10 @@ class LambdaHandlerTestCase(unittest.TestCase):
             'messages': [],
         }
 
-        modify_listener = LoadBalancerHelper()
+        modify_listener = LoadbalancerHelper()
         response = modify_listener.modify_rule([old_token, new_token])
 
-        token_refresh = CloudFlareHelper()
+        token_refresh = CloudflareHelper()
         response = token_refresh.roll_token(new_token)
 
         mock_alb_modifyrule.return_value = {
@@ -223,7 +239,7 @@ class LambdaHandlerTestCase(unittest.TestCase):
         """Test for the test secret method."""
 
         print('Testing test secret')
-        service_client = boto3.client('secretsmanager')
+        service_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
         token = 'dummy_token'
         arn = 'dummy_arn'
         lambda_function.test_secret = Mock(
@@ -239,7 +255,7 @@ class LambdaHandlerTestCase(unittest.TestCase):
         """Test for the finish secret method."""
 
         print('Testing finish secret')
-        service_client = boto3.client('secretsmanager')
+        service_client = boto3.client('secretsmanager', region_name='ap-southeast-2')
         token = 'dummy_token'
         arn = 'dummy_arn'
         service_client.describe_secret = Mock(
@@ -287,3 +303,249 @@ class LambdaHandlerTestCase(unittest.TestCase):
                 }
             },
         )
+
+
+@mock_ec2
+@mock_elbv2
+class SetSecretTestCase(unittest.TestCase):
+    """Tests for set secret against moto listener rules and the cloudflare stand-in."""
+
+    engine = 'threads'
+
+    def setUp(self):
+        self.standin = CloudflareStandin().start()
+        self.addCleanup(self.standin.stop)
+        self.addCleanup(aws_clients.reset_clients)
+        self.cf_target = CloudflareTarget('zone', 'ruleset', 'rule')
+        self.alb_target = create_listener_rule('ap-southeast-2', 'one.example.com')
+        self.rotation = Mock(
+            current_value='old_token', pending_value='new_token', deadline=Deadline()
+        )
+        for target, value in (
+            ('cloudflare_helper.CF_TARGETS', [self.cf_target]),
+            ('cloudflare_helper.CF_API_BASE_URL', self.standin.base_url),
+            ('loadbalancer_helper.ALB_TARGETS', [self.alb_target]),
+            ('rotation_state.get_checkpoint_store', Mock(return_value=NullCheckpointStore())),
+            ('cloudflare_helper.RATE_LIMITER', TokenBucket(rate=100, burst=100)),
+            ('lambda_function.ROTATION_ENGINE', self.engine),
+        ):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = patch.object(CloudflareHelper, 'get_api_key', Mock(return_value='key'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.standin.add_rule('zone', 'ruleset', 'rule')
+        self.set_cloudflare_value('old_token')
+
+    def set_cloudflare_value(self, value):
+        """Set the header value in the stand-in rule."""
+
+        CloudflareHelper().update_rule(value, self.cf_target, 'key')
+        self.standin.requests.clear()
+
+    def set_secret(self):
+        """Run set secret and return the number of listener rule and cloudflare writes."""
+
+        with patch.object(
+            LoadbalancerHelper,
+            'modify_target',
+            autospec=True,
+            side_effect=LoadbalancerHelper.modify_target,
+        ) as mock_modify_target:
+            lambda_function.set_secret(self.rotation)
+        patches = [request for request in self.standin.requests if request[0] == 'PATCH']
+        return mock_modify_target.call_count, len(patches)
+
+    def test_set_secret(self):
+        """Test a fresh rotation writes every phase."""
+
+        self.assertEqual(self.set_secret(), (2, 1))
+        # The ruleset read for the plan is written back without reading it again
+        reads = [request for request in self.standin.requests if request[0] == 'GET']
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(header_values(self.alb_target), ['new_token'])
+        self.assertEqual(
+            self.standin.header_value('zone', 'ruleset', 'rule'), 'new_token'
+        )
+
+    def test_retry_after_cloudflare(self):
+        """Test a retry after cloudflare was rolled only removes the old token."""
+
+        LoadbalancerHelper().modify_rule(['old_token', 'new_token'])
+        self.set_cloudflare_value('new_token')
+
+        self.assertEqual(self.set_secret(), (1, 0))
+        self.assertEqual(header_values(self.alb_target), ['new_token'])
+
+    def test_retry_after_completion(self):
+        """Test a retry of a completed rotation writes nothing."""
+
+        LoadbalancerHelper().modify_rule(['new_token'])
+        self.set_cloudflare_value('new_token')
+
+        self.assertEqual(self.set_secret(), (0, 0))
+
+    def test_cloudflare_failure(self):
+        """Test a cloudflare failure leaves both tokens accepted and raises."""
+
+        self.standin.scripted = [(400, {})]
+
+        with self.assertRaises(RuntimeError):
+            self.set_secret()
+        self.assertEqual(header_values(self.alb_target), ['old_token', 'new_token'])
+
+    def test_plan_set_secret(self):
+        """Test the plan when the listener rule already accepts both tokens."""
+
+        plan = plan_set_secret(
+            'old_token',
+            'new_token',
+            [self.alb_target],
+            {self.alb_target.rule_arn: ['old_token', 'new_token']},
+            [self.cf_target],
+            {self.cf_target: 'old_token'},
+        )
+
+        self.assertEqual(
+            plan,
+            {'alb_dual': [], 'cloudflare': [self.cf_target], 'alb_single': [self.alb_target]},
+        )
+
+
+class AsyncSetSecretTestCase(SetSecretTestCase):
+    """Tests for set secret with the asyncio rotation engine."""
+
+    engine = 'asyncio'
+
+
+class BatchHandlerTestCase(unittest.TestCase):
+    """Tests for the batch handler."""
+
+    def rotation_event(self, secret_id, step):
+        """Return a rotation event for a secret and step."""
+
+        return {'SecretId': secret_id, 'ClientRequestToken': 'token', 'Step': step}
+
+    @patch('lambda_function.rotate_secret')
+    def test_batch_handler_sqs(self, mock_rotate_secret):
+        """Test the failed SQS messages are reported, with the later steps of their secret."""
+
+        def rotate_secret(event, deadline):
+            if event['SecretId'] == 'secret_b' and event['Step'] == 'createSecret':
+                raise ValueError('failed')
+
+        mock_rotate_secret.side_effect = rotate_secret
+        records = [
+            ('1', self.rotation_event('secret_a', 'createSecret')),
+            ('2', self.rotation_event('secret_b', 'createSecret')),
+            ('3', self.rotation_event('secret_a', 'setSecret')),
+            ('4', self.rotation_event('secret_b', 'setSecret')),
+        ]
+        event = {
+            'Records': [
+                {'messageId': message_id, 'body': json.dumps(body)}
+                for message_id, body in records
+            ]
+        }
+
+        response = lambda_function.batch_handler(event, None)
+
+        self.assertEqual(
+            response, {'batchItemFailures': [{'itemIdentifier': '2'}, {'itemIdentifier': '4'}]}
+        )
+        steps = [
+            (call.args[0]['SecretId'], call.args[0]['Step'])
+            for call in mock_rotate_secret.call_args_list
+        ]
+        self.assertEqual(len(steps), 3)
+        self.assertLess(
+            steps.index(('secret_a', 'createSecret')), steps.index(('secret_a', 'setSecret'))
+        )
+        self.assertNotIn(('secret_b', 'setSecret'), steps)
+
+    @patch('lambda_function.rotate_secret')
+    def test_batch_handler_malformed_message(self, mock_rotate_secret):
+        """Test a message that is not a rotation event is reported without failing the batch."""
+
+        event = {
+            'Records': [
+                {'messageId': '1', 'body': '{"SecretId": '},
+                {'messageId': '2', 'body': json.dumps(self.rotation_event('secret_a', 'setSecret'))},
+                {'messageId': '3', 'body': '[]'},
+            ]
+        }
+
+        response = lambda_function.batch_handler(event, None)
+
+        self.assertEqual(
+            response, {'batchItemFailures': [{'itemIdentifier': '1'}, {'itemIdentifier': '3'}]}
+        )
+        mock_rotate_secret.assert_called_once()
+        self.assertEqual(mock_rotate_secret.call_args.args[0]['SecretId'], 'secret_a')
+
+    @patch('lambda_function.rotate_secret')
+    def test_batch_handler_events(self, mock_rotate_secret):
+        """Test a plain list of rotation events runs every event."""
+
+        events = [self.rotation_event(f'secret_{index}', 'testSecret') for index in range(5)]
+
+        response = lambda_function.batch_handler({'Events': events}, None)
+
+        self.assertEqual(response, {'batchItemFailures': []})
+        self.assertEqual(mock_rotate_secret.call_count, 5)
+
+    @patch('lambda_function.rotate_secret')
+    def test_lambda_handler_single_event(self, mock_rotate_secret):
+        """Test the single event handler still rotates one event."""
+
+        event = self.rotation_event('secret_a', 'testSecret')
+
+        lambda_function.lambda_handler(event, None)
+
+        mock_rotate_secret.assert_called_once()
+        self.assertEqual(mock_rotate_secret.call_args.args[0], event)
+
+
+class ColdStartTestCase(unittest.TestCase):
+    """Tests for the modules imported when the function starts."""
+
+    def test_lazy_imports(self):
+        """Test the Cloudflare, load balancer and HTTP modules are left to the steps using them."""
+
+        script = (
+            "import sys; sys.path.append('.'); import lambda_function; "
+            "print(' '.join(sorted(sys.modules)))"
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', script], capture_output=True, text=True, check=True
+        ).stdout
+
+        modules = set(output.split())
+        self.assertIn('lambda_function', modules)
+        for module in ('requests', 'aiohttp', 'cloudflare_helper', 'loadbalancer_helper', 'moto'):
+            self.assertNotIn(module, modules)
+
+    def test_test_secret_without_urls(self):
+        """Test testSecret without URLs to probe leaves the Cloudflare modules and requests alone."""
+
+        script = (
+            "import sys; sys.path.append('.'); from unittest.mock import Mock; "
+            "import lambda_function; from deadline import Deadline; "
+            "lambda_function.test_secret(Mock(pending_value='token', deadline=Deadline())); "
+            "print(' '.join(sorted(sys.modules)))"
+        )
+        environment = {key: value for key, value in os.environ.items() if key != 'PROBE_URLS'}
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            capture_output=True,
+            text=True,
+            check=True,
+            env=environment,
+        ).stdout
+
+        # The step prints first, the module names are the last line
+        modules = set(output.splitlines()[-1].split())
+        self.assertIn('secret_probe', modules)
+        for module in ('requests', 'cloudflare_helper', 'cloudflare_discovery'):
+            self.assertNotIn(module, modules)
@@ -5,20 +5,26 @@ import sys
 import unittest
 from unittest.mock import patch
 
+import boto3
+from moto import mock_ec2, mock_elbv2, mock_sts
+
 sys.path.append('.')
 
-from loadbalancer_helper import LoadBalancerHelper
+import aws_clients
+from alb_standin import create_listener_rules
+from loadbalancer_helper import LoadbalancerHelper
+from targets import ListenerRuleTarget
 
 
-class LoadBalancerHelperTestCase(unittest.TestCase):
+class LoadbalancerHelperTestCase(unittest.TestCase):
     """ Tests for loadbalancer helper. """
 
     # Patch the modify_rule method
-    @patch("loadbalancer_helper.LoadBalancerHelper.modify_rule")
+    @patch("loadbalancer_helper.LoadbalancerHelper.modify_rule")
     def test_modify_rule(self, mock_modify_rule):
         """ Test for the modify_rule function. """
 
-        loadbalancer_helper = LoadBalancerHelper()
+        loadbalancer_helper = LoadbalancerHelper()
         token = 'dummy_token'
         mock_modify_rule.return_value = {
             'result': {
@@ -80,3 +86,74 @@ class LoadBalancerHelperTestCase(unittest.TestCase):
             ],
         )
         assert mock_modify_rule.called
+
+
+def create_listener_rule(region_name, host, client=None, ec2_client=None):
+    """Create a load balancer with a listener rule checking the token header."""
+
+    return create_listener_rules(region_name, [host], client=client, ec2_client=ec2_client)[0]
+
+
+def header_values(target, client=None):
+    """Return the token header values checked by a listener rule."""
+
+    client = client or boto3.client('elbv2', region_name=target.region_name)
+    rule = client.describe_rules(RuleArns=[target.rule_arn])['Rules'][0]
+    for condition in rule['Conditions']:
+        if condition['Field'] == 'http-header':
+            return condition['HttpHeaderConfig']['Values']
+    return None
+
+
+@mock_ec2
+@mock_elbv2
+@mock_sts
+class LoadbalancerTargetsTestCase(unittest.TestCase):
+    """Tests for modifying listener rules across regions and accounts under moto."""
+
+    def tearDown(self):
+        aws_clients.reset_clients()
+
+    def test_modify_rule_targets(self):
+        """Test every listener rule in every region is updated with its own conditions."""
+
+        targets = [
+            create_listener_rule('ap-southeast-2', 'one.example.com'),
+            create_listener_rule('us-east-1', 'two.example.com'),
+        ]
+
+        results = LoadbalancerHelper().modify_rule(['old_token', 'new_token'], targets)
+
+        self.assertEqual([result.target for result in results], targets)
+        self.assertTrue(all(result.success for result in results))
+        for target in targets:
+            self.assertEqual(header_values(target), ['old_token', 'new_token'])
+        self.assertIn(('elbv2', 'us-east-1', None, None), aws_clients.CLIENTS)
+
+    def test_modify_rule_other_account(self):
+        """Test a rule in another account is modified with the assumed role."""
+
+        role_arn = 'arn:aws:iam::111111111111:role/token-rotation'
+        elbv2_client = aws_clients.get_client('elbv2', 'ap-southeast-2', role_arn)
+        ec2_client = aws_clients.get_role_session(role_arn).client(
+            'ec2', region_name='ap-southeast-2'
+        )
+        target = create_listener_rule(
+            'ap-southeast-2', 'three.example.com', elbv2_client, ec2_client
+        )
+        target = ListenerRuleTarget(target.rule_arn, target.conditions, role_arn=role_arn)
+
+        results = LoadbalancerHelper().modify_rule(['new_token'], [target])
+
+        self.assertTrue(results[0].success)
+        self.assertEqual(header_values(target, elbv2_client), ['new_token'])
+
+    def test_modify_rule_failure(self):
+        """Test a missing listener rule is reported without failing the others."""
+
+        target = create_listener_rule('ap-southeast-2', 'one.example.com')
+        missing = ListenerRuleTarget(target.rule_arn[:-4] + '0000')
+
+        results = LoadbalancerHelper().modify_rule(['new_token'], [target, missing])
+
+        self.assertEqual([result.success for result in results], [True, False])
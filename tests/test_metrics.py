@@ -0,0 +1,174 @@
+""" Tests for the embedded metric format metrics. """
+
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+import aws_clients
+import metrics
+from async_rotation import AsyncCloudflareHelper
+from cloudflare_helper import CloudflareHelper
+from cloudflare_standin import CloudflareStandin
+from metrics import MemorySink
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+SECRET_ID = 'cf-alb-token'
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for the metric records of steps and external calls."""
+
+    def setUp(self):
+        # The modules share the METRICS logger, capture what it emits
+        self.sink = MemorySink()
+        self.metrics = metrics.METRICS
+        for name, value in (('namespace', 'Test'), ('sink', self.sink), ('enabled', True)):
+            patcher = patch.object(self.metrics, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_step_record(self):
+        """Test a step emits an EMF record with its duration."""
+
+        with self.metrics.step(SECRET_ID, 'createSecret'):
+            pass
+
+        [record] = self.sink.records
+        directive = record['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Namespace'], 'Test')
+        self.assertEqual(directive['Dimensions'], [['Step']])
+        self.assertEqual(
+            directive['Metrics'],
+            [{'Name': 'Duration', 'Unit': 'Milliseconds'}, {'Name': 'Errors', 'Unit': 'Count'}],
+        )
+        self.assertEqual(record['Step'], 'createSecret')
+        self.assertEqual(record['SecretId'], SECRET_ID)
+        self.assertEqual(record['Errors'], 0)
+        self.assertGreaterEqual(record['Duration'], 0)
+
+    def test_step_error(self):
+        """Test a failed step is counted as an error with its type."""
+
+        with self.assertRaises(ValueError):
+            with self.metrics.step(SECRET_ID, 'setSecret'):
+                raise ValueError('failed')
+
+        [record] = self.sink.records
+        self.assertEqual(record['Errors'], 1)
+        self.assertEqual(record['ErrorType'], 'ValueError')
+
+    def test_disabled(self):
+        """Test nothing is emitted when metrics are disabled."""
+
+        self.metrics.enabled = False
+
+        with self.metrics.step(SECRET_ID, 'createSecret'):
+            self.metrics.call('cloudflare', 'GET', 0.1)
+
+        self.assertEqual(self.sink.records, [])
+
+    @mock_secretsmanager
+    def test_aws_calls(self):
+        """Test AWS API calls made during a step are recorded with the secret and step."""
+
+        self.addCleanup(aws_clients.reset_clients)
+        client = aws_clients.get_client('secretsmanager', 'ap-southeast-2')
+
+        with self.metrics.step(SECRET_ID, 'createSecret'):
+            client.create_secret(Name=SECRET_ID, SecretString='token')
+            with self.assertRaises(client.exceptions.ResourceNotFoundException):
+                client.describe_secret(SecretId='missing')
+
+        [created] = self.sink.find(Operation='CreateSecret')
+        self.assertEqual(created['Service'], 'secretsmanager')
+        self.assertEqual(created['StatusCode'], 200)
+        self.assertEqual(created['Retries'], 0)
+        # Only the Cloudflare calls go through the rate limiter
+        self.assertNotIn('QueueWait', created)
+        self.assertEqual((created['SecretId'], created['Step']), (SECRET_ID, 'createSecret'))
+        [described] = self.sink.find(Operation='DescribeSecret')
+        self.assertGreaterEqual(described['StatusCode'], 400)
+        self.assertEqual(described['Errors'], 1)
+
+    def test_cloudflare_calls(self):
+        """Test Cloudflare requests are recorded with their retries, status and target."""
+
+        targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(2)]
+        with CloudflareStandin() as standin, patch('cloudflare_helper.time.sleep'):
+            for target in targets:
+                standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+            standin.scripted = [(503, {})]
+            cloudflare_helper = CloudflareHelper(
+                base_url=standin.base_url,
+                targets=targets,
+                rate_limiter=TokenBucket(rate=100, burst=100),
+            )
+            cloudflare_helper.get_api_key = Mock(return_value='dummy_secret')
+
+            with self.metrics.step(SECRET_ID, 'setSecret'):
+                cloudflare_helper.roll_token('dummy_token')
+
+        # The rulesets are read before the rules are written
+        self.assertEqual(len(self.sink.find(Service='cloudflare', Operation='GET')), 2)
+        records = sorted(
+            self.sink.find(Service='cloudflare', Operation='PATCH'),
+            key=lambda record: record['Retries'],
+        )
+        self.assertEqual([record['Retries'] for record in records], [0, 1])
+        self.assertEqual({record['StatusCode'] for record in records}, {200})
+        self.assertEqual(
+            {record['Target'] for record in records},
+            {f'/zones/zone{index}/rulesets/ruleset/rules/rule' for index in range(2)},
+        )
+        # The rules are updated on worker threads, which still know the step
+        self.assertEqual({record['Step'] for record in records}, {'setSecret'})
+
+    def test_async_cloudflare_calls(self):
+        """Test requests made on the event loop are recorded with the secret and step."""
+
+        with CloudflareStandin() as standin:
+            cloudflare_helper = AsyncCloudflareHelper(
+                base_url=standin.base_url,
+                targets=[CloudflareTarget('zone', 'ruleset', 'rule')],
+                rate_limiter=TokenBucket(rate=100, burst=100),
+            )
+            cloudflare_helper.helper.get_api_key = Mock(return_value='dummy_secret')
+
+            with self.metrics.step(SECRET_ID, 'setSecret'):
+                cloudflare_helper.get_token_values()
+
+        [record] = self.sink.find(Service='cloudflare')
+        self.assertEqual((record['Operation'], record['StatusCode']), ('GET', 200))
+        self.assertEqual((record['SecretId'], record['Step']), (SECRET_ID, 'setSecret'))
+
+    def test_queue_wait(self):
+        """Test Cloudflare requests report the time they waited for the rate limiter."""
+
+        targets = [CloudflareTarget(f'zone{index}', 'ruleset', 'rule') for index in range(3)]
+        clock = Mock(return_value=0.0)
+        with CloudflareStandin() as standin, patch('cloudflare_helper.time.sleep'):
+            for target in targets:
+                standin.add_rule(target.zone_id, target.ruleset_id, target.rule_id)
+            cloudflare_helper = CloudflareHelper(
+                base_url=standin.base_url,
+                targets=targets,
+                # The clock stands still, so every request after the first queues a second longer
+                rate_limiter=TokenBucket(rate=1, burst=1, clock=clock),
+            )
+            cloudflare_helper.get_api_key = Mock(return_value='dummy_secret')
+            cloudflare_helper.roll_token('dummy_token')
+
+        records = self.sink.find(Service='cloudflare')
+        # Three ruleset reads, then three writes
+        self.assertEqual(
+            sorted(record['QueueWait'] for record in records), [index * 1000 for index in range(6)]
+        )
+        self.assertIn(
+            {'Name': 'QueueWait', 'Unit': 'Milliseconds'},
+            records[0]['_aws']['CloudWatchMetrics'][0]['Metrics'],
+        )
@@ -0,0 +1,100 @@
+""" Tests for the invocation profiler. """
+
+import importlib
+import os
+import pstats
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+sys.path.append('.')
+
+from profiling import DirectorySink, Profiler
+from targets import run_concurrently
+
+
+def busy_target(target):
+    """Burn a little CPU on a worker thread."""
+
+    return sum(range(20000 * target))
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """Tests for the profiles captured around an invocation."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(kinds=['all'], sink=DirectorySink(self.directory), top=50)
+        self.addCleanup(self.profiler.import_timer.uninstall)
+
+    def profile_files(self, suffix):
+        """Paths of the profiles written with the suffix."""
+
+        return [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(suffix)
+        ]
+
+    def test_invocation_profiles(self):
+        """Test CPU, memory and import profiles are written for the invocation."""
+
+        module_directory = tempfile.mkdtemp()
+        with open(os.path.join(module_directory, 'slow_module.py'), 'w') as module_file:
+            module_file.write('import time\ntime.sleep(0.01)\n')
+        sys.path.append(module_directory)
+        self.addCleanup(sys.path.remove, module_directory)
+        self.addCleanup(sys.modules.pop, 'slow_module', None)
+
+        def handler():
+            importlib.invalidate_caches()
+            __import__('slow_module')
+            run_concurrently(busy_target, [1, 2], 2)
+            return [bytearray(1024) for _ in range(100)]
+
+        with self.profiler.invocation('lambda_handler'):
+            handler()
+
+        [cpu_profile] = self.profile_files('-cpu.prof')
+        functions = {function for _, _, function in pstats.Stats(cpu_profile).stats}
+        self.assertIn('handler', functions)
+        # Worker threads started during the invocation are profiled too
+        self.assertIn('busy_target', functions)
+        [cpu_report] = self.profile_files('-cpu.txt')
+        with open(cpu_report) as report:
+            self.assertIn('cumulative', report.read())
+
+        [memory_report] = self.profile_files('-memory.txt')
+        with open(memory_report) as report:
+            self.assertIn('Peak traced memory', report.read())
+
+        [import_report] = self.profile_files('-imports.txt')
+        with open(import_report) as report:
+            [line] = [line for line in report if line.endswith('slow_module\n')]
+        self.assertGreaterEqual(float(line.split()[0]), 10)
+
+    def test_profiled(self):
+        """Test a decorated handler is profiled under its own name."""
+
+        handler = self.profiler.profiled(Mock(__name__='lambda_handler', return_value='done'))
+
+        self.assertEqual(handler({}, None), 'done')
+        self.assertEqual(len(self.profile_files('-cpu.prof')), 1)
+        self.assertTrue(os.listdir(self.directory)[0].startswith('lambda_handler-'))
+
+    def test_disabled(self):
+        """Test profiling off leaves the handler untouched and writes nothing."""
+
+        sink = Mock()
+        profiler = Profiler(kinds=[], sink=sink)
+
+        def handler(event, context):
+            return time.perf_counter()
+
+        self.assertIs(profiler.profiled(handler), handler)
+        with profiler.invocation('lambda_handler'):
+            handler({}, None)
+        sink.write.assert_not_called()
+        self.assertIsNone(profiler.import_timer)
@@ -0,0 +1,88 @@
+""" Tests for the edge propagation verifier. """
+
+import sys
+import unittest
+
+sys.path.append('.')
+
+from cloudflare_helper import CloudflareHelper, get_http_session
+from cloudflare_standin import CloudflareStandin, EdgeStandin
+from deadline import Deadline, DeadlineExceeded
+from propagation import PropagationTimeout, PropagationVerifier, get_probe_session
+from rate_limiter import TokenBucket
+from targets import CloudflareTarget
+
+
+class PropagationVerifierTestCase(unittest.TestCase):
+    """Tests for the propagation verifier against the local edge stand-in."""
+
+    def setUp(self):
+        self.target = CloudflareTarget('zone', 'ruleset', 'rule')
+        self.standin = CloudflareStandin().start()
+        self.addCleanup(self.standin.stop)
+        self.standin.add_rule('zone', 'ruleset', 'rule', token='old_token')
+        self.edge = EdgeStandin(self.standin, self.target, propagation_delay=0.3).start()
+        self.addCleanup(self.edge.stop)
+        cloudflare_helper = CloudflareHelper(
+            base_url=self.standin.base_url, rate_limiter=TokenBucket(rate=100, burst=100)
+        )
+        cloudflare_helper.update_rule('new_token', self.target, 'key')
+
+    def verifier(self, **kwargs):
+        """Return a verifier probing the edge stand-in with short intervals."""
+
+        options = dict(probe_urls=[self.edge.address], interval=0.05, max_interval=0.2, timeout=5)
+        options.update(kwargs)
+        return PropagationVerifier(**options)
+
+    def test_wait_for(self):
+        """Test the wait ends once the edge sends the new token for enough rounds in a row."""
+
+        elapsed = self.verifier(required_matches=3).wait_for('new_token')
+
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(self.edge.edge_value(), 'new_token')
+
+    def test_backoff(self):
+        """Test polling slows down while the edge still sends the old value."""
+
+        self.edge.propagation_delay = 1.0
+
+        self.verifier(interval=0.05, max_interval=0.4, required_matches=1).wait_for('new_token')
+
+        # Polling every 50 ms would take about 20 rounds
+        self.assertLess(self.edge.requests, 12)
+
+    def test_timeout(self):
+        """Test the wait gives up when the edge never sends the new token."""
+
+        with self.assertRaises(PropagationTimeout):
+            self.verifier(timeout=0.3).wait_for('other_token')
+
+    def test_deadline(self):
+        """Test the wait stops with a resumable error when the invocation runs out of time."""
+
+        with self.assertRaises(DeadlineExceeded):
+            self.verifier(deadline=Deadline.after(0.2)).wait_for('other_token')
+
+    def test_unreachable_probe(self):
+        """Test an unreachable probe counts as not propagated."""
+
+        self.edge.stop()
+
+        with self.assertRaises(PropagationTimeout):
+            self.verifier(timeout=0.2).wait_for('new_token')
+
+    def test_no_probes(self):
+        """Test the wait is skipped without probe urls."""
+
+        self.assertEqual(PropagationVerifier(probe_urls=[]).wait_for('new_token'), 0.0)
+
+    def test_own_session(self):
+        """Test the probes do not share the Cloudflare API session."""
+
+        verifier = PropagationVerifier(probe_urls=[self.edge.address])
+
+        self.assertIs(verifier.session, get_probe_session())
+        self.assertIsNot(verifier.session, get_http_session())
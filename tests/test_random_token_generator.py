@@ -0,0 +1,59 @@
+""" Tests for the random token generator. """
+
+import string
+import sys
+import unittest
+
+import boto3
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+from random_token_generator import RandomTokenGenerator
+
+
+class RandomTokenGeneratorTestCase(unittest.TestCase):
+    """Tests for the random token generator."""
+
+    def test_generate_local_token(self):
+        """Test local tokens honour the length, alphabet and exclusions."""
+
+        token_generator = RandomTokenGenerator(length=48, exclude_characters='0Ol1I')
+        tokens = {token_generator.generate_random_token() for _ in range(50)}
+
+        self.assertEqual(len(tokens), 50)
+        for token in tokens:
+            self.assertEqual(len(token), 48)
+            self.assertTrue(set(token) <= set(string.ascii_letters + string.digits))
+            self.assertFalse(set(token) & set('0Ol1I'))
+            self.assertTrue(set(token) & set(string.ascii_lowercase))
+            self.assertTrue(set(token) & set(string.ascii_uppercase))
+            self.assertTrue(set(token) & set(string.digits))
+
+    def test_generate_local_token_alphabet(self):
+        """Test a custom alphabet is used as is."""
+
+        token = RandomTokenGenerator(alphabet='abc', exclude_characters='').generate_random_token()
+
+        self.assertEqual(len(token), 32)
+        self.assertTrue(set(token) <= set('abc'))
+
+    @mock_secretsmanager
+    def test_generate_remote_token(self):
+        """Test the secrets manager backend is still available."""
+
+        client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        token_generator = RandomTokenGenerator(
+            length=20, alphabet=string.hexdigits, backend='secretsmanager', client=client
+        )
+
+        token = token_generator.generate_random_token()
+
+        self.assertEqual(len(token), 20)
+        self.assertTrue(set(token) <= set(string.hexdigits))
+
+    def test_invalid_backend(self):
+        """Test an unknown backend is rejected."""
+
+        with self.assertRaises(ValueError):
+            RandomTokenGenerator(backend='unknown').generate_random_token()
@@ -0,0 +1,141 @@
+""" Tests for the token bucket rate limiter. """
+
+import sys
+import threading
+import unittest
+from unittest.mock import Mock
+
+sys.path.append('.')
+
+from rate_limiter import TokenBucket, parse_rate_limit, parse_retry_after
+
+
+class FakeClock:
+    """Clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """Tests for the token bucket."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(rate=4, burst=2, clock=self.clock)
+
+    def test_burst_then_rate(self):
+        """Test the burst is free and later requests queue at the rate."""
+
+        waits = [self.bucket.reserve() for _ in range(4)]
+
+        self.assertEqual(waits, [0.0, 0.0, 0.25, 0.5])
+
+    def test_refill(self):
+        """Test tokens refill with time up to the burst."""
+
+        for _ in range(2):
+            self.bucket.reserve()
+        self.clock.now += 10
+
+        waits = [self.bucket.reserve() for _ in range(3)]
+
+        self.assertEqual(waits, [0.0, 0.0, 0.25])
+
+    def test_acquire_sleeps(self):
+        """Test acquire sleeps for the reserved wait."""
+
+        sleep = Mock()
+        for _ in range(3):
+            self.bucket.acquire(sleep=sleep)
+
+        sleep.assert_called_once_with(0.25)
+
+    def test_retry_after_pauses(self):
+        """Test Retry-After holds callers back without a burst after the pause."""
+
+        self.bucket.update_from_headers({'Retry-After': '3'})
+
+        self.assertEqual(self.bucket.reserve(), 3.0)
+        self.clock.now += 3
+        self.assertEqual(self.bucket.reserve(), 0.25)
+
+    def test_callers_queue_behind_pause(self):
+        """Test callers arriving during a pause are released one by one at the rate after it."""
+
+        self.bucket.pause(10)
+
+        waits = [self.bucket.reserve() for _ in range(8)]
+
+        self.assertEqual(waits, [10.0 + index * 0.25 for index in range(8)])
+
+    def test_remaining_limits_tokens(self):
+        """Test rate limit headers cap the requests until the reset and pause once exhausted."""
+
+        bucket = TokenBucket(rate=4, burst=10, clock=self.clock)
+        bucket.update_from_headers({'X-RateLimit-Remaining': '2', 'X-RateLimit-Reset': '60'})
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.0, 0.0, 60.25])
+        # Waiting does not refill the bucket before the reset
+        self.clock.now += 10
+        self.assertEqual(bucket.reserve(), 50.5)
+
+        self.bucket.update_from_headers({'Ratelimit': '"default";r=0;t=30'})
+        self.assertEqual(self.bucket.reserve(), 30.0)
+
+    def test_metrics(self):
+        """Test queue wait metrics are recorded."""
+
+        for _ in range(4):
+            self.bucket.reserve()
+
+        metrics = self.bucket.metrics()
+
+        self.assertEqual(metrics['acquired'], 4)
+        self.assertEqual(metrics['delayed'], 2)
+        self.assertEqual(metrics['total_wait_seconds'], 0.75)
+        self.assertEqual(metrics['max_wait_seconds'], 0.5)
+
+    def test_concurrent_reservations(self):
+        """Test concurrent callers each get a distinct slot."""
+
+        bucket = TokenBucket(rate=10, burst=1, clock=self.clock)
+        waits = []
+        lock = threading.Lock()
+
+        def reserve():
+            wait = bucket.reserve()
+            with lock:
+                waits.append(wait)
+
+        threads = [threading.Thread(target=reserve) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({round(wait, 6) for wait in waits}), 20)
+
+
+class ParseHeadersTestCase(unittest.TestCase):
+    """Tests for parsing the rate limit headers."""
+
+    def test_parse_retry_after(self):
+        """Test Retry-After is read as seconds or an HTTP date."""
+
+        self.assertEqual(parse_retry_after('5'), 5.0)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+    def test_parse_rate_limit(self):
+        """Test the structured and X-RateLimit headers are both understood."""
+
+        self.assertEqual(parse_rate_limit({'Ratelimit': '"default";r=50;t=30'}), (50, 30.0))
+        self.assertEqual(
+            parse_rate_limit({'X-RateLimit-Remaining': '7', 'X-RateLimit-Reset': '12'}), (7, 12.0)
+        )
+        self.assertEqual(parse_rate_limit({}), (None, None))
+
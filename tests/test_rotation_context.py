@@ -0,0 +1,132 @@
+""" Tests for the rotation context. """
+
+import sys
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+import boto3
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+import aws_clients
+import lambda_function
+from deadline import Deadline, DeadlineExceeded
+from rotation_context import RotationContext
+from targets import TargetResult
+
+ARN = 'cf-alb-token'
+TOKEN = 'c9a7e4f0-3e46-4b7c-9d5b-000000000001'
+
+
+@mock_secretsmanager
+class RotationContextTestCase(unittest.TestCase):
+    """Tests for the rotation context and the secrets manager calls made per step."""
+
+    def setUp(self):
+        client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        client.create_secret(Name=ARN, SecretString='old_token')
+        # Count the calls made to the moto backed client
+        self.service_client = Mock(wraps=client)
+        self.service_client.exceptions = client.exceptions
+        self.service_client.describe_secret = Mock(
+            side_effect=lambda **kwargs: dict(
+                client.describe_secret(**kwargs), RotationEnabled=True
+            )
+        )
+        aws_clients.set_client('secretsmanager', self.service_client, None)
+        self.addCleanup(aws_clients.reset_clients)
+
+    def run_step(self, step):
+        """Run a step through the lambda handler and reset the call counts."""
+
+        self.service_client.reset_mock()
+        self.service_client.describe_secret.reset_mock()
+        event = {'SecretId': ARN, 'ClientRequestToken': TOKEN, 'Step': step}
+        lambda_function.lambda_handler(event, None)
+
+    def test_get_secret_value_is_memoized(self):
+        """Test a version is read once and a missing version is cached as None."""
+
+        rotation = RotationContext(self.service_client, ARN, TOKEN)
+
+        self.assertEqual(rotation.current_value, 'old_token')
+        self.assertEqual(rotation.current_value, 'old_token')
+        self.assertIsNone(rotation.pending_value)
+        self.assertIsNone(rotation.pending_value)
+        self.assertEqual(self.service_client.get_secret_value.call_count, 2)
+
+        rotation.put_pending_value('new_token')
+        self.assertEqual(rotation.pending_value, 'new_token')
+        self.assertEqual(self.service_client.get_secret_value.call_count, 2)
+
+    def test_concurrent_reads(self):
+        """Test concurrent reads of the same version fetch it once."""
+
+        rotation = RotationContext(self.service_client, ARN, TOKEN)
+        values = []
+
+        threads = [
+            threading.Thread(target=lambda: values.append(rotation.current_value))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(values, ['old_token'] * 8)
+        self.assertEqual(self.service_client.get_secret_value.call_count, 1)
+
+    @patch('cloudflare_helper.CloudflareHelper.get_rules', Mock(return_value={}))
+    @patch('loadbalancer_helper.LoadbalancerHelper.get_token_values', Mock(return_value={}))
+    @patch('cloudflare_helper.CloudflareHelper.roll_token')
+    @patch('loadbalancer_helper.LoadbalancerHelper.modify_rule')
+    def test_calls_per_step(self, mock_modify_rule, mock_roll_token):
+        """Test the exact number of secrets manager calls made by each step."""
+
+        mock_modify_rule.return_value = [TargetResult('rule')]
+        mock_roll_token.return_value = [TargetResult('zone')]
+
+        self.run_step('createSecret')
+        self.assertEqual(self.service_client.describe_secret.call_count, 1)
+        self.assertEqual(self.service_client.get_secret_value.call_count, 1)
+        self.assertEqual(self.service_client.get_random_password.call_count, 0)
+        self.assertEqual(self.service_client.put_secret_value.call_count, 1)
+
+        self.run_step('setSecret')
+        self.assertEqual(self.service_client.describe_secret.call_count, 1)
+        self.assertEqual(self.service_client.get_secret_value.call_count, 2)
+        pending = self.service_client.get_secret_value(
+            SecretId=ARN, VersionId=TOKEN, VersionStage='AWSPENDING'
+        )['SecretString']
+        self.assertEqual(mock_roll_token.call_args.args[0], pending)
+        self.assertEqual(mock_modify_rule.call_args_list[-1].args[0], [pending])
+
+        self.run_step('testSecret')
+        self.assertEqual(self.service_client.describe_secret.call_count, 1)
+        self.assertEqual(self.service_client.get_secret_value.call_count, 0)
+
+        self.run_step('finishSecret')
+        self.assertEqual(self.service_client.describe_secret.call_count, 1)
+        self.assertEqual(self.service_client.update_secret_version_stage.call_count, 1)
+        current = self.service_client.get_secret_value(SecretId=ARN, VersionStage='AWSCURRENT')
+        self.assertEqual(current['VersionId'], TOKEN)
+
+    def test_client_per_call(self):
+        """Test every call takes a client with timeouts fitting the time left when it starts."""
+
+        rotation = RotationContext(None, ARN, TOKEN, Deadline.after(100))
+        with patch('rotation_context.get_client', return_value=self.service_client) as get_client:
+            self.assertEqual(rotation.metadata['Name'], ARN)
+            rotation.deadline = Deadline.after(5)
+            rotation.put_pending_value('new_token')
+            rotation.deadline = Deadline.after(-1)
+            with self.assertRaises(DeadlineExceeded):
+                rotation.current_value
+
+        self.assertEqual(
+            [call.kwargs['timeouts'] for call in get_client.call_args_list],
+            [(4.0, 4.0, 4), (0.5, 0.5, 2)],
+        )
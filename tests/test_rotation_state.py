@@ -0,0 +1,233 @@
+""" Tests for the checkpointed set secret state machine. """
+
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+import boto3
+from moto import mock_secretsmanager
+
+sys.path.append('.')
+
+from deadline import Deadline, DeadlineExceeded
+from rotation_context import RotationContext
+from rotation_state import (
+    FileCheckpointStore,
+    SecretTagCheckpointStore,
+    SetSecretStateMachine,
+)
+from targets import CloudflareTarget, ListenerRuleTarget, TargetResult
+
+ARN = 'cf-alb-token'
+TOKEN = 'c9a7e4f0-3e46-4b7c-9d5b-000000000001'
+RULE_ARN = 'arn:aws:elasticloadbalancing:ap-southeast-2:123456789012:listener-rule/app/alb/1/2/3'
+
+
+def cf_rule(token):
+    """Transform rule setting the token header, as read from its ruleset."""
+
+    return {'id': 'rule', 'action_parameters': {'headers': {'X-ALB-SECRET': {'value': token}}}}
+
+
+class CheckpointStoreTestCase(unittest.TestCase):
+    """Tests for the checkpoint stores."""
+
+    def test_file_checkpoint_store(self):
+        """Test the last completed phase is kept per token version."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileCheckpointStore(directory)
+
+            self.assertIsNone(store.load(ARN, TOKEN))
+            store.save(ARN, TOKEN, 'alb_dual')
+            store.save(ARN, TOKEN, 'cloudflare')
+
+            self.assertEqual(FileCheckpointStore(directory).load(ARN, TOKEN), 'cloudflare')
+            self.assertIsNone(store.load(ARN, 'other_token'))
+
+    @mock_secretsmanager
+    def test_secret_tag_checkpoint_store(self):
+        """Test the checkpoint is tagged on the secret and older versions are untagged."""
+
+        client = boto3.client('secretsmanager', region_name='ap-southeast-2')
+        client.create_secret(
+            Name=ARN,
+            SecretString='old_token',
+            Tags=[{'Key': 'rotation-checkpoint-old_version', 'Value': 'alb_single'}],
+        )
+        store = SecretTagCheckpointStore(RotationContext(client, ARN, TOKEN))
+
+        self.assertIsNone(store.load(ARN, TOKEN))
+        store.save(ARN, TOKEN, 'alb_dual')
+
+        reloaded = SecretTagCheckpointStore(RotationContext(client, ARN, TOKEN))
+        self.assertEqual(reloaded.load(ARN, TOKEN), 'alb_dual')
+        tags = client.describe_secret(SecretId=ARN)['Tags']
+        self.assertEqual(tags, [{'Key': f'rotation-checkpoint-{TOKEN}', 'Value': 'alb_dual'}])
+
+    def test_secret_tag_checkpoint_store_deadline(self):
+        """Test a checkpoint is not written once the invocation is out of time."""
+
+        client = Mock()
+        client.describe_secret.return_value = {'Tags': []}
+        rotation = RotationContext(client, ARN, TOKEN)
+        store = SecretTagCheckpointStore(rotation)
+        store.load(ARN, TOKEN)
+        rotation.deadline = Deadline.after(-1)
+
+        with self.assertRaises(DeadlineExceeded):
+            store.save(ARN, TOKEN, 'alb_single')
+        client.tag_resource.assert_not_called()
+
+
+class SetSecretStateMachineTestCase(unittest.TestCase):
+    """Tests for the set secret state machine."""
+
+    def setUp(self):
+        self.alb_target = ListenerRuleTarget(RULE_ARN)
+        self.cf_target = CloudflareTarget('zone', 'ruleset', 'rule')
+        self.modify_listener = Mock(targets=[self.alb_target])
+        self.modify_listener.get_token_values.return_value = {RULE_ARN: ['old_token']}
+        self.modify_listener.modify_rule.return_value = [TargetResult(self.alb_target)]
+        self.token_refresh = Mock(targets=[self.cf_target])
+        self.token_refresh.get_rules.return_value = {self.cf_target: cf_rule('old_token')}
+        self.token_refresh.roll_token.return_value = [TargetResult(self.cf_target)]
+        self.rotation = Mock(
+            arn=ARN,
+            token=TOKEN,
+            current_value='old_token',
+            pending_value='new_token',
+            deadline=Deadline(),
+        )
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = FileCheckpointStore(directory.name)
+
+    def run_state_machine(self):
+        """Run the state machine over the mocked helpers."""
+
+        SetSecretStateMachine(
+            self.rotation, self.store, self.modify_listener, self.token_refresh
+        ).run()
+
+    def test_run(self):
+        """Test every phase runs in order and is checkpointed."""
+
+        self.run_state_machine()
+
+        self.assertEqual(
+            [call.args[0] for call in self.modify_listener.modify_rule.call_args_list],
+            [['old_token', 'new_token'], ['new_token']],
+        )
+        # The rules read for the plan are written back without reading them again
+        self.token_refresh.roll_token.assert_called_once_with(
+            'new_token', [self.cf_target], {self.cf_target: cf_rule('old_token')}
+        )
+        self.assertEqual(self.store.load(ARN, TOKEN), 'alb_single')
+
+    def test_resume_after_cloudflare(self):
+        """Test a retry after the cloudflare phase neither reads nor writes cloudflare."""
+
+        self.store.save(ARN, TOKEN, 'cloudflare')
+        self.modify_listener.get_token_values.return_value = {
+            RULE_ARN: ['old_token', 'new_token']
+        }
+
+        self.run_state_machine()
+
+        self.token_refresh.get_rules.assert_not_called()
+        self.token_refresh.roll_token.assert_not_called()
+        self.modify_listener.modify_rule.assert_called_once_with(
+            ['new_token'], [self.alb_target]
+        )
+
+    def test_resume_completed(self):
+        """Test a retry of a completed version does nothing."""
+
+        self.store.save(ARN, TOKEN, 'alb_single')
+
+        self.run_state_machine()
+
+        self.modify_listener.get_token_values.assert_not_called()
+        self.modify_listener.modify_rule.assert_not_called()
+
+    def test_failed_phase_is_not_checkpointed(self):
+        """Test a failed phase leaves the previous checkpoint for the retry."""
+
+        self.token_refresh.roll_token.return_value = [
+            TargetResult(self.cf_target, error=ValueError('failed'))
+        ]
+
+        with self.assertRaises(RuntimeError):
+            self.run_state_machine()
+        self.assertEqual(self.store.load(ARN, TOKEN), 'alb_dual')
+
+    def test_deadline_stops_before_phase(self):
+        """Test the state machine stops with a resumable error when time runs out."""
+
+        self.token_refresh.roll_token.side_effect = lambda *args: (
+            setattr(self.rotation, 'deadline', Deadline.after(-1))
+            or [TargetResult(self.cf_target)]
+        )
+
+        with self.assertRaises(DeadlineExceeded):
+            self.run_state_machine()
+        self.assertEqual(self.store.load(ARN, TOKEN), 'cloudflare')
+
+    def test_reads_overlap(self):
+        """Test the tokens and remote state are read concurrently."""
+
+        def slow(value):
+            time.sleep(0.2)
+            return value
+
+        self.modify_listener.get_token_values.side_effect = lambda: slow({RULE_ARN: ['old_token']})
+        rules = {self.cf_target: cf_rule('old_token')}
+        self.token_refresh.get_rules.side_effect = lambda: slow(rules)
+        state_machine = SetSecretStateMachine(
+            self.rotation, self.store, self.modify_listener, self.token_refresh
+        )
+
+        start = time.perf_counter()
+        plan = state_machine.plan(['alb_dual', 'cloudflare', 'alb_single'])
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual(plan['cloudflare'], [self.cf_target])
+        self.assertEqual(
+            (state_machine.old_token, state_machine.new_token), ('old_token', 'new_token')
+        )
+
+    def test_read_failure(self):
+        """Test a failed read stops before any phase runs."""
+
+        self.token_refresh.get_rules.side_effect = ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            self.run_state_machine()
+        self.modify_listener.modify_rule.assert_not_called()
+
+    def test_propagation_before_single_token(self):
+        """Test the old token is only dropped after the edge sends the new one."""
+
+        calls = []
+        propagation = Mock()
+        propagation.wait_for.side_effect = lambda token: calls.append(('wait_for', token))
+        self.modify_listener.modify_rule.side_effect = lambda token, targets: (
+            calls.append(('modify_rule', token)) or [TargetResult(self.alb_target)]
+        )
+
+        SetSecretStateMachine(
+            self.rotation, self.store, self.modify_listener, self.token_refresh, propagation
+        ).run()
+
+        self.assertEqual(
+            calls,
+            [
+                ('modify_rule', ['old_token', 'new_token']),
+                ('wait_for', 'new_token'),
+                ('modify_rule', ['new_token']),
+            ],
+        )
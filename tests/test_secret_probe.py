@@ -0,0 +1,91 @@
+""" Tests for the test secret probe harness. """
+
+import sys
+import unittest
+from unittest.mock import Mock, patch
+
+sys.path.append('.')
+
+import lambda_function
+from alb_standin import ListenerStandin
+from deadline import Deadline
+from secret_probe import ProbeFailed, ProbeHarness, percentile
+
+
+class ProbeHarnessTestCase(unittest.TestCase):
+    """Tests for the probe harness against a header checking stand-in."""
+
+    def setUp(self):
+        self.listener = ListenerStandin(accepted=['new_token']).start()
+        self.addCleanup(self.listener.stop)
+
+    def harness(self, **kwargs):
+        """Return a harness probing the stand-in."""
+
+        options = dict(urls=[self.listener.address], requests_per_url=20, concurrency=5)
+        options.update(kwargs)
+        return ProbeHarness(**options)
+
+    def test_accepted(self):
+        """Test an accepted token passes with latency percentiles recorded."""
+
+        reports = self.harness().check('new_token')
+
+        self.assertEqual((reports[0].sent, reports[0].accepted), (20, 20))
+        self.assertEqual(len(reports[0].latencies), 20)
+        self.assertLessEqual(reports[0].p50, reports[0].p99)
+        self.assertEqual(
+            {request[2] for request in self.listener.requests}, {'new_token'}
+        )
+
+    def test_rejected_fails_fast(self):
+        """Test a rejected token fails without sending the whole burst."""
+
+        with self.assertRaises(ProbeFailed):
+            self.harness(requests_per_url=100).check('old_token')
+        self.assertLess(len(self.listener.requests), 100)
+
+    def test_min_acceptance(self):
+        """Test a partial acceptance passes when the threshold allows it."""
+
+        self.listener.accepted = lambda: ['new_token'] if len(self.listener.requests) % 2 else []
+
+        with self.assertRaises(ProbeFailed):
+            self.harness(concurrency=1).check('new_token')
+        reports = self.harness(concurrency=1, min_acceptance=0.4).check('new_token')
+
+        self.assertEqual(reports[0].accepted, 10)
+
+    def test_latency_regression(self):
+        """Test a slow endpoint fails the p99 threshold."""
+
+        self.listener.latency = 0.05
+
+        with self.assertRaises(ProbeFailed) as raised:
+            self.harness(requests_per_url=5, max_p99_ms=20).check('new_token')
+        self.assertIn('p99', str(raised.exception))
+
+    def test_unreachable(self):
+        """Test an unreachable host counts as rejected."""
+
+        with self.assertRaises(ProbeFailed):
+            self.harness(urls=['http://127.0.0.1:9'], requests_per_url=3).check('new_token')
+
+    def test_percentile(self):
+        """Test the nearest rank percentile."""
+
+        self.assertEqual(percentile(range(1, 101), 0.5), 50)
+        self.assertEqual(percentile(range(1, 101), 0.99), 99)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_test_secret(self):
+        """Test the test secret step probes the configured hosts with the pending token."""
+
+        rotation = Mock(pending_value='old_token', deadline=Deadline())
+
+        with patch('secret_probe.PROBE_URLS', [self.listener.address]):
+            with self.assertRaises(ProbeFailed):
+                lambda_function.test_secret(rotation)
+            rotation.pending_value = 'new_token'
+            lambda_function.test_secret(rotation)
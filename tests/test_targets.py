@@ -0,0 +1,42 @@
+""" Tests for the rotation targets. """
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append('.')
+
+from targets import CloudflareTarget, load_targets, run_concurrently
+
+
+class TargetsTestCase(unittest.TestCase):
+    """Tests for the rotation targets."""
+
+    def test_run_concurrently(self):
+        """Test results keep the target order and capture errors."""
+
+        def update(target):
+            if target == 2:
+                raise ValueError('failed')
+            return target * 10
+
+        results = run_concurrently(update, [1, 2, 3], max_workers=2)
+
+        self.assertEqual([result.target for result in results], [1, 2, 3])
+        self.assertEqual([result.response for result in results], [10, None, 30])
+        self.assertEqual([result.success for result in results], [True, False, True])
+        self.assertIsInstance(results[1].error, ValueError)
+
+    def test_load_targets(self):
+        """Test targets are read from the environment or fall back to the default."""
+
+        default = [CloudflareTarget('zone', 'ruleset', 'rule')]
+        self.assertEqual(load_targets('TEST_TARGETS', CloudflareTarget, default), default)
+
+        value = '[{"zone_id": "z1", "ruleset_id": "r1", "rule_id": "id1"}]'
+        with patch.dict(os.environ, {'TEST_TARGETS': value}):
+            self.assertEqual(
+                load_targets('TEST_TARGETS', CloudflareTarget, default),
+                [CloudflareTarget('z1', 'r1', 'id1')],
+            )